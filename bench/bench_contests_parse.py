@@ -0,0 +1,63 @@
+# コンテストアーカイブHTMLのパース速度を測る
+# 保存済のアーカイブページ(fixtures/contests_archive_page.html)を使う
+#
+# 使い方（src/から実行する）
+#  python ../bench/bench_contests_parse.py [ページ数]
+
+import os
+import sys
+import time
+import datetime
+import pandas as pd
+from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import lib
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'contests_archive_page.html')
+
+# 比較用: 以前の実装（1行ごとにDataFrameを作ってconcatする）
+def parse_legacy(text):
+    bs = BeautifulSoup(text, 'html.parser').find('tbody')
+    df = pd.DataFrame()
+    while True:
+        bs = bs.find_next('tr')
+        if bs is None: break
+        bs_td = bs.find_all('td')
+        start_epoch_second = datetime.datetime.fromisoformat(bs_td[0].find('time').text).timestamp()
+        type_ = bs_td[1].find('span')['title']
+        contest_id = bs_td[1].find('a')['href'].split('/')[-1]
+        title = bs_td[1].find('a').text
+        hours, minutes = map(int, bs_td[2].text.split(':'))
+        duration_second = datetime.timedelta(hours=hours, minutes=minutes).total_seconds()
+        end_epoch_second = start_epoch_second + duration_second
+        rated = int(bs_td[3].text != '-')
+        df_add = pd.DataFrame([[contest_id, start_epoch_second, end_epoch_second, duration_second, title, rated, type_]],
+            columns=['contest_id', 'start_epoch_second', 'end_epoch_second',
+                     'duration_second', 'title', 'rated', 'type_']).set_index('contest_id')
+        df = pd.concat([df, df_add])
+    return df
+
+def measure(name, func, texts):
+    start_time = time.perf_counter()
+    dfs = func(texts)
+    duration = time.perf_counter() - start_time
+    print(f'{name:24s} {duration:8.3f}sec {len(texts) / duration:8.1f}pages/sec')
+    return dfs
+
+def main(pages=20):
+    with open(FIXTURE) as f:
+        texts = [f.read()] * pages
+    print(f'{pages} pages, parser={lib.HTML_PARSER}')
+    legacy = measure('legacy (row concat)', lambda t: [parse_legacy(x) for x in t], texts)
+    current = measure('columnar', lambda t: [lib.parse_contests_archive(x) for x in t], texts)
+    with ProcessPoolExecutor() as executor:
+        parallel = measure('columnar (processes)', lambda t: list(executor.map(lib.parse_contests_archive, t)), texts)
+    for a, b, c in zip(legacy, current, parallel):
+        pd.testing.assert_frame_equal(a, b)
+        pd.testing.assert_frame_equal(a, c)
+    print('results are identical')
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
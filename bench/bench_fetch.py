@@ -0,0 +1,111 @@
+# 取得（fetch → get_cached_url → parse）の速さ、リトライ、レート制限の遵守を、ローカルの代役サーバ（src/replay.py）で測る
+# 合成データ（bench/synthetic.py）をフィクスチャにして返し、ストアには一部だけを置いて、残りを取得させる
+# - submissions: 最後の --catchup の割合の提出を、提出API（500件ずつ）で追いつく
+# - results: 最後の --contests 個のコンテストの結果を取得する（並列の先読みあり）
+# - problem_models: 一部の問題を消して、problem-models.json を取得しなおす（条件付きGET）
+# 取得後の行数が元のテーブルと一致することも確かめる
+#
+# 使い方（src/から実行する）
+#  python ../bench/bench_fetch.py [--rows 200000] [--latency 0.05] [--error-rate 0.05] [--throttle-rate 0.05] [--rate 20]
+#  --rate: クライアントの1秒あたりのリクエスト数（config.yaml の fetcher.hosts を上書きする）
+#          サーバはそれを超えたリクエストに429を返す（--server-rateで別に指定できる）
+
+import os
+import sys
+import time
+import yaml
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import synthetic
+from bench_pipeline import setup
+
+HOSTS = ['atcoder.jp', 'kenkoooo.com']
+
+def run(args, workdir):
+    setup(workdir)
+    from lib import AtCoderDB
+    from replay import ReplayServer
+    with open('config.yaml') as f:
+        config = yaml.safe_load(f)
+    dfs = synthetic.tables(args.rows, args.seed)
+    fixtures = os.path.join(workdir, 'in', 'fixtures')
+    synthetic.write_fixtures(fixtures, dfs)
+
+    # ストアには一部だけを置く
+    submissions = dfs['submissions']
+    kept = submissions.iloc[:int(len(submissions) * (1 - args.catchup))]
+    contest_ids = dfs['contests'].index[dfs['contests']['rated'] == 1][-args.contests:]
+    results = dfs['results']
+    problem_models = dfs['problem_models']
+    synthetic.write(config['database'], {
+        'submissions': kept, 'contests': dfs['contests'],
+        'results': results[~results['contest_id'].isin(contest_ids)].reset_index(drop=True),
+        'problem_models': problem_models.iloc[:len(problem_models) // 2],
+    })
+    updated = synthetic.updated(int(kept['epoch_second'].max()))
+    updated['submissions']['fetch_epoch_second'] = 0
+    with open(config['updated']['filename'], 'w') as f:
+        yaml.safe_dump(updated, f, default_flow_style=False)
+
+    server_rate = args.server_rate or args.rate
+    server = ReplayServer(fixtures, {
+        'latency': args.latency, 'jitter': args.latency, 'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate, 'retry_after': args.retry_after, 'seed': args.seed,
+        'rate_limit': {host: {'rate': server_rate, 'burst': args.burst + 1} for host in HOSTS},
+    }).start()
+    config['fetcher']['rewrite'] = server.rewrite()
+    config['fetcher']['backoff'] = args.retry_after
+    config['fetcher']['hosts'] = {host: {'rate': args.rate, 'burst': args.burst} for host in HOSTS}
+    with open('config.yaml', 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False, allow_unicode=True)
+
+    print(f'{"key":16s} {"sec":>8s} {"rows":>9s} {"rows/sec":>10s} {"requests":>9s} {"retries":>8s}  status')
+    try:
+        for key, expected in [('submissions', len(submissions)), ('results', len(results)),
+                              ('problem_models', len(problem_models))]:
+            db = AtCoderDB()
+            start_time = time.perf_counter()
+            rows = len(db.df(key))
+            seconds = time.perf_counter() - start_time
+            stats = db.fetcher.stats
+            status = ' '.join(f'{k.removeprefix("status_")}:{v}' for k, v in sorted(stats.items()) if k.startswith('status_'))
+            print(f'{key:16s} {seconds:8.2f} {rows:9,d} {rows / seconds:10,.0f} {stats["requests"]:9d} {stats["retries"]:8d}  {status}')
+            assert rows == expected, f'Fetched {key} has {rows} rows, expected {expected}.'
+        stats = server.stats()
+    finally:
+        server.stop()
+    print(f'server: {stats["requests"]} requests, status {stats["status"]}, {stats["limited"]} over the rate limit')
+    for host, count in stats['max_per_second'].items():
+        # トークンバケットが1秒間に許すのは burst + rate 回まで
+        allowed = args.burst + args.rate
+        print(f'{host:16s} max {count} requests/sec (client allows {allowed:g})' + (' <- exceeded' if count > allowed else ''))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fetching against the local replay server.')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--catchup', type=float, default=0.1)
+    parser.add_argument('--contests', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=0.1)
+    parser.add_argument('--rate', type=float, default=20)
+    parser.add_argument('--burst', type=float, default=2)
+    parser.add_argument('--server-rate', type=float)
+    parser.add_argument('--keep', action='store_true')
+    args = parser.parse_args()
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='atcoder-bench-fetch-')
+    print(f'{args.rows:,} submissions, seed={args.seed}, workdir={workdir}')
+    try:
+        run(args, workdir)
+    finally:
+        os.chdir(cwd)
+        if not args.keep: shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
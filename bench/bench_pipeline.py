@@ -0,0 +1,171 @@
+# AtCoderDB / Usersのパイプラインを、合成データ（bench/synthetic.py）で段ごとに測る
+# 一時ディレクトリに src/（config.yamlのコピー）、in/、out/ を作り、そこで実行するので実データには触れない
+#
+# 段: generate → load_file → prepare → add_diff_and_tee_in_submissions → Users.agg → Users.resample
+#     → Users.agg(M) → filter → users.main（full、差分）→ users.main(stale)
+# users.main(stale): 親プロセスのfetchから5分以上たってワーカーが起動した場合（submissionsの依存関係は時刻で破れるが、
+#                    ワーカーはprepare済のテーブルをそのまま使う）
+# 各段の秒、行/秒、ピークメモリ（その段の間の最大RSS）をJSONに書き、ベースラインがあれば比較する
+# users.mainは別プロセスで実行し、ピークメモリはワーカーを含む子プロセスの最大RSS
+#
+# 使い方（src/から実行する）
+#  python ../bench/bench_pipeline.py [--rows 1000000] [--seed 0] [--save] [--keep]
+#  --save: 結果をベースライン（--baseline、既定は bench/baseline.json）として保存する
+#          省略時はベースラインと比較して、遅くなった段（--tolerance倍を超えたもの）に印をつける
+#  --keep: 一時ディレクトリを残す（中身を調べたいとき）
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+import synthetic
+
+# ピークRSS(MB) Linuxでは/proc/self/clear_refsで段ごとにリセットできる、それ以外はプロセス全体の最大値
+def reset_peak():
+    if os.path.exists('/proc/self/clear_refs'):
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+def peak_mb():
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            return int(re.search(r'VmHWM:\s+(\d+)', f.read()).group(1)) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+class Bench:
+    def __init__(self):
+        self.stages = {}
+
+    # func()を測る、rowsは処理した行数（スループットの分母）
+    def measure(self, name, rows, func):
+        reset_peak()
+        start_time = time.perf_counter()
+        result = func()
+        self.record(name, rows, time.perf_counter() - start_time, peak_mb())
+        return result
+
+    def record(self, name, rows, seconds, peak):
+        self.stages[name] = {'seconds': round(seconds, 4), 'rows': int(rows),
+                             'rows_per_sec': round(rows / seconds) if seconds > 0 else None, 'peak_mb': round(peak, 1)}
+        print(f'{name:34s} {seconds:9.3f}sec {rows / max(seconds, 1e-9):14,.0f}rows/sec {peak:9.1f}MB', flush=True)
+
+    # users.mainを別プロセスで実行する（spawnのワーカーを含めて測る）
+    def measure_main(self, name, rows, args):
+        before = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(SRC, 'users.py')] + args, check=True, stdout=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start_time
+        peak = max(before, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        self.record(name, rows, seconds, peak / (1024 ** 2 if sys.platform == 'darwin' else 1024))
+
+# workdirの下に src/（config.yamlのコピー）、in/、out/ を作って、src/に移る
+# （config.yamlの相対パス ../out、../in がworkdirの下を指す）
+def setup(workdir):
+    os.makedirs(os.path.join(workdir, 'src'))
+    os.makedirs(os.path.join(workdir, 'in'))
+    os.makedirs(os.path.join(workdir, 'out', 'users'))
+    shutil.copy(os.path.join(SRC, 'config.yaml'), os.path.join(workdir, 'src'))
+    os.chdir(os.path.join(workdir, 'src'))
+
+def run(rows, seed, workdir):
+    setup(workdir)
+    from lib import AtCoderDB
+    from users import Users
+    import storage
+
+    bench = Bench()
+    db = AtCoderDB()
+    counts = bench.measure('generate', rows, lambda: synthetic.generate(db.config['database'], rows, seed))
+    item = db.config['database']['submissions']
+    last_epoch = int(storage.read(item['filename'], item['storage'], item.get('schema'), ['epoch_second'],
+                                  partition=item.get('partition'))['epoch_second'].max())
+    db.updated = synthetic.updated(last_epoch)
+    db.save_updated()
+
+    # AtCoderDB()は呼ぶたびに初期化される（読み込み済のテーブルを持たない）
+    bench.measure('load_file', rows, lambda: AtCoderDB().load_file('submissions', item['filename']))
+    db = AtCoderDB()
+    bench.measure('prepare', rows, lambda: db.prepare(['submissions', 'contests', 'results', 'problem_models']))
+    bench.measure('add_diff_and_tee_in_submissions', rows, db.add_diff_and_tee_in_submissions)
+    users = Users.from_db(db, 'submissions', columns=['problem_id', 'point', 'diff', 'tee', 'execution_time'])
+    agg = {'problem_id': ('size', 'submissions'), 'point': 'sum', 'diff': 'mean', 'tee': 'last', 'execution_time': 'max'}
+    bench.measure('Users.agg', rows, lambda: users.agg(agg))
+    monthly = bench.measure('Users.resample', rows, lambda: users.resample('M'))
+    bench.measure('Users.agg(M)', rows, lambda: monthly.agg(agg))
+    contest_ids = db.df('contests').index[db.df('contests')['type_'] == 'Algorithm'][::10].to_list()
+    period = range(synthetic.START_EPOCH, (synthetic.START_EPOCH + last_epoch) // 2)
+    bench.measure('filter', rows, lambda: db.filter('submissions', contest_id=contest_ids, epoch_second=period))
+
+    bench.measure_main('users.main(full)', rows, ['full'])
+    bench.measure_main('users.main', rows, [])
+    db = AtCoderDB()
+    db.updated['submissions']['fetch_epoch_second'] = int(time.time()) - 400
+    db.save_updated()
+    bench.measure_main('users.main(stale)', rows, ['jobs'])
+    return {
+        'rows': rows, 'seed': seed, 'tables': counts,
+        'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+        'machine': platform.machine(), 'cpus': os.cpu_count(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stages': bench.stages,
+    }
+
+# ベースラインとの比較（秒の比、tolerance倍を超えたら印をつける）
+def compare(result, baseline, tolerance):
+    if baseline['rows'] != result['rows'] or baseline['seed'] != result['seed']:
+        print(f'Baseline is for rows={baseline["rows"]}, seed={baseline["seed"]}, ratios are not comparable.')
+        return
+    print(f'Compared with the baseline at {baseline["date"]} (ratio = this / baseline)')
+    for name, stage in result['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None or not base['seconds']: continue
+        ratio = stage['seconds'] / base['seconds']
+        memory = stage['peak_mb'] / base['peak_mb'] if base['peak_mb'] else float('nan')
+        mark = ' <- slower' if ratio > tolerance else ''
+        print(f'{name:34s} time x{ratio:5.2f}  memory x{memory:5.2f}{mark}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AtCoderDB / Users pipeline on synthetic data.')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.2)
+    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('--output', help='write this run as JSON')
+    args = parser.parse_args()
+    baseline = os.path.abspath(args.baseline)
+    output = os.path.abspath(args.output) if args.output else None
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='atcoder-bench-')
+    print(f'{args.rows:,} submissions, seed={args.seed}, workdir={workdir}')
+    try:
+        result = run(args.rows, args.seed, workdir)
+    finally:
+        os.chdir(cwd)
+        if not args.keep: shutil.rmtree(workdir)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.save:
+        with open(baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f'Saved the baseline to {baseline}')
+    elif os.path.isfile(baseline):
+        with open(baseline) as f:
+            compare(result, json.load(f), args.tolerance)
+
+if __name__ == '__main__':
+    main()
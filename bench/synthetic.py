@@ -0,0 +1,243 @@
+# ベンチマーク用の合成データ（submissions / contests / results / problem_models）
+# 乱数のseedを固定すれば、同じ行数からは常に同じデータになる
+#
+# 実データに近づけている分布
+# - コンテスト: ABC毎週(土)、ARC隔週(日)、AGC 5週ごと(日)、AHC 4週ごと（長時間）、ほかにunratedの問題集
+# - ユーザの活動量: Zipf分布（少数のユーザが多くを提出する）
+# - 提出の半分はコンテスト中（前の問題ほど多い）、残りはコンテスト後の精進（終了直後ほど多い）
+# - result / language は実データの比率に近い重み、languageは2023言語アップデートの前後で名前が変わる
+# - results: 参加者はユーザの活動量に比例して選び、perfは実力のまわりに散らばる、new_rateはperfの累積平均から補正を引く
+#
+# 使い方（src/から）
+#  import synthetic; synthetic.generate(db.config['database'], rows)
+#  config.yaml の filename / storage / schema にしたがって書き出すので、作業ディレクトリをsrc/相当にしておくこと
+#  synthetic.write_fixtures(dirname, synthetic.tables(rows)) で、取得先のAPIの形のフィクスチャにする
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import storage
+
+START_EPOCH = 1467460800        # 2016-07-02 21:00 JST（土）
+END_EPOCH = 1767193200          # 2026-01-01 00:00 JST
+LANGUAGE_UPDATE_EPOCH = 1690815600  # 2023-08-01 00:00 JST
+WEEK = 7 * 86400
+
+# (prefix, 初回のオフセット秒, 間隔週, 問題数, コンテスト時間秒, rated, type_, 提出の重み)
+CONTEST_TYPES = [
+    ('abc', 0, 1, 7, 6000, 1, 'Algorithm', 8.0),
+    ('arc', 86400, 2, 6, 7200, 1, 'Algorithm', 2.0),
+    ('agc', 86400 + WEEK, 5, 6, 10800, 1, 'Algorithm', 1.0),
+    ('ahc', 3 * 86400 + 2 * WEEK, 4, 1, 14400, 1, 'Heuristic', 0.5),
+]
+# (contest_id, 問題数) いずれもunrated、START_EPOCHから公開されているものとする
+PRACTICE_CONTESTS = [('typical90', 90), ('tessoku-book', 150), ('math-and-algorithm', 104)]
+
+RESULTS = {'AC': 0.50, 'WA': 0.28, 'TLE': 0.09, 'RE': 0.05, 'CE': 0.05, 'MLE': 0.02, 'OLE': 0.01}
+# (2023言語アップデート前の名前, 後の名前, 重み)
+LANGUAGES = [
+    ('C++ (GCC 9.2.1)', 'C++ 20 (gcc 12.2)', 0.45),
+    ('Python (3.8.2)', 'Python (CPython 3.11.4)', 0.15),
+    ('PyPy3 (7.3.0)', 'Python (PyPy 3.10-v7.3.12)', 0.15),
+    ('Rust (1.42.0)', 'Rust (rustc 1.70.0)', 0.05),
+    ('Java (OpenJDK 11.0.6)', 'Java (OpenJDK 17)', 0.05),
+    ('C# (.NET Core 3.1.201)', 'C# 11.0 (.NET 7.0.7)', 0.04),
+    ('Go (1.14.1)', 'Go (go 1.20.6)', 0.03),
+    ('Ruby (2.7.1)', 'Ruby (ruby 3.2.2)', 0.03),
+    ('Kotlin (1.3.71)', 'Kotlin (Kotlin/JVM 1.8.20)', 0.02),
+    ('Haskell (GHC 8.8.3)', 'Haskell (GHC 9.4.5)', 0.02),
+    ('JavaScript (Node.js 12.16.1)', 'JavaScript (Node.js 18.16.1)', 0.01),
+]
+COUNTRIES = {'JP': 0.75, 'CN': 0.06, 'US': 0.04, 'KR': 0.03, 'VN': 0.03, 'TW': 0.02, 'IN': 0.02, '': 0.05}
+AFFILIATIONS = 200
+
+# 重みの累積分布から一括で引く（np.random.Generator.choiceは呼ぶたびに累積分布を作り直すので使わない）
+def choice(rng, cdf, size):
+    return np.minimum(np.searchsorted(cdf, rng.random(size) * cdf[-1], side='right'), len(cdf) - 1)
+
+def contests():
+    rows = []
+    for prefix, offset, interval, problems, duration, rated, type_, weight in CONTEST_TYPES:
+        starts = np.arange(START_EPOCH + offset, END_EPOCH - duration, interval * WEEK)
+        for i, start in enumerate(starts):
+            rows.append([f'{prefix}{i + 1:03d}', start, start + duration, duration, f'{prefix.upper()} {i + 1:03d}',
+                         rated, type_, problems, weight])
+    for contest_id, problems in PRACTICE_CONTESTS:
+        rows.append([contest_id, START_EPOCH, START_EPOCH, 0, contest_id, 0, 'Algorithm', problems, 0.0])
+    df = pd.DataFrame(rows, columns=['contest_id', 'start_epoch_second', 'end_epoch_second', 'duration_second', 'title',
+                                     'rated', 'type_', 'problems', 'weight'])
+    return df.sort_values('start_epoch_second', kind='stable').set_index('contest_id')
+
+# 問題の一覧 problem_id順で、(contest_id, problem_id, 問題の番号, 満点) を持つ
+def problems(df_contests):
+    contest_ids = np.repeat(df_contests.index.to_numpy(), df_contests['problems'].to_numpy())
+    numbers = np.concatenate([np.arange(n) for n in df_contests['problems']])
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    names = np.where(df_contests['problems'].reindex(contest_ids).to_numpy() <= len(letters),
+                     letters[np.minimum(numbers, len(letters) - 1)], (numbers + 1).astype(str))
+    return pd.DataFrame({'contest_id': contest_ids, 'problem_id': [f'{c}_{n}' for c, n in zip(contest_ids, names)],
+                         'number': numbers, 'point': (numbers + 1) * 100})
+
+def generate_submissions(rng, rows, df_contests, df_problems, user_ids, user_cdf):
+    n_contest = rows // 2
+    problem_codes = np.empty(rows, dtype=np.int64)
+    epochs = np.empty(rows, dtype=np.int64)
+    # コンテスト中の提出（コンテストは重みで、問題は前のものほど多く選ぶ）
+    rated = df_contests[df_contests['weight'] > 0]
+    contest_codes = choice(rng, np.cumsum(rated['weight'].to_numpy()), n_contest)
+    first = df_problems.reset_index().groupby('contest_id', sort=False)['index'].min().reindex(rated.index).to_numpy()
+    count = rated['problems'].to_numpy()
+    number = np.minimum(rng.geometric(0.35, n_contest) - 1, count[contest_codes] - 1)
+    problem_codes[:n_contest] = first[contest_codes] + number
+    start = rated['start_epoch_second'].to_numpy()[contest_codes]
+    epochs[:n_contest] = start + (rng.random(n_contest) * rated['duration_second'].to_numpy()[contest_codes]).astype(np.int64)
+    # 精進の提出（問題は一様に選び、公開後の経過が短いほど多い）
+    n_practice = rows - n_contest
+    problem_codes[n_contest:] = rng.integers(0, len(df_problems), n_practice)
+    released = df_contests['end_epoch_second'].reindex(df_problems['contest_id']).to_numpy()[problem_codes[n_contest:]]
+    epochs[n_contest:] = released + ((END_EPOCH - released) * rng.random(n_practice) ** 2).astype(np.int64)
+    order = np.argsort(epochs, kind='stable')
+    epochs, problem_codes = epochs[order], problem_codes[order]
+    result_codes = choice(rng, np.cumsum(list(RESULTS.values())), rows)
+    language_codes = choice(rng, np.cumsum([w for _, _, w in LANGUAGES]), rows) * 2 + (epochs >= LANGUAGE_UPDATE_EPOCH)
+    execution_time = np.minimum(np.exp(rng.normal(3.5, 1.5, rows)), 10000).round().astype(np.float32)
+    execution_time[result_codes == list(RESULTS).index('CE')] = np.nan
+    problem_ids = pd.Categorical.from_codes(problem_codes, df_problems['problem_id'])
+    return pd.DataFrame({
+        'epoch_second': epochs,
+        'problem_id': problem_ids,
+        'contest_id': pd.Categorical.from_codes(pd.factorize(df_problems['contest_id'])[0][problem_codes],
+                                                pd.unique(df_problems['contest_id'])),
+        'user_id': pd.Categorical.from_codes(choice(rng, user_cdf, rows), user_ids),
+        'language': pd.Categorical.from_codes(language_codes, [name for pair in LANGUAGES for name in pair[:2]]),
+        'point': np.where(result_codes == 0, df_problems['point'].to_numpy()[problem_codes], 0).astype(np.int32),
+        'length': np.clip(np.exp(rng.normal(7, 1, rows)), 1, 512000).astype(np.int32),
+        'result': pd.Categorical.from_codes(result_codes, list(RESULTS)),
+        'execution_time': execution_time,
+    }, index=pd.Index(np.arange(1, rows + 1, dtype=np.int64), name='id'))
+
+def generate_results(rng, rows, df_contests, user_ids, user_cdf):
+    rated = df_contests[df_contests['rated'] == 1]
+    # 提出のおよそ1/6の行数（実データの比率）
+    participants = int(np.clip(rows // 6 // max(len(rated), 1), 10, len(user_ids)))
+    frames = []
+    for contest_id, end in zip(rated.index, rated['end_epoch_second']):
+        users = np.unique(choice(rng, user_cdf, participants))
+        frames.append(pd.DataFrame({'contest_id': contest_id, 'end_epoch_second': end, 'user': users}))
+    df = pd.concat(frames).sort_values('end_epoch_second', kind='stable', ignore_index=True)
+    df['type_'] = rated['type_'].reindex(df['contest_id']).to_numpy()
+    # 活動量の多いユーザほど実力が高い
+    skill = 2400 - 2000 * np.log1p(np.arange(len(user_ids))) / np.log1p(len(user_ids)) + rng.normal(0, 300, len(user_ids))
+    df['perf'] = np.maximum(skill[df['user']] + rng.normal(0, 300, len(df)), 1).round().astype(np.int32)
+    df['place'] = df.groupby('contest_id', sort=False)['perf'].rank(ascending=False, method='first').astype(np.int32)
+    groups = df.groupby(['user', 'type_'], sort=False)
+    n = groups.cumcount().to_numpy() + 1
+    mean = groups['perf'].cumsum().to_numpy() / n
+    df['new_rate'] = np.maximum(mean - 1200 * 0.8 ** n, 0).round().astype(np.int32)
+    df['old_rate'] = df.groupby(['user', 'type_'], sort=False)['new_rate'].shift(1, fill_value=0).astype(np.int32)
+    country = choice(rng, np.cumsum(list(COUNTRIES.values())), len(user_ids))
+    affiliation = rng.integers(-AFFILIATIONS, AFFILIATIONS, len(user_ids))
+    return pd.DataFrame({
+        'contest_id': df['contest_id'],
+        'end_epoch_second': df['end_epoch_second'],
+        'user_id': user_ids[df['user']],
+        'country': pd.Series(np.array(list(COUNTRIES))[country[df['user']]]).replace('', None),
+        'affiliation': pd.Series([f'University {x}' if x >= 0 else None for x in affiliation[df['user']]]),
+        'place': df['place'],
+        'old_rate': df['old_rate'],
+        'new_rate': df['new_rate'],
+        'perf': df['perf'],
+        'user_rated': np.int8(1),
+    })
+
+def generate_problem_models(rng, df_contests, df_problems):
+    df = df_problems[df_problems['contest_id'].isin(df_contests.index[df_contests['type_'] == 'Algorithm'])]
+    prefix = df['contest_id'].str[:3].to_numpy()
+    base = np.select([prefix == 'agc', prefix == 'arc'], [1600, 800], -400)
+    diff = base + df['number'].to_numpy() * 450 + rng.normal(0, 250, len(df))
+    # 問題集には難易度の無い問題がある（problem_modelsに載らない）
+    keep = (df_contests['rated'].reindex(df['contest_id']).to_numpy() == 1) | (rng.random(len(df)) < 0.7)
+    return pd.DataFrame({
+        'contest_id': df['contest_id'].to_numpy(),
+        'diff': np.maximum(diff, 0).round().astype(np.int32),
+        'tee': np.exp(rng.normal(6, 1, len(df))),
+    }, index=pd.Index(df['problem_id'].to_numpy(), name='problem_id'))[keep]
+
+# 4つのテーブル {key: DataFrame}（AtCoderDBで読み込んだときと同じ形）
+def tables(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    df_contests = contests()
+    df_problems = problems(df_contests)
+    # ユーザ数は提出のおよそ1/100、活動量はZipf（順位の1.1乗に反比例）
+    n_users = max(rows // 100, 100)
+    user_ids = np.array([f'user{i:07d}' for i in range(n_users)], dtype=object)
+    user_cdf = np.cumsum(1 / (np.arange(n_users) + 10.0) ** 1.1)
+    return {
+        'submissions': generate_submissions(rng, rows, df_contests, df_problems, user_ids, user_cdf),
+        'contests': df_contests.drop(columns=['problems', 'weight']),
+        'results': generate_results(rng, rows, df_contests, user_ids, user_cdf),
+        'problem_models': generate_problem_models(rng, df_contests, df_problems),
+    }
+
+# config.yaml の database にしたがって、テーブルを書き出す
+# 戻り値は {key: 行数}
+def write(config, dfs):
+    for key, df in dfs.items():
+        item = config[key]
+        os.makedirs(os.path.dirname(item['filename']), exist_ok=True)
+        storage.write(df, item['filename'], item.get('storage', 'csv'), item.get('schema'), item.get('partition'))
+    return {key: len(df) for key, df in dfs.items()}
+
+def generate(config, rows, seed=0):
+    return write(config, tables(rows, seed))
+
+# テーブルを、取得先のAPIが返す形のフィクスチャにする（src/replay.py で返す）
+# 提出は kenkoooo.com/submissions.json（提出APIはここから返す）、resultsはコンテストごと、
+# contests.json と problem-models.json は全体で1つ
+def write_fixtures(dirname, dfs):
+    from fetcher import fixture_path
+    def save(url, text):
+        filename = fixture_path(dirname, url)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(text)
+    df = dfs['submissions'].reset_index().astype({'point': np.float64})
+    save('https://kenkoooo.com/submissions.json', df.to_json(orient='records'))
+    df = dfs['contests'].reset_index()
+    save('https://kenkoooo.com/atcoder/resources/contests.json', pd.DataFrame({
+        'id': df['contest_id'], 'start_epoch_second': df['start_epoch_second'], 'duration_second': df['duration_second'],
+        'title': df['title'], 'rate_change': np.where(df['rated'] == 1, 'All', '-'),
+    }).to_json(orient='records'))
+    df = dfs['problem_models']
+    # tee = exp(slope * 4000 + intercept) になるように、slope=0とする
+    save('https://kenkoooo.com/atcoder/resources/problem-models.json', pd.DataFrame({
+        'slope': 0.0, 'intercept': np.log(df['tee']), 'variance': 0.1, 'difficulty': df['diff'].astype(np.float64),
+        'discrimination': 0.004, 'irt_loglikelihood': -100.0, 'irt_users': 1000, 'is_experimental': False,
+    }, index=df.index).to_json(orient='index'))
+    jst = pd.Timestamp(0, tz='UTC')
+    for contest_id, df in dfs['results'].groupby('contest_id', sort=False):
+        end = (jst + pd.to_timedelta(df['end_epoch_second'], unit='s')).dt.tz_convert('Asia/Tokyo')
+        save(f'https://atcoder.jp/contests/{contest_id}/results/json', pd.DataFrame({
+            'ContestScreenName': df['contest_id'] + '.contest.atcoder.jp',
+            'EndTime': end.map(lambda x: x.isoformat()), 'UserScreenName': df['user_id'],
+            'Country': df['country'], 'Affiliation': df['affiliation'], 'Place': df['place'],
+            'OldRating': df['old_rate'], 'NewRating': df['new_rate'], 'Performance': df['perf'],
+            'IsRated': df['user_rated'] == 1,
+        }).to_json(orient='records', force_ascii=False))
+
+# 生成したデータを取り込み済（fetch不要）とみなす updated.yaml の内容
+def updated(last_epoch):
+    df_contests = contests()
+    rated = df_contests[df_contests['rated'] == 1]
+    return {
+        'submissions': {'recently_contest_ids': [], 'fetch_epoch_second': 2 ** 40, 'base_file_last_epoch': last_epoch,
+                        'base_file_signature': None, 'watermark': last_epoch},
+        'contests': {'recently_rated_contest_ids': rated.index.to_list(),
+                     'recently_rated_algo_contest_ids': rated.index[rated['type_'] == 'Algorithm'].to_list(),
+                     'contest_ids': 'virtual'},
+        'results': {'contest_ids': 'virtual'},
+        'problem_models': {'contest_ids': 'virtual'},
+    }
@@ -1,6 +1,5 @@
 # 各種チャート
 # あらかじめコマンドラインで python users.py を実行しておくこと
-# KeyError: コンテスト名リストが出たら in/contsts.json を削除して再実行すること
 #
 # Pythonコマンドメニューにおいて
 #  from charts import *
@@ -34,20 +33,12 @@ def charts_rate_shojin():
 # 2023/5/20 Twitter投稿グラフ
 def chatts_typical_tessoku_alsu():
     db = AtCoderDB()
-    users = Users.from_db(db, 'submissions').filter({'contest_id':
-        (['typical90', 'tessoku-book', 'math-and-algorithm'], 'isin')})
-
-    def trend(users, contest_id):
-        res = users.filter({'contest_id': contest_id})\
-            .resample('M').drop_duplicates(['contest_id'])\
-            .df.groupby('datetime').size()
-        res.name = contest_id
-        return res
-
-    typical = trend(users, 'typical90')
-    tessoku = trend(users, 'tessoku-book')
-    alsu = trend(users, 'math-and-algorithm')
-    data = pd.concat([typical, tessoku, alsu], axis=1)[:-1].reset_index()  # 最新月は含まず
+    contest_ids = ['typical90', 'tessoku-book', 'math-and-algorithm']
+    # 月間ユニークユーザ数は集計キューブから得る
+    data = SubmissionCubes().read('users_month', contest_id=contest_ids)
+    data = data.pivot(index='datetime', columns='contest_id', values='users').reindex(columns=contest_ids)
+    data = data[:-1].reset_index()  # 最新月は含まず
+    data.columns.name = None
     data['datetime'] = (data['datetime'] - 200000).astype('str')
     data = data.set_index('datetime')
     p = sns.lineplot(data)
@@ -60,11 +51,14 @@ def chatts_typical_tessoku_alsu():
     plt.show()
 
     profile = UsersProfile()
+    profile.add_color('a_rate', 'a_color', inplace=True)
     import datetime
+    tz_jst = datetime.timezone(datetime.timedelta(hours=9))
+    from_ = int(datetime.datetime(2022, 11, 1, tzinfo=tz_jst).timestamp())
+    users = Users.from_df(db.query('submissions').where(contest_id=contest_ids, epoch_second=range(from_, 2 ** 62))
+                          .select(['user_id', 'epoch_second', 'contest_id']).collect(), 'submissions')
     def show_rates(users, contest_id):
-        tz_jst = datetime.timezone(datetime.timedelta(hours=9))
-        from_ = datetime.datetime(2022, 11, 1, tzinfo=tz_jst).timestamp()
-        res = users.filter({'contest_id': contest_id, 'datetime': (from_, '>=')})\
+        res = users.filter({'contest_id': contest_id})\
             .drop_duplicates(['contest_id'])\
             .df.merge(profile.df, on='user_id')
         atcoder_color = ['gray', 'brown', 'green', 'lightblue', 'blue', 'yellow', 'orange', 'red']
@@ -86,15 +80,22 @@ def chatts_typical_tessoku_alsu():
 # 2023/6/23 Twitter投稿グラフ
 def charts_AC_TLE(contest_id, languages=['C++', 'Python', 'Rust'], compare=['AC', 'TLE']):
     db = AtCoderDB()
-    db.filter('contests', contest_id=contest_id)
-    fr, to = map(int, db.df('contests')[['start_epoch_second', 'end_epoch_second']].to_numpy().tolist()[0])
+    contest = db.query('contests').where(contest_id=contest_id).collect()
+    fr, to = map(int, contest[['start_epoch_second', 'end_epoch_second']].to_numpy().tolist()[0])
     # コンテスト実行中のみに限定（終了時刻0秒は採用されない: AtCoderの動作で確認）
-    db.filter('submissions', contest_id=contest_id, epoch_second=range(fr, to))
-    db.transfer_languages_in_submissions()
-    submits = db.df('submissions')
-    db.filter('results', contest_id=contest_id)
-    results = db.df('results')
-    data = pd.merge(submits, results, on='user_id')
+    submits = db.transfer_languages(db.query('submissions').where(contest_id=contest_id, epoch_second=range(fr, to)).collect())
+    results = db.query('results').where(contest_id=contest_id).collect()
+    # コンテストの参加者について、提出時点のレート（レート推移から引く、初参加は0）
+    # レート推移（users.pyの出力）が無ければ、resultsのコンテスト前のレート(old_rate)を使う
+    data = submits[submits['user_id'].isin(results['user_id'])].reset_index(drop=True)
+    history = UsersHRateHistory() if contest['type_'].iloc[0] == 'Heuristic' else UsersARateHistory()
+    if history.df is not None:
+        timeline = RatingTimeline.from_users(history)
+        data['old_rate'] = timeline.rate_at(data['user_id'], data['epoch_second'], default=0)
+    else:
+        logging.warn(f'{history.filename} is not found (made by python users.py), using old_rate in results.')
+        old_rate = results.drop_duplicates('user_id').set_index('user_id')['old_rate']
+        data['old_rate'] = data['user_id'].astype(object).map(old_rate.rename(index=str)).to_numpy()
     data = data[data['result'].isin(compare)]
     data['problem_id'] = data['problem_id'].str.split('_').apply(lambda x: x[-1].upper())
     data = data.sort_values(['problem_id', 'result']).reset_index(drop=True)
@@ -112,19 +113,20 @@ def charts_AC_TLE(contest_id, languages=['C++', 'Python', 'Rust'], compare=['AC'
 
 # AtCoderの特定時間帯でのリクエスト推移
 # 2023/6/25 Twitter投稿グラフ
+# 提出数は集計キューブ（1分単位）から得るので、resolutionは60の倍数
 def charts_submissions_trend(contest_id, margin=300, resolution=60, heuristics=False):
+    assert resolution % 60 == 0, 'Resolution should be a multiple of 60 sec.'
     db = AtCoderDB()
-    db.filter('contests', contest_id=contest_id)
-    fr, to = map(int, db.df('contests')[['start_epoch_second', 'end_epoch_second']].to_numpy().tolist()[0])
-    # コンテスト実行中のみに限定（終了時刻0秒は採用されない: AtCoderの動作で確認）
+    contest = db.query('contests').where(contest_id=contest_id).collect()
+    fr, to = map(int, contest[['start_epoch_second', 'end_epoch_second']].to_numpy().tolist()[0])
+    where = {'datetime': range(fr - margin, to + margin)}
     if heuristics:
-        db.filter('submissions', problem_id=contest_id + '_a')
-    db.filter('submissions', epoch_second=range(fr - margin, to + margin))
-    data = db.df('submissions')
-    data['problem_id'][data['contest_id'] != contest_id] = 'other_contests'
+        where['problem_id'] = contest_id + '_a'
+    data = SubmissionCubes().read('counts_minute', columns=['datetime', 'contest_id', 'problem_id', 'count'], **where)
+    data['problem_id'] = data['problem_id'].astype(object).where(data['contest_id'] == contest_id, 'other_contests')
     hue_order = sorted(data['problem_id'].unique().tolist())
-    data['datetime'] = pd.to_datetime(data['epoch_second'], unit='s', utc=True).dt.tz_convert('Asia/Tokyo')
-    p = sns.histplot(data=data, x='datetime', hue='problem_id', hue_order=hue_order,
+    data['datetime'] = pd.to_datetime(data['datetime'], unit='s', utc=True).dt.tz_convert('Asia/Tokyo')
+    p = sns.histplot(data=data, x='datetime', weights='count', hue='problem_id', hue_order=hue_order,
         multiple='stack', bins=(to - fr + margin * 2) // resolution)
     p.set_ylabel(f'submissions / {resolution} sec')
     p.set_title(f'Submissions\' trend at the time of {contest_id}')
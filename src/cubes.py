@@ -0,0 +1,101 @@
+# 提出の集計キューブ（チャート用に、提出を時間の区切りごとに数えておく）
+# submissionsの生データを毎回走査しないように、out/cubes/ に次を保存して差分で更新する
+#
+# counts_{bucket}: (datetime, contest_id, problem_id, language, result) ごとの提出数 count
+# users_{bucket}:  (datetime, contest_id) ごとのユニークユーザ数 users
+#
+# bucket は 'minute'（datetime=分の初めのエポック秒）、'day'（YYYYMMDD）、'month'（YYYYMM）、いずれも東京時間
+# languageは変換集約前のもの（必要であればAtCoderDB.transfer_languagesを通す）
+#
+# 差分更新では、前回のウォーターマーク（ストアのマージと同じだけ遡る）を含む月の初めから後を作り直す
+# （月単位で作り直すので、ユニークユーザ数も足し合わせずに正しく求まる）
+# users.main のジョブとして実行される
+
+import os
+import yaml
+import logging
+import numpy as np
+import storage
+import kernels
+from lib import AtCoderDB, logging_time
+
+class SubmissionCubes:
+    INPUTS = ['submissions']
+    BUCKETS = ['minute', 'day', 'month']
+    DIMENSIONS = ['contest_id', 'problem_id', 'language', 'result']
+
+    def __init__(self):
+        self.config = AtCoderDB().config['cubes']
+        self.cubes = {}
+        self.watermark = None
+
+    def filename(self, name):
+        ext = 'csv' if self.config['storage'] == 'csv' else self.config['storage']
+        return os.path.join(self.config['dirname'], f'{name}.{ext}')
+
+    def meta_filename(self):
+        return os.path.join(self.config['dirname'], 'meta.yaml')
+
+    # キューブを読む（whereはAtCoderDB.filterの書式、保存形式が対応していれば読み込み時に絞る）
+    # 例 read('counts_minute', datetime=range(s, t), contest_id='abc300')
+    def read(self, name, columns=None, **where):
+        filename = self.filename(name)
+        assert os.path.isfile(filename), f'{filename} is not found, run python users.py first.'
+        return storage.read(filename, self.config['storage'], self.config.get('schema'), columns, where)
+
+    # エポック秒を、bucketのdatetimeへ
+    @classmethod
+    def bucket(cls, epoch, bucket):
+        match bucket:
+            case 'minute':
+                return epoch // 60 * 60
+            case 'day':
+                return kernels.resample_datetime(epoch, 'epoch', 'D')
+            case 'month':
+                return kernels.resample_datetime(epoch, 'epoch', 'M')
+            case _:
+                assert False, f'Bucket: {bucket} is not implemented.'
+
+    # epochを含む月の初め（東京時間）のエポック秒
+    @classmethod
+    def month_start(cls, epoch):
+        return int(kernels.to_epoch(kernels.resample_datetime([epoch], 'epoch', 'M'), 'M')[0])
+
+    @logging_time
+    def update(self, full=False):
+        db = AtCoderDB()
+        start = None
+        if not full and os.path.isfile(self.meta_filename()):
+            with open(self.meta_filename()) as f:
+                watermark = yaml.safe_load(f)['watermark']
+            overlap = db.config['database']['submissions']['pre_processing']['merge_overlap']
+            start = self.__class__.month_start(watermark - overlap)
+        query = db.query('submissions').select(['epoch_second', 'user_id', *self.__class__.DIMENSIONS])
+        if start is not None:
+            query = query.where(epoch_second=range(start, 2 ** 62))
+        delta = query.collect()
+        logging.info(f'Building cubes from {len(delta)} submissions')
+        epoch = delta['epoch_second'].to_numpy()
+        for bucket in self.__class__.BUCKETS:
+            datetime = self.__class__.bucket(epoch, bucket)
+            df = delta[self.__class__.DIMENSIONS].assign(datetime=datetime)
+            counts = df.groupby(['datetime', *self.__class__.DIMENSIONS], observed=True).size()
+            users = delta[['user_id', 'contest_id']].assign(datetime=datetime)\
+                .groupby(['datetime', 'contest_id'], observed=True)['user_id'].nunique()
+            for name, new in [(f'counts_{bucket}', counts.rename('count')), (f'users_{bucket}', users.rename('users'))]:
+                new = new.reset_index()
+                if start is not None and os.path.isfile(self.filename(name)):
+                    # 作り直す範囲より前だけを残す
+                    old = self.read(name, datetime=range(0, int(self.__class__.bucket(np.array([start]), bucket)[0])))
+                    new = storage.concat([old, new]).reset_index(drop=True)
+                self.cubes[name] = new
+        self.watermark = db.updated['submissions']['watermark']
+
+    def save(self):
+        os.makedirs(self.config['dirname'], exist_ok=True)
+        for name, df in self.cubes.items():
+            storage.write(df, self.filename(name), self.config['storage'], self.config.get('schema'))
+        # キューブを書いてからウォーターマークを記録する
+        with open(self.meta_filename(), 'w') as f:
+            yaml.safe_dump({'watermark': self.watermark}, f, default_flow_style=False)
+        logging.info(f'Saved cubes to {self.config["dirname"]}')
@@ -0,0 +1,148 @@
+# HTTP取得エンジン
+# requests.Session（keep-alive のコネクションプール）を共有し、複数URLをスレッドで並列に取得する
+# ホストごとのトークンバケットでリクエスト頻度を制限し、失敗時は指数バックオフでリトライする
+# 設定は config.yaml の fetcher にしたがう
+# rewrite でURLの先頭を書き換えられる（replay.py のローカルサーバに向けるときなど、レート制限は元のホストで数える）
+# record を設定すると、取得できた本文をフィクスチャとして保存する（fixture_path を参照、replay.py で返せる）
+
+import os
+import time
+import logging
+import threading
+import datetime
+import collections
+import requests
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit, quote
+from concurrent.futures import ThreadPoolExecutor
+
+# Retry-Afterの秒数（秒数またはHTTP-date、RFC 9110）、無いか読めなければdefault
+def retry_after(value, default):
+    if value is None: return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if date.tzinfo is None: date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+# URLのフィクスチャのファイル名 {dirname}/{ホスト}/{パス}（クエリは ? をつけて最後の要素に含める）
+# 要素はパーセントエンコードする 例 https://atcoder.jp/contests/archive?page=2 → {dirname}/atcoder.jp/contests/archive%3Fpage%3D2
+def fixture_path(dirname, url):
+    parts = urlsplit(url)
+    names = [parts.hostname, *(parts.path.strip('/') or 'index').split('/')]
+    if parts.query: names[-1] += f'?{parts.query}'
+    return os.path.join(dirname, *[quote(name, safe='') for name in names])
+
+# トークンバケット
+# rate: 1秒あたりに補充されるトークン数、burst: 貯められる最大トークン数
+class TokenBucket:
+    def __init__(self, rate=1, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    # トークンがあれば1つ使って0を、なければ待たずに、トークンができるまでの秒数を返す
+    def try_acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    # トークンを1つ得るまで待つ
+    def acquire(self):
+        while (wait := self.try_acquire()) > 0:
+            time.sleep(wait)
+
+class Fetcher:
+    RETRY_STATUS = [429, 500, 502, 503, 504]
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.workers = config.get('workers', 1)
+        self.retries = config.get('retries', 0)
+        self.backoff = config.get('backoff', 1)
+        self.timeout = config.get('timeout')
+        self.headers = config.get('headers') or {}
+        self.default = config.get('default') or {'rate': 1, 'burst': 1}
+        self.hosts = config.get('hosts') or {}
+        self.rewrite = config.get('rewrite') or {}
+        self.record = config.get('record')
+        self.buckets = {}
+        # 取得の集計 requests: 送ったリクエスト数、retries: リトライ数、status_{code}: 状態コードごとの数
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(len(self.hosts), 1), pool_maxsize=max(self.workers, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def bucket(self, url):
+        host = urlsplit(url).hostname
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(**self.hosts.get(host, self.default))
+            return self.buckets[host]
+
+    # rewriteにしたがってURLを書き換える（先頭一致）
+    def target(self, url):
+        for prefix, replacement in self.rewrite.items():
+            if url.startswith(prefix): return replacement + url[len(prefix):]
+        return url
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    # 1つのURLを取得する（レート制限、リトライつき）
+    def get(self, url, headers=None):
+        headers = {**self.headers, **(headers or {})}
+        target = self.target(url)
+        for i in range(self.retries + 1):
+            self.bucket(url).acquire()
+            if i > 0: self.count('retries')
+            self.count('requests')
+            try:
+                response = self.session.get(target, headers=headers, timeout=self.timeout)
+                self.count(f'status_{response.status_code}')
+                if response.status_code not in self.__class__.RETRY_STATUS or i == self.retries:
+                    response.raise_for_status()
+                    if self.record is not None and response.status_code == 200: self.save_fixture(url, response)
+                    return response
+                wait = retry_after(response.headers.get('Retry-After'), self.backoff * 2 ** i)
+                logging.warn(f'Got {response.status_code} from {url}, retry after {wait}sec.')
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.count('connection_errors')
+                if i == self.retries: raise
+                wait = self.backoff * 2 ** i
+                logging.warn(f'{e}, retry after {wait}sec.')
+            time.sleep(wait)
+
+    # 取得した本文を、元のURLのフィクスチャとして保存する
+    def save_fixture(self, url, response):
+        filename = fixture_path(self.record, url)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(f'{filename}.{threading.get_native_id()}.tmp', 'wb') as f:
+            f.write(response.content)
+        os.replace(f'{filename}.{threading.get_native_id()}.tmp', filename)
+
+    # 複数のURLを並列に取得する {url: response または例外} を返す
+    def get_many(self, urls, headers=None):
+        def get(url):
+            try:
+                return self.get(url, headers)
+            except Exception as e:
+                return e
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(zip(urls, executor.map(get, urls)))
@@ -0,0 +1,94 @@
+# テーブルの副次インデックス（行番号を返す）
+# - sorted: ソート済の列（epoch_secondなど）は二分探索で範囲を求める
+# - csr: contest_id / user_id / problem_id のような列は、値ごとの行番号の並びとその開始位置(CSR形式)で持つ
+# 保存済テーブルの隣の {filename}.idx/ に版を分けて保存し（storage.write_version を参照）、
+# テーブルファイルの同一性(signature)で有効性を確認する
+# {版}/meta.yaml: 行数、signature、sortedの列名（テーブルの列そのものを参照するので、列名だけを保存する）、csrの列名
+# {版}/{i}.categories.npy, {i}.offsets.npy, {i}.rows.npy: csrのi番目の列
+# 読むときは .npy をメモリマップで開くので、複数のプロセスで物理メモリを共有し、使う部分だけが読まれる
+#
+# lookupの書式は AtCoderDB.filter と同じ（値、リスト、range）
+# 引けない条件（インデックスの無い列、csr列へのrangeなど）はNoneを返すので、呼び出し側で絞り込むこと
+
+import os
+import yaml
+import numpy as np
+import pandas as pd
+import storage
+
+class TableIndex:
+    def __init__(self, nrows, signature=None, sorted_columns=None, csr=None):
+        self.nrows = nrows
+        self.signature = signature
+        self.sorted_columns = sorted_columns or {}   # {column: values} テーブルの列を参照する
+        self.csr = csr or {}                           # {column: (categories, offsets, rows)}
+        self.categories = {}                           # {column: pd.Index(categories)} 検索用
+
+    @classmethod
+    def build(cls, df, sorted_columns=(), csr_columns=(), signature=None):
+        index = cls(len(df), signature)
+        for column in sorted_columns:
+            values = _values(df, column)
+            assert (values[1:] >= values[:-1]).all(), f'{column} is not sorted.'
+            index.sorted_columns[column] = values
+        for column in csr_columns:
+            # カテゴリ型であれば符号をそのまま使う
+            values = pd.Categorical(_values(df, column))
+            codes, categories = values.codes, values.categories
+            rows = np.argsort(codes, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(codes[codes >= 0], minlength=len(categories)))])
+            # 欠損値(code=-1)の行は先頭に集まるので飛ばす
+            rows = rows[(codes < 0).sum():]
+            index.csr[column] = (np.asarray(categories).astype(str), offsets, rows)
+        return index
+
+    # 条件に合う行番号（昇順）を返す、引けない条件ならNone
+    def lookup(self, column, value):
+        if column in self.sorted_columns:
+            values = self.sorted_columns[column]
+            if isinstance(value, range):
+                if len(value) == 0: return np.empty(0, dtype=np.int64)
+                lo, hi = value[0], value[-1]
+                return np.arange(np.searchsorted(values, lo, 'left'), np.searchsorted(values, hi, 'right'))
+            value = value if isinstance(value, list) else [value]
+            return np.unique(np.concatenate([np.arange(np.searchsorted(values, v, 'left'),
+                np.searchsorted(values, v, 'right')) for v in value] + [np.empty(0, dtype=np.int64)]))
+        if column in self.csr and not isinstance(value, range):
+            categories, offsets, rows = self.csr[column]
+            if column not in self.categories: self.categories[column] = pd.Index(categories)
+            value = value if isinstance(value, list) else [value]
+            codes = self.categories[column].get_indexer([str(v) for v in value])
+            parts = [rows[offsets[c]:offsets[c + 1]] for c in codes if c >= 0]
+            return np.sort(np.concatenate(parts + [np.empty(0, dtype=np.int64)]))
+        return None
+
+    def save(self, dirname):
+        def write(path):
+            for i, (categories, offsets, rows) in enumerate(self.csr.values()):
+                np.save(os.path.join(path, f'{i}.categories.npy'), categories)
+                np.save(os.path.join(path, f'{i}.offsets.npy'), offsets)
+                np.save(os.path.join(path, f'{i}.rows.npy'), rows)
+            meta = {'nrows': self.nrows, 'signature': self.signature,
+                    'sorted': list(self.sorted_columns), 'csr': list(self.csr)}
+            with open(os.path.join(path, 'meta.yaml'), 'w') as f:
+                yaml.safe_dump(meta, f, default_flow_style=False)
+        storage.write_version(dirname, write)
+
+    # dfは、インデックスを作ったときと同じテーブル、保存されていなければNone
+    @classmethod
+    def load(cls, dirname, df):
+        path = storage.current_version(dirname)
+        if path is None: return None
+        with open(os.path.join(path, 'meta.yaml')) as f:
+            meta = yaml.safe_load(f)
+        index = cls(meta['nrows'], meta['signature'])
+        for column in meta['sorted']:
+            index.sorted_columns[column] = _values(df, column)
+        for i, column in enumerate(meta['csr']):
+            index.csr[column] = tuple(np.load(os.path.join(path, f'{i}.{name}.npy'), mmap_mode='r')
+                                      for name in ['categories', 'offsets', 'rows'])
+        return index
+
+def _values(df, column):
+    values = df.index if df.index.name == column else df[column]
+    return values.array if isinstance(values.dtype, pd.CategoricalDtype) else values.to_numpy()
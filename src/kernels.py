@@ -0,0 +1,155 @@
+# parseで使う変換のベクトル化版
+# いずれも AtCoderDB の1行ずつの変換（adjust_perf / adjust_diff / fromisoformat / split）と同じ結果を返す
+#
+# np.exp と math.exp は最下位ビットで食い違うことがあるため、切り捨て・丸めの境界のごく近くにある要素だけは
+# スカラー版で計算しなおして、結果を完全に一致させる
+#
+# python kernels.py で、ランダムな入力に対してスカラー版と一致することを確認できる
+
+import math
+import datetime
+import numpy as np
+import pandas as pd
+
+EPS = 1e-9
+
+# 内部perfを外部perfへ変換 int(400 / exp((400 - perf) / 400)) if perf < 400 else perf
+def adjust_perf(perf):
+    perf = np.asarray(perf)
+    res = perf.copy()
+    low = perf < 400
+    x = 400 / np.exp((400 - perf[low]) / 400)
+    y = np.trunc(x)
+    near = np.abs(x - np.round(x)) < EPS
+    y[near] = [int(400 / math.exp((400 - p) / 400)) for p in perf[low][near]]
+    res[low] = y
+    return res
+
+# 内部diffを外部diffへ変換 round(400 / exp((400 - diff) / 400)) if diff < 400 else diff
+def adjust_diff(diff):
+    diff = np.asarray(diff, dtype=np.float64)
+    res = diff.copy()
+    low = diff < 400
+    x = 400 / np.exp((400 - diff[low]) / 400)
+    y = np.round(x)
+    near = np.abs(x - np.floor(x) - 0.5) < EPS
+    y[near] = [round(400 / math.exp((400 - d) / 400)) for d in diff[low][near]]
+    res[low] = y
+    return res
+
+# 東京時間の暦（夏時間が無いので、9時間足して日で割れば日付が決まる）
+# CALENDAR[1960-01-01からの日数] = YYYYMMDD、エポック秒の日数にはDAY0を足す
+JST_OFFSET = 9 * 3600
+def _calendar(start='1960-01-01', end='2100-01-01'):
+    days = np.arange(start, end, dtype='datetime64[D]')
+    months = days.astype('datetime64[M]')
+    year = days.astype('datetime64[Y]').astype(np.int64) + 1970
+    month = months.astype(np.int64) % 12 + 1
+    day = (days - months).astype(np.int64) + 1
+    return (year * 10000 + month * 100 + day).astype(np.int64)
+CALENDAR = _calendar()
+DAY0 = int((np.datetime64('1970-01-01') - np.datetime64('1960-01-01')).astype(np.int64))
+
+# Users.resample のdatetimeの形式
+# 'epoch': エポック秒、'H': YYYYMMDDHH、'D': YYYYMMDD、'W': 週初め(月曜)のYYYYMMDD、'M': YYYYMM、'Y': YYYY
+FLEQS = ['epoch', 'H', 'D', 'W', 'M', 'Y']
+
+# 形式fleqの値を、暦の日数と時(0〜23)に戻す（M / Y は月初・年初、W / D / M / Y は0時）
+def to_days(values, fleq):
+    values = np.asarray(values).astype(np.int64)
+    match fleq:
+        case 'epoch':
+            seconds = values + JST_OFFSET
+            return seconds // 86400 + DAY0, seconds % 86400 // 3600
+        case 'H':
+            ymd, hours = values // 100, values % 100
+        case 'D' | 'W':
+            ymd, hours = values, 0
+        case 'M':
+            ymd, hours = values * 100 + 1, 0
+        case 'Y':
+            ymd, hours = values * 10000 + 101, 0
+        case _:
+            assert False, f'Fleq: {fleq} is not implemented.'
+    return np.searchsorted(CALENDAR, ymd), np.broadcast_to(hours, ymd.shape)
+
+# 日数と時から、形式fleqの値を作る
+def from_days(days, hours, fleq):
+    assert 0 <= days.min(initial=0) and days.max(initial=0) < len(CALENDAR), 'Out of calendar range.'
+    match fleq:
+        case 'H':
+            return CALENDAR[days] * 100 + hours
+        case 'D':
+            return CALENDAR[days]
+        case 'W':
+            return CALENDAR[days - (days - DAY0 + 3) % 7]     # 1970-01-01は木曜
+        case 'M':
+            return CALENDAR[days] // 100
+        case 'Y':
+            return CALENDAR[days] // 10000
+        case _:
+            assert False, f'Fleq: {fleq} is not implemented.'
+
+# 形式fleqの値の始まり（月であれば月初の0時）のエポック秒
+def to_epoch(values, fleq):
+    days, hours = to_days(values, fleq)
+    return (days - DAY0) * 86400 + hours * 3600 - JST_OFFSET
+
+# datetimeを形式fleq_frからfleq_toへ変換する（epochへは戻せない）
+def resample_datetime(values, fleq_fr, fleq_to):
+    if fleq_fr == fleq_to: return np.asarray(values)
+    return from_days(*to_days(values, fleq_fr), fleq_to)
+
+# ISO形式の時刻文字列をエポック秒(float)へ datetime.fromisoformat(s).timestamp()
+# タイムゾーンの無い文字列はローカル時刻として扱われるため、スカラー版で変換する
+def iso_to_epoch(values):
+    values = pd.Series(values)
+    if not values.str.contains(r'(?:Z|[+-]\d\d:?\d\d)$').all():
+        return values.map(lambda x: datetime.datetime.fromisoformat(x).timestamp()).to_numpy()
+    # ナノ秒のままfloatにすると精度が落ちるので、マイクロ秒の整数にしてから割る
+    us = (pd.to_datetime(values, utc=True, format='ISO8601') - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(microseconds=1)
+    return us.to_numpy(dtype=np.int64) / 10 ** 6
+
+# 問題idからコンテストidを得る '_'.join(s.split('_')[:-1])
+def split_problem_id(values):
+    return pd.Series(values).str.rpartition('_')[0].to_numpy()
+
+# ContestScreenName からコンテストidを得る s.split('.')[0]
+def split_contest_id(values):
+    return pd.Series(values).str.partition('.')[0].to_numpy()
+
+# スカラー版との一致を確認する
+def check(n=1000000, seed=0):
+    from lib import AtCoderDB
+    rng = np.random.default_rng(seed)
+    perf = rng.integers(-3000, 4000, n)
+    assert (adjust_perf(perf) == np.array([AtCoderDB.adjust_perf(p) for p in perf])).all()
+    diff = np.concatenate([rng.uniform(-3000, 4000, n), np.arange(-2000, 400, 0.25), [np.nan]])
+    expected = np.array([AtCoderDB.adjust_diff(None, d) for d in diff])
+    assert np.array_equal(adjust_diff(diff), expected, equal_nan=True)
+    epoch = rng.integers(1300000000, 1900000000, 1000)
+    tz = datetime.timezone(datetime.timedelta(hours=9))
+    iso = [datetime.datetime.fromtimestamp(e, tz).isoformat() for e in epoch]
+    assert (iso_to_epoch(iso) == np.array([datetime.datetime.fromisoformat(s).timestamp() for s in iso])).all()
+    ids = ['abc001_a', 'abc_001_b', 'typical90_cl', 'a', '_', 'x_']
+    assert list(split_problem_id(ids)) == ['_'.join(s.split('_')[:-1]) for s in ids]
+    ids = ['abc001.contest.atcoder.jp', 'abc001', '.x']
+    assert list(split_contest_id(ids)) == [s.split('.')[0] for s in ids]
+    epoch = np.concatenate([epoch, [0, 951836399, 951836400, 4102412399]])
+    jst = pd.to_datetime(epoch, unit='s', utc=True).tz_convert('Asia/Tokyo')
+    ymd = jst.year * 10000 + jst.month * 100 + jst.day
+    monday = (jst - pd.to_timedelta(jst.dayofweek, unit='D'))
+    expected = {'H': ymd * 100 + jst.hour, 'D': ymd, 'M': ymd // 100, 'Y': ymd // 10000,
+                'W': monday.year * 10000 + monday.month * 100 + monday.day}
+    for fleq, values in expected.items():
+        assert (resample_datetime(epoch, 'epoch', fleq) == np.asarray(values)).all(), fleq
+    for fleq in ['H', 'D', 'W', 'M', 'Y']:
+        start = to_epoch(expected[fleq], fleq)
+        assert (start <= epoch).all() and (resample_datetime(start, 'epoch', fleq) == expected[fleq]).all(), fleq
+        assert (resample_datetime(start - 1, 'epoch', fleq) != expected[fleq]).all(), fleq
+    for fleq_fr, fleq_to in [('H', 'D'), ('H', 'W'), ('D', 'W'), ('D', 'M'), ('M', 'Y')]:
+        assert (resample_datetime(expected[fleq_fr], fleq_fr, fleq_to) == expected[fleq_to]).all(), (fleq_fr, fleq_to)
+    print('kernels are identical to scalar versions')
+
+if __name__ == '__main__':
+    check()
@@ -11,7 +11,8 @@
 
 import os
 import copy
-import glob
+import importlib.util
+import functools
 import time
 import yaml
 import logging
@@ -19,29 +20,165 @@ import logging.config
 import datetime
 import math
 import numpy as np
+import threading
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from io import StringIO
-
-# 簡易的な実行時間計測のためのデコレータ定義
-# @logging_time として利用する
+from concurrent.futures import ThreadPoolExecutor
+import storage
+import kernels
+import profiling
+from fetcher import Fetcher
+from pagecache import PageCache
+from index import TableIndex
+
+# HTMLパーサー: lxmlがあれば速いほうを使う
+HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') is not None else 'html.parser'
+
+# 実行時間計測のためのデコレータ定義
+# @logging_time として利用する（メソッドでも関数でもよい）
+# ログに加えて、profiling.profilerにspanとして記録する（入れ子の呼び出しは子spanになる）
+# selfがprofile_frame()を持てば、その行数とメモリを入力（と、戻り値が無いかselfのときは出力）として記録する
 def logging_time(func):
+    method = '.' in func.__qualname__ and func.__qualname__.split('.')[-2] != '<locals>'
+    @functools.wraps(func)
     def inner_func(*args, **kwargs):
-        cls = f'{args[0]}'.split()[0].split('.')[1]
-        logging.info(f'Computing {cls}.{func.__name__}{args[1:]} ...')
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        duration = int(time.time() - start_time)
-        logging.info(f'Computed {cls}.{func.__name__}{args[1:]} in {duration}sec.')
+        name = func.__qualname__
+        if method:
+            # 継承先のメソッドとして呼ばれたら、そのクラス名にする（classmethodならargs[0]がクラス）
+            name = f'{(args[0] if isinstance(args[0], type) else type(args[0])).__name__}.{func.__name__}'
+        shown = args[1:] if method else args
+        # DataFrameの引数は、ログでは行数だけにする
+        brief = tuple(f'<{type(arg).__name__} {len(arg)} rows>' if isinstance(arg, (pd.DataFrame, pd.Series)) else arg
+                      for arg in shown)
+        logging.info(f'Computing {name}{brief} ...')
+        frame = None
+        if method and hasattr(args[0], 'profile_frame'):
+            frame = lambda: args[0].profile_frame(*args[1:], **kwargs)
+        inputs = [frame()] if frame is not None else []
+        inputs += [arg for arg in shown if isinstance(arg, (pd.DataFrame, pd.Series))]
+        start_time = time.perf_counter()
+        with profiling.span(name, inputs) as span:
+            result = func(*args, **kwargs)
+            if result is not None and not (method and result is args[0]):
+                span['output'] = result
+            elif frame is not None:
+                span['output'] = frame()
+        duration = time.perf_counter() - start_time
+        logging.info(f'Computed {name}{brief} in {duration:.3f}sec.')
         return result
     return inner_func
 
+# コンテストアーカイブ1ページ分のHTMLをパースする
+# 行ごとにDataFrameを作らず、列ごとにリストへ集めてから1つのDataFrameにする
+def parse_contests_archive(text):
+    bs = BeautifulSoup(text, HTML_PARSER, parse_only=SoupStrainer('tbody')).find('tbody')
+    if bs is None:
+        logging.info('Get no contest.')
+        return pd.DataFrame()
+    columns = ['contest_id', 'start_epoch_second', 'end_epoch_second', 'duration_second', 'title', 'rated', 'type_']
+    data = {column: [] for column in columns}
+    for tr in bs.find_all('tr'):
+        bs_td = tr.find_all('td')
+        start_epoch_second = datetime.datetime.fromisoformat(bs_td[0].find('time').text).timestamp()
+        hours, minutes = map(int, bs_td[2].text.split(':'))
+        duration_second = datetime.timedelta(hours=hours, minutes=minutes).total_seconds()
+        data['contest_id'].append(bs_td[1].find('a')['href'].split('/')[-1])
+        data['start_epoch_second'].append(start_epoch_second)
+        data['end_epoch_second'].append(start_epoch_second + duration_second)
+        data['duration_second'].append(duration_second)
+        data['title'].append(bs_td[1].find('a').text)
+        data['rated'].append(int(bs_td[3].text != '-'))
+        data['type_'].append(bs_td[1].find('span')['title'])
+    if len(data['contest_id']) == 0: return pd.DataFrame()
+    return pd.DataFrame(data, columns=columns).set_index('contest_id')
+
+# 取得中のページを、これまでに見たidの集合で重複排除する
+# time_columnとwindowを指定すると、最新からwindow秒より古いidは集合から捨てるので、集合の大きさは一定に保たれる
+class StreamingDedup:
+    def __init__(self, column, time_column=None, window=None, break_if_duplicated=False):
+        self.column = column
+        self.time_column = time_column
+        self.window = window
+        self.break_if_duplicated = break_if_duplicated
+        self.ids = np.empty(0)
+        self.times = np.empty(0)
+
+    def values(self, df):
+        return (df.index if df.index.name == self.column else df[self.column]).to_numpy()
+
+    # すでに保存済の行を既知のidとして登録する
+    def seed(self, df):
+        if self.time_column is not None and self.window is not None and len(df) > 0:
+            times = df[self.time_column].to_numpy()
+            df = df.iloc[np.searchsorted(times, times[-1] - self.window):]
+        self.add(df)
+
+    def add(self, df):
+        values = self.values(df)
+        self.ids = values if len(self.ids) == 0 else np.concatenate([self.ids, values])
+        if self.time_column is not None:
+            times = df[self.time_column].to_numpy()
+            self.times = times if len(self.times) == 0 else np.concatenate([self.times, times])
+            if self.window is not None and len(self.times) > 0:
+                keep = self.times >= self.times.max() - self.window
+                self.ids, self.times = self.ids[keep], self.times[keep]
+
+    # 未知のidの行だけを返す（ページ内の重複も除く）
+    def __call__(self, df):
+        values = self.values(df)
+        df = df[~(pd.Index(values).isin(self.ids) | pd.Index(values).duplicated())]
+        self.add(df)
+        return df
+
+# 非破壊の遅延クエリー
+# 例 db.query('submissions').where(result='AC').select(['user_id', 'problem_id']).distinct().collect()
+# - where の書式は AtCoderDB.filter と同じ（複数回呼べばand）
+# - collect() するまで何も読まず、AtCoderDBが持つ元のテーブルは変更しない
+# - テーブルが未ロードで保存済ファイルが最新であれば、条件と列を保存形式に渡して必要な部分だけを読む
+class Query:
+    def __init__(self, db, key):
+        self.db = db
+        self.key = key
+        self.predicates = {}
+        self.columns = None
+        self.subset = False
+
+    def _copy(self, **karg):
+        query = copy.copy(self)
+        for name, value in karg.items(): setattr(query, name, value)
+        return query
+
+    def where(self, **karg):
+        predicates = dict(self.predicates)
+        for column, value in karg.items():
+            assert column not in predicates, f'Duplicated condition on {column}.'
+            predicates[column] = value
+        return self._copy(predicates=predicates)
+
+    def select(self, columns):
+        return self._copy(columns=list(columns))
+
+    # subset=None であれば全列で重複排除する
+    def distinct(self, subset=None):
+        return self._copy(subset=subset)
+
+    @logging_time
+    def collect(self):
+        df = self.db.scan(self.key, self.columns, **self.predicates)
+        if self.subset is not False:
+            df = df.drop_duplicates(self.subset)
+        return df
+
 # データベース管理クラス（シングルトン）
 # 遅延loading, fetch（fetchした結果を in/にキャッシュ）, 依存関係自動最適化、ログ出力
 
 class AtCoderDB:
     CONFIG_FILENAME = 'config.yaml'
+    CONTEST_MARGIN = 7 * 86400
+    # 読み取り専用（users.mainのワーカープロセス）: 親プロセスがprepareで用意したファイルと共有列ストアを読むだけで、
+    # fetch / save / export / updatedの書き込みをしない（同じファイルへの並行した書き込みを避ける）
+    READ_ONLY = False
 
     # 初期設定
 
@@ -53,12 +190,31 @@ class AtCoderDB:
     def __init__(self, force_update=False):
         self.load_config_and_updated(force_update)
         logging.config.dictConfig(self.config['logging'])
+        profiling.profiler.configure(self.config.get('profiling'))
         # 初期のDataFrameをセット {key: 空のDataFrame}
         self.__df = {}
         self.__df_saved = {}
+        self.__lock = {}
+        # 副次インデックス（テーブルが保存済ファイルと同じ行である間だけ有効）
+        self.__index = {}
+        self.__index_valid = {}
         for key in self.config['database'].keys():
             self.__df[key] = None
             self.__df_saved[key] = None
+            self.__lock[key] = threading.RLock()
+            self.__index[key] = None
+            self.__index_valid[key] = False
+        self.__lock_updated = threading.Lock()
+        # HTTP取得（並列、ホストごとのレート制限つき）と、先読みしたレスポンス {url: text}
+        self.fetcher = Fetcher(self.config.get('fetcher'))
+        self.__prefetched = {}
+        # 再検証したリソースのパース済DataFrame {cache: DataFrame}
+        self.__parsed = {}
+        # 取得したページのキャッシュ（旧形式の個別ファイルは初回に取り込む）
+        self.pages = PageCache(self.config['page_cache']['filename'])
+        for item in self.config['database'].values():
+            for fetch in [item['fetch'], (item.get('post_processing') or {}).get('fetch') or {}]:
+                if fetch.get('cache') is not None: self.pages.import_files(fetch['cache'])
 
     def load_config_and_updated(self, force_update):
         # コンフィグ読み込み（リードオンリー）
@@ -74,31 +230,93 @@ class AtCoderDB:
             self.updated = copy.deepcopy(self.config['updated']['init'])
 
     def save_updated(self):
+        assert not self.__class__.READ_ONLY, 'Cannot save updated in read-only mode.'
         # 更新状況を書き込み
         updated_filename = self.config['updated']['filename']
-        with open(updated_filename, 'w') as f:
+        with self.__lock_updated, open(updated_filename, 'w') as f:
             yaml.safe_dump(self.updated, f, default_flow_style=False)
         logging.info(f'Saved {updated_filename}')
 
     # データへの基本アクセス
 
     def df(self, key):
-        if self.__df[key] is None: self.load(key)   # 遅延ローディング
+        with self.__lock[key]:
+            if self.__df[key] is None: self.load(key)   # 遅延ローディング
         return self.__df[key]
 
+    # 互いに独立なkeyを並列にloadする（fetchが必要なものは並列にダウンロードされる）
+    # 例 preload(['results', 'problem_models'])
+    def preload(self, keys):
+        with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+            list(executor.map(self.df, keys))
+
+    # 依存関係（config.yamlのdependencies）で参照している他のkey
+    def dependency_keys(self, key):
+        return {item['other_key'] for item in self.config['database'][key]['dependencies']} - {key}
+
+    # keysとそれが依存するkeyを、依存関係の順にloadする（互いに独立なものは並列に）
+    # 副次インデックスと共有列ストアも用意するので、以降は他のプロセスからもloadせずに使える
+    @logging_time
+    def prepare(self, keys):
+        pending = set()
+        def visit(key):
+            pending.add(key)
+            for other in self.dependency_keys(key) - pending: visit(other)
+        for key in keys: visit(key)
+        prepared = sorted(pending)
+        while len(pending) > 0:
+            ready = [key for key in pending if len(self.dependency_keys(key) & pending) == 0]
+            assert len(ready) > 0, f'Found circular dependencies in {pending}.'
+            self.preload(ready)
+            for key in ready: self.get_index(key)
+            pending -= set(ready)
+        # 用意したファイルのシグネチャを記録する（読み取り専用のプロセスはこれと照らして最新かを判断する）
+        for key in prepared:
+            self.updated[key]['prepared_signature'] = storage.signature(self.config['database'][key]['filename'])
+        self.save_updated()
+
+    # 計測用: keyのテーブル（読み込み済のときだけ、profiling.frame_sizeを参照）
+    def profile_frame(self, key='submissions', *args, **karg):
+        return self.__df.get(key) if isinstance(key, str) else None
+
     # データのload / fetch
 
+    @logging_time
     def load(self, key):
+        # 共有列ストアが最新であれば、読み込まずに接続する
+        if self.attach(key): return
+        if self.__class__.READ_ONLY:
+            self.load_prepared(key)
+            return
         self.__df[key] = pd.DataFrame()
-        # 先読みすべきファイルの読み込み
+        # 旧形式(csv)のファイルがあれば新形式に変換しておく
+        self.migrate(key)
+        # 先読みすべきファイルの読み込み（ストアとベースファイルをマージ済の状態になる）
         if 'pre_processing' in self.config['database'][key]: self.load_pre_file(key)
         # dependencyを確認して不整合あればfetchする
         broken = self.broken_dependencies(key)
         filename = self.config['database'][key]['filename']
-        if not broken and os.path.isfile(filename):
-            self.__df[key] = pd.concat([self.__df[key], self.load_file(key, filename)])
-        else:
+        # 前回のフェッチが途中で止まっていれば（fetch_stateあり）、その続きをfetchする
+        if broken or not os.path.isfile(filename) or self.updated[key].get('fetch_state') is not None:
             self.fetch(key, broken)
+        elif len(self.__df[key]) == 0:
+            self.__df[key] = self.load_file(key, filename)
+        # ここでテーブルは保存済ファイルと同じ行になっている
+        self.__index[key] = None
+        self.__index_valid[key] = True
+        # 共有列ストアが古ければ書き出しておく（次のプロセスからは接続できる）
+        item = self.config['database'][key]
+        if item.get('shared') is not None:
+            meta = storage.exported(item['shared'])
+            if meta is None or meta['signature'] != storage.signature(filename): self.export(key)
+
+    # 読み取り専用で、保存済ファイルをそのまま読む（マージやfetchが必要なら、親プロセスで用意されていない）
+    def load_prepared(self, key):
+        filename = self.config['database'][key]['filename']
+        assert os.path.isfile(filename) and self.is_fresh(key), f'{key} is not prepared for read-only access.'
+        self.__df[key] = self.load_file(key, filename)
+        self.__index[key] = None
+        self.__index_valid[key] = True
 
     # 依存関係の確認 正常 → False(0)、破れあり True (1〜2 の2段階)
     def broken_dependencies(self, key):
@@ -110,12 +328,8 @@ class AtCoderDB:
             type_ = item['type']
             if self_ == 'virtual':
                 assert item['self'] == 'contest_ids'
-                filename = self.config['database'][key]['filename']
-                if os.path.isfile(filename):
-                    df = self.load_file(key, filename)
-                    self_ = df.reset_index()['contest_id'].to_list()
-                else:
-                    self_ = []
+                manifest = self.manifest(key)
+                self_ = (manifest['contest_ids'] or []) if manifest is not None else []
             if self_ is not None and other is not None:
                 if 'self_gap' in item: self_ += item['self_gap']
                 if op == 'lt':
@@ -134,46 +348,140 @@ class AtCoderDB:
             if op == 'set_ge': logging.warn(f'- diff: {set(other) - set(self_)}')
         return res
 
+    # 保存済ファイルのマニフェスト（storage.write_manifest を参照）、ファイルが無ければNone
+    # マニフェストが無いか古ければ、ファイルを読み込んで作りなおす（次からは読まずに済む、分割した保存は目録から作る）
+    def manifest(self, key):
+        item = self.config['database'][key]
+        filename = item['filename']
+        if not os.path.isfile(filename): return None
+        manifest = storage.read_manifest(filename, item.get('schema'))
+        if manifest is None:
+            assert not self.__class__.READ_ONLY, f'Manifest of {key} is not prepared for read-only access.'
+            logging.info(f'Building manifest of {key}')
+            df = self.load_file(key, filename) if item.get('partition') is None else None
+            manifest = storage.write_manifest(df, filename, item.get('schema'), item.get('partition'))
+        return manifest
+
+    @logging_time
     def load_file(self, key, filename):
         if self.__df_saved[key] is None:
             logging.info(f'Loading {key} form {filename}')
-            self.__df_saved[key] = pd.read_csv(filename, index_col=0)
+            item = self.config['database'][key]
+            self.__df_saved[key] = storage.read(filename, item.get('storage', 'csv'), item.get('schema'),
+                                                partition=item.get('partition'))
         return self.__df_saved[key]
 
+    # 共有列ストア（config.yaml の shared）に読み取り専用で接続する
+    # 保存済ファイルから書き出したもので、ファイルがそのまま使える状態のときだけ接続してTrueを返す
+    def attach(self, key):
+        item = self.config['database'][key]
+        dirname = item.get('shared')
+        if dirname is None or not os.path.isfile(item['filename']): return False
+        meta = storage.exported(dirname)
+        if meta is None or meta['signature'] != storage.signature(item['filename']) or not self.is_fresh(key): return False
+        logging.info(f'Attaching {key} to {dirname}')
+        self.__df[key] = storage.attach(dirname)
+        self.__index[key] = None
+        self.__index_valid[key] = True
+        return True
+
+    # テーブルを共有列ストアへ書き出す（saveのたびに呼ばれる）
+    def export(self, key):
+        assert not self.__class__.READ_ONLY, f'Cannot export {key} in read-only mode.'
+        item = self.config['database'][key]
+        assert item.get('shared') is not None, f'{key} has no shared column store.'
+        storage.export(self.df(key), item['shared'], item.get('schema'), storage.signature(item['filename']))
+
+    def migrate(self, key):
+        item = self.config['database'][key]
+        storage.migrate(item.get('migrate_from'), item['filename'], item.get('storage', 'csv'), item.get('schema'),
+                        item.get('partition'))
+
     # ベースファイルを読み込む
-    # 現状はsubmissions専用、かつベースファイルの存在が前提
-    # （1GB近くあるため、手動ダウンロードに限定する）
+    # 現状はsubmissions専用
+    # out/のストア（ソート済・重複排除済の全提出）があれば読み込み、ベースファイルが新しくなっていれば
+    # ウォーターマーク（ストアの最終epoch）以降の行だけをidで重複排除してマージする
+    # ストアが無いときはベースファイルが必須（1GB近くあるため、手動ダウンロードに限定する）
+    @logging_time
     def load_pre_file(self, key):
         assert key == 'submissions'
-        pre_cache = self.config['database'][key]['pre_processing']['fetch']['cache']
-        pre_url = self.config['database'][key]['pre_processing']['fetch']['url']
-        assert os.path.isfile(pre_cache), f'Download {pre_url} and set it to {pre_cache} manually.'
-        start_time = time.time()
-        last_epoch = os.path.getatime(pre_cache)
-        if time.time() - last_epoch < 864000:
-            logging.info(f'Wait a minutes loading {key}_base_file from {pre_cache}')
-            self.__df[key] = pd.read_csv(pre_cache, index_col=0)
-            duration = int(time.time() - start_time)
-            logging.info(f'Loaded {key}_base_file in {duration} seconds.')
-            start_time = time.time()
-            logging.info(f'Wait a minutes sorting {key}.')
-            self.__df[key] = self.__df[key].sort_values('epoch_second')
-            duration = int(time.time() - start_time)
-            logging.info(f'Sorted {key} in {duration} seconds.')
-            self.updated[key]['base_file_last_epoch_previous'] = self.updated[key]['base_file_last_epoch']
-            last_epoch = int(self.__df[key].tail(1)['epoch_second'].values[0])
-            logging.info(f'Last epoch of base_file is {datetime.datetime.fromtimestamp(last_epoch)}')
-        if time.time() - last_epoch >= 864000:
+        item = self.config['database'][key]
+        pre_cache = item['pre_processing']['fetch']['cache']
+        pre_url = item['pre_processing']['fetch']['url']
+        filename = item['filename']
+        watermark = self.updated[key].get('watermark')
+        if os.path.isfile(filename):
+            self.__df[key] = self.load_file(key, filename)
+        else:
+            assert os.path.isfile(pre_cache), f'Download {pre_url} and set it to {pre_cache} manually.'
+        if not os.path.isfile(pre_cache):
+            return
+        # 取り込み済のベースファイルであれば何もしない
+        signature = self.pre_file_signature(key)
+        if self.updated[key].get('base_file_signature') == signature and watermark is not None:
+            return
+        if time.time() - os.path.getatime(pre_cache) >= 864000:
+            if watermark is not None:
+                logging.warn('Base file is too old, skipped merging it.')
+                return
             logging.error('Base file is too old, restart this after getting new base file.')
             exit()
-        if self.updated[key]['base_file_last_epoch_previous'] != last_epoch:
-            logging.info(f'Detected new base_file.')
-        self.updated[key]['base_file_last_epoch'] = last_epoch
-        self.save_updated()
+        start_time = time.time()
+        if watermark is None:
+            # 初回: ベースファイル全体を読み込み、旧形式のストア(ベース以降の差分のみ)があればマージする
+            logging.info(f'Wait a minutes loading {key}_base_file from {pre_cache}')
+            stored, self.__df[key] = self.__df[key], self.scan_pre_file(key)
+            if len(stored) > 0:
+                self.__df[key] = self.merge_store(key, stored, int(stored['epoch_second'].min()))
+        else:
+            cutoff = watermark - item['pre_processing'].get('merge_overlap', 0)
+            logging.info(f'Merging {key}_base_file since {datetime.datetime.fromtimestamp(cutoff)} from {pre_cache}')
+            delta = self.scan_pre_file(key, epoch_second=range(cutoff, 2 ** 62))
+            if len(delta) > 0:
+                self.updated[key]['base_file_last_epoch'] = int(delta['epoch_second'].values[-1])
+            self.__df[key] = self.merge_store(key, delta, cutoff)
+        since = cutoff if watermark is not None else None   # マージで変わるのはcutoff以降だけ
+        duration = int(time.time() - start_time)
+        logging.info(f'Merged {key}_base_file in {duration} seconds.')
+        if watermark is None:
+            self.updated[key]['base_file_last_epoch'] = int(self.__df[key]['epoch_second'].values[-1])
+        logging.info(f'Detected new base_file, last epoch is '
+                     f'{datetime.datetime.fromtimestamp(self.updated[key]["base_file_last_epoch"])}')
+        self.updated[key]['base_file_signature'] = signature
+        self.save(key, since)
+
+    # ベースファイルの同一性（大きさと更新時刻）、ファイルが無ければNone
+    def pre_file_signature(self, key):
+        return storage.signature(self.config['database'][key]['pre_processing']['fetch']['cache'])
+
+    # epoch_second順のストアに、epoch_second順の差分をマージする
+    # cutoffより前のストアには触れないので、計算量は差分の大きさに比例する
+    # idが重複した場合は差分の側を採用する
+    @logging_time
+    def merge_store(self, key, delta, cutoff):
+        df = self.__df[key]
+        pos = int(np.searchsorted(df['epoch_second'].to_numpy(), cutoff, side='left')) if len(df) > 0 else 0
+        tail = storage.merge_sorted([df.iloc[pos:], delta], 'epoch_second')
+        tail = tail[~tail.index.duplicated(keep='last')]
+        logging.info(f'Merged {len(tail) - (len(df) - pos)} new rows into {key}')
+        return storage.concat([df.iloc[:pos], tail])
+
+    # ベースファイルをチャンク単位でストリーミングして読み、epoch_second順にソート済で返す
+    # 列の射影と行の絞り込みは読み込み中に行う（filterと同じ書式）
+    # 例 scan_pre_file('submissions', columns=['user_id', 'problem_id'], result='AC', epoch_second=range(s, t))
+    @logging_time
+    def scan_pre_file(self, key, columns=None, **karg):
+        assert key == 'submissions'
+        item = self.config['database'][key]
+        pre_cache = item['pre_processing']['fetch']['cache']
+        chunksize = item['pre_processing'].get('chunksize', 1000000)
+        return storage.scan_csv(pre_cache, 'epoch_second', chunksize, columns, item.get('schema'), karg)
 
     # type_=1: 現在のout/をもとに追加をfetchしてout/を新規作成または上書きする
     # type_=2: baseは維持するが、現在のout/とin/キャッシュを破棄して、最初からfetchしなおす
+    @logging_time
     def fetch(self, key, type_=1):
+        assert not self.__class__.READ_ONLY, f'Cannot fetch {key} in read-only mode.'
         filename = self.config['database'][key]['filename']
         cache = self.config['database'][key]['fetch']['cache']
         # type_=2の処理をまずはやっておく
@@ -181,11 +489,11 @@ class AtCoderDB:
             assert key == 'submissions' or key == 'problem_models'
             logging.info(f'Removing files for {key}')
             if os.path.isfile(filename): os.remove(filename)
-            if cache is not None:
-                for f in glob.glob(cache.replace('{}', '*')):
-                    os.remove(f)
+            # 再検証できるキャッシュ(revalidate)は残し、条件付きGETで更新を確認する
+            if cache is not None and not self.config['database'][key]['fetch'].get('revalidate'):
+                self.pages.delete(cache)
         # 以降は共通処理
-        # baseファイルで読み込み済な位置を記録しておく
+        # ストアとして読み込み済な位置を記録しておく
         pre_file_len = len(self.__df[key])
         df_list = []
         if pre_file_len > 0:
@@ -193,89 +501,201 @@ class AtCoderDB:
             assert key == 'submissions'
             df_list.append(self.__df[key].tail(1000))
             self.__df[key] = self.__df[key].head(pre_file_len - len(df_list[-1]))
-        # ファイルが存在していれば、まず読み込む
-        if os.path.isfile(filename):
+        # ファイルが存在していれば、まず読み込む（ストアとして読み込み済であれば不要）
+        elif os.path.isfile(filename):
             df = self.load_file(key, filename)
             if len(df) > 0: df_list.append(df)
         # 読み込んだ部分からの追加をフェッチする
+        # 重複処理は、既知のidの集合に対する一括の所属判定で、ページごとに行う
         uniqueness = self.config['database'][key].get('uniqueness')
-        state = self.get_value_state(key, df_list)
-        while state is not None:
-            value, state = self.get_next_value(key, state)
-            df = self.get_cached_url(key, value)
-            if len(df) == 0:
-                break
-            if uniqueness is not None and len(df_list) > 0:   # 重複処理
-                name = df.index.name
-                df_unique = pd.concat([df_list[-1], df]).reset_index().drop_duplicates(
-                    uniqueness['column']).iloc[len(df_list[-1]):].set_index(name)
-                df_list.append(df_unique)
-                if len(df_unique) == 0 or (len(df_unique) < len(df) and uniqueness['break_if_duplicated']):
+        dedup = StreamingDedup(**uniqueness) if uniqueness is not None else None
+        if dedup is not None:
+            for df in df_list: dedup.seed(df)
+        # 前回のフェッチが途中で止まっていれば、記録した状態から再開する
+        resumed = self.updated[key].get('fetch_state')
+        if type_ == 2: resumed = None
+        if resumed is not None: logging.info(f'Resuming fetching {key} from {self.short(resumed)}')
+        state = resumed if resumed is not None else self.get_value_state(key, df_list)
+        # checkpoint秒ごとに、取得した分をテーブルに追加してセーブし、状態をupdatedに記録する
+        checkpoint = self.config['database'][key]['fetch'].get('checkpoint')
+        checkpoint_time = time.time()
+        recently = list(self.updated[key].get('recently_contest_ids') or []) if resumed is not None else []
+        pages = 0   # 前回のセーブから取得したページ数
+        try:
+            while state is not None:
+                self.prefetch(key, self.get_upcoming_values(key, state))
+                value, next_state = self.get_next_value(key, state)
+                df = self.get_cached_url(key, value)
+                if len(df) == 0:
                     break
-            else:
-                df_list.append(df)
-        # 後処理
-        if 'post_processing' in self.config['database'][key]:
+                if dedup is not None:   # 重複処理
+                    df_unique = dedup(df)
+                    if len(df_unique) > 0: df_list.append(df_unique)
+                    if len(df_unique) == 0 or (len(df_unique) < len(df) and dedup.break_if_duplicated):
+                        break
+                else:
+                    df_list.append(df)
+                state = self.get_state_after(key, next_state, df_list[-1])
+                pages += 1
+                if checkpoint is not None and time.time() - checkpoint_time >= checkpoint and state is not None:
+                    pages = 0
+                    self.commit_fetched(key, df_list, state, recently)
+                    checkpoint_time = time.time()
+        except Exception:
+            # 取得できたページまでを保存して、次回はその続きから再開する
+            # （KeyboardInterruptなどはそのまま止め、次回は最後のチェックポイントから再開する）
+            if checkpoint is not None and state is not None and pages > 0:
+                logging.error(f'Fetching {key} was interrupted, saving the progress to resume from {self.short(state)}')
+                self.commit_fetched(key, df_list, state, recently)
+            raise
+        # 後処理（コンテスト一覧の追加）
+        if key == 'contests':
             item = self.config['database'][key]['post_processing']
+            df_list.append(self.get_cached_url(key, cache=item['fetch']['cache'], url=item['fetch']['url'],
+                                               post_processing=True))
+        # 残りをテーブルに追加してセーブする（完了したので状態は消す）
+        self.commit_fetched(key, df_list, None, recently)
+
+    # フェッチした分(df_list)をテーブルに追加して後処理し、次に取得する状態stateとともにセーブする
+    # df_listは空にする（チェックポイントごとに呼ばれ、取得したページをすべて持ち続けないようにする）
+    # recentlyはsubmissionsの後処理用、このフェッチで取得した提出のコンテストid（チェックポイントをまたいで貯める）
+    def commit_fetched(self, key, df_list, state, recently):
+        # 分割した保存では、追加した行を含むパーティションだけを書きなおす（追加が無ければ書きなおさない）
+        partition = self.config['database'][key].get('partition')
+        since = None
+        if partition is not None:
+            since = min((int(df[partition['column']].min()) for df in df_list if len(df) > 0), default=2 ** 62)
+        if 'post_processing' in self.config['database'][key] and len(df_list) > 0:
             if key == 'submissions':
-                recently_contest_ids = pd.concat(df_list)['contest_id'].drop_duplicates().to_list()
-                recently_contest_ids = [i for i in recently_contest_ids if 'adt_' not in i]
-                self.updated[key]['recently_contest_ids'] = recently_contest_ids
-            elif key == 'contests':
-                df = self.get_cached_url(key, cache=item['fetch']['cache'], url=item['fetch']['url'],
-                                         post_processing=True)
-                df_list.append(df)
-                assert uniqueness is not None
-                # 読み込んだ分をすべてつなげて後処理との重複を確認する
-                df_list = [pd.concat(df_list).reset_index().drop_duplicates(uniqueness['column']).set_index('contest_id')]
-            elif key == 'results':
-                # ソートする
-                df_list = [pd.concat(df_list).reset_index(drop=True).sort_values('end_epoch_second')]
-            else:
-                assert False
-        # フェッチした結果を全てつなげる
-        self.__df[key] = pd.concat([self.__df[key], *df_list])
-        # セーブする
-        self.save(key, pre_file_len)
+                contest_ids = pd.concat([df['contest_id'] for df in df_list]).drop_duplicates().to_list()
+                recently[:] = list(dict.fromkeys(recently + [i for i in contest_ids if 'adt_' not in i]))
+                self.updated[key]['recently_contest_ids'] = list(recently)
+        # フェッチした結果をつなげる（カテゴリ列は型を保ったまま）
+        df = storage.concat([self.__df[key], *df_list])
+        df_list.clear()
+        if key == 'contests':
+            # 保存済の分とも合わせて重複を確認する（アーカイブとコンテスト一覧で重なる）
+            column = self.config['database'][key]['uniqueness']['column']
+            df = df.reset_index().drop_duplicates(column).set_index('contest_id')
+        elif key == 'results':
+            # ソートする
+            df = df.reset_index(drop=True).sort_values('end_epoch_second')
+        self.__df[key] = df
+        self.updated[key]['fetch_state'] = state
+        # セーブする（途中のチェックポイントでは、マニフェストと共有列ストアは書かない）
+        self.save(key, since, checkpoint=state is not None)
+
+    # ログ表示用に状態を短縮する（リストの場合は先頭と要素数だけにする）
+    def short(self, state):
+        return f'{state[0]}.. (list#{len(state)})' if isinstance(state, list) else state
 
     # configにしたがってキャッシュから読み込み、キャッシュが無ければurlを読み込んでキャッシュする
+    # キャッシュは (テンプレート, 値) をキーにしてページキャッシュに保存する
     # パースしたデータフレームを返す
     def get_cached_url(self, key, value=None, cache=None, url=None, post_processing=False):
+        page = ''
         if cache is None:
             cache = self.config['database'][key]['fetch']['cache']
-            if cache is not None: cache = cache.replace('{}', str(value))
+            page = str(value) if cache is not None and '{}' in cache else ''
         if url is None:
             url = self.config['database'][key]['fetch']['url'].replace('{}', str(value))
-        if cache is not None and os.path.isfile(cache):
-            logging.info(f'Loading {cache}')
-            with open(cache) as f:
-                text = f.read()
+        revalidate = self.config['database'][key]['post_processing' if post_processing else 'fetch'].get('revalidate')
+        text = self.pages.get(cache, page) if cache is not None and not revalidate else None
+        if revalidate and cache is not None:
+            df = self.get_revalidated_url(key, cache, url, post_processing)
+        elif text is not None:
+            logging.info(f'Loading {cache.replace("{}", page)}')
             df = self.parse(key, text, post_processing)
         else:
-            logging.info(f'Getting {url}')
             try:
-                header = { 'accept-language': 'ja-JP' }
-                response = requests.get(url, headers=header)
-                response.raise_for_status()
-                response.encoding = response.apparent_encoding
-                text = response.text
+                text = self.__prefetched.pop(url, None)
+                if text is None:
+                    logging.info(f'Getting {url}')
+                    text = self.get_text(url)
                 df = self.parse(key, text, post_processing)
                 if cache is not None and len(df) > 0:
-                    with open(cache, 'w') as f:
-                        f.write(text)
-                        logging.info(f'Saved as {cache}')
-                        # fetch時刻をupdatedに登録
-                        if 'fetch_epoch_second' in self.updated[key]:
-                            self.updated[key]['fetch_epoch_second'] = time.time()
+                    self.pages.put(cache, page, text)
+                    logging.info(f'Saved as {cache.replace("{}", page)}')
+                    # fetch時刻をupdatedに登録
+                    if 'fetch_epoch_second' in self.updated[key]:
+                        self.updated[key]['fetch_epoch_second'] = time.time()
             except Exception as e:
                 logging.error(e)
                 assert False
-            time.sleep(1)
         return df
 
+    def get_text(self, url):
+        response = self.fetcher.get(url)
+        response.encoding = response.apparent_encoding
+        return response.text
+
+    # 大きな静的リソース向け: 本文とともにETag/Last-Modifiedを保存しておき、条件付きGETで再検証する
+    # 304であれば、パース済のDataFrame（メモリ上、なければ {cache}.npz）をそのまま使う
+    def get_revalidated_url(self, key, cache, url, post_processing=False):
+        parsed_filename = f'{cache}.npz'
+        meta = self.pages.meta(cache)
+        headers = {}
+        if meta.get('etag') is not None: headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified') is not None: headers['If-Modified-Since'] = meta['last_modified']
+        logging.info(f'Revalidating {url}')
+        try:
+            response = self.fetcher.get(url, headers)
+        except Exception as e:
+            logging.error(e)
+            assert False
+        if response.status_code == 304:
+            logging.info(f'Not modified, reusing {cache}')
+            if cache in self.__parsed: return self.__parsed[cache]
+            if os.path.isfile(parsed_filename):
+                df = storage.read(parsed_filename, 'npz')
+            else:
+                df = self.parse(key, self.pages.get(cache), post_processing)
+        else:
+            response.encoding = response.apparent_encoding
+            df = self.parse(key, response.text, post_processing)
+            if len(df) > 0:
+                self.pages.put(cache, '', response.text,
+                               response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                storage.write(df, parsed_filename, 'npz')
+                logging.info(f'Saved as {cache}')
+        df = self.normalize_parsed(key, df)
+        self.__parsed[cache] = df
+        return df
+
+    # パース直後とnpzから読んだものとで型を揃える（テーブルのスキーマにしたがう）
+    # npzは文字列列をカテゴリ型で返すので、スキーマでcategoryでない列は文字列に戻す
+    def normalize_parsed(self, key, df):
+        schema = self.config['database'][key].get('schema') or {}
+        columns = {column: df[column].astype(df[column].cat.categories.dtype) for column in df.columns
+                   if isinstance(df[column].dtype, pd.CategoricalDtype) and schema.get(column) != 'category'}
+        if len(columns) > 0: df = df.assign(**columns)
+        if df.index.dtype == object and len(df) > 0 and isinstance(df.index[0], str):
+            df.index = df.index.astype(str)
+        return storage.apply_schema(df, schema)
+
+    # キャッシュの無い値のurlをまとめて並列に取得しておく（パースとキャッシュ保存はget_cached_urlで行う）
+    def prefetch(self, key, values):
+        cache = self.config['database'][key]['fetch']['cache']
+        url = self.config['database'][key]['fetch']['url']
+        # キャッシュ済のページはまとめて読み出しておく
+        if cache is not None: self.pages.preload(cache, values)
+        # 直後の値が取得済であれば、前回のまとめ取得の途中なので何もしない
+        if len(values) == 0 or url.replace('{}', str(values[0])) in self.__prefetched: return
+        urls = [url.replace('{}', str(value)) for value in values
+                if cache is None or not self.pages.has(cache, value)]
+        urls = [u for u in urls if u not in self.__prefetched]
+        if len(urls) <= 1: return
+        logging.info(f'Getting {len(urls)} urls for {key} in parallel')
+        for u, response in self.fetcher.get_many(urls).items():
+            if isinstance(response, Exception):
+                logging.warn(f'Failed to prefetch {u}: {response}')
+                continue
+            response.encoding = response.apparent_encoding
+            self.__prefetched[u] = response.text
+
     def get_value_state(self, key, df_list):
         if key == 'submissions':
-            return df_list
+            return int(df_list[-1]['epoch_second'].values[-1])
         elif key == 'contests':
             return 1
         elif key == 'results':
@@ -290,10 +710,20 @@ class AtCoderDB:
         else:
             assert False
 
+    # 先の値がわかっていれば、並列取得のためにそれらを返す
+    def get_upcoming_values(self, key, state):
+        if key == 'results':
+            return state[:self.fetcher.workers * 4]
+        elif key == 'contests' and (not os.path.isfile(self.config['database'][key]['filename'])
+                                    or self.updated[key].get('fetch_state') is not None):
+            # 全履歴を作り直すとき（その再開を含む）は、先のページもまとめて取得する
+            return list(range(state, state + self.fetcher.workers))
+        else:
+            return []
+
     def get_next_value(self, key, state):
         if key == 'submissions':
-            value = int(state[-1].tail(1)['epoch_second'].values[0])
-            return value, state
+            return state, state
         elif key == 'contests':
             return state, state + 1
         elif key == 'results':
@@ -304,6 +734,12 @@ class AtCoderDB:
         else:
             assert False
 
+    # 1ページを取得した後の状態（submissionsは取得した最後の提出の時刻から続ける）
+    def get_state_after(self, key, state, df):
+        if key == 'submissions':
+            return int(df['epoch_second'].values[-1])
+        return state
+
     # 得られたテキストをパースしてDataFrameにする
     def parse(self, key, text, post_processing=False):
         if key == 'submissions':
@@ -317,28 +753,7 @@ class AtCoderDB:
                 return pd.DataFrame()
             return df
         elif key == 'contests' and not post_processing:
-            bs = BeautifulSoup(text, 'html.parser').find('tbody')
-            df = pd.DataFrame()
-            if bs is None:
-                logging.info(f'Get no contest.')
-                return pd.DataFrame()
-            while True:
-                bs = bs.find_next('tr')
-                if bs is None: break
-                bs_td = bs.find_all('td')
-                start_epoch_second = datetime.datetime.fromisoformat(bs_td[0].find('time').text).timestamp()
-                type_ = bs_td[1].find('span')['title']
-                contest_id = bs_td[1].find('a')['href'].split('/')[-1]
-                title = bs_td[1].find('a').text
-                hours, minutes = map(int, bs_td[2].text.split(':'))
-                duration_second = datetime.timedelta(hours=hours, minutes=minutes).total_seconds()
-                end_epoch_second = start_epoch_second + duration_second
-                rated = int(bs_td[3].text != '-')
-                df_add = pd.DataFrame([[contest_id, start_epoch_second, end_epoch_second, duration_second, title, rated, type_]],
-                    columns=['contest_id', 'start_epoch_second', 'end_epoch_second',
-                             'duration_second', 'title', 'rated', 'type_']).set_index('contest_id')
-                df = pd.concat([df, df_add])
-            return df
+            return parse_contests_archive(text)
         elif key == 'contests' and post_processing:
             df = pd.read_json(StringIO(text)).rename(columns={'id': 'contest_id', 'rate_change': 'rated'})
             df['rated'] = (df['rated'] != '-').astype(int)
@@ -353,17 +768,17 @@ class AtCoderDB:
                 'Place', 'OldRating', 'NewRating', 'Performance', 'IsRated']]
             df.columns = ['contest_id', 'end_epoch_second', 'user_id', 'country', 'affiliation',
                 'place', 'old_rate', 'new_rate', 'perf', 'user_rated']
-            df['contest_id'] = df['contest_id'].str.split('.', expand=True)[0]
-            df['end_epoch_second'] = df['end_epoch_second'].apply(lambda x: datetime.datetime.fromisoformat(x).timestamp())
+            df['contest_id'] = kernels.split_contest_id(df['contest_id'])
+            df['end_epoch_second'] = kernels.iso_to_epoch(df['end_epoch_second'])
             df['user_rated'] = df['user_rated'].astype(int)
-            df['perf'] = df['perf'].apply(self.__class__.adjust_perf)   # 内部perfを外部perfへ変換
+            df['perf'] = kernels.adjust_perf(df['perf'])   # 内部perfを外部perfへ変換
             df.loc[df['user_rated'] == 0, 'perf'] = 0    # ratedでなければperf=0に（上と２段階に分けるのが速い）
             return df
         elif key == 'problem_models':
             df_raw = pd.read_json(StringIO(text)).T
             df_raw.index.name = 'problem_id'
-            df_raw['contest_id'] = df_raw.index.map(lambda s: '_'.join(s.split('_')[:-1]))
-            diff = df_raw['difficulty'].agg(self.adjust_diff)
+            df_raw['contest_id'] = kernels.split_problem_id(df_raw.index)
+            diff = pd.Series(kernels.adjust_diff(df_raw['difficulty'].to_numpy(dtype=float)), index=df_raw.index)
             diff.name = 'diff'
             tee = (df_raw['slope'] * 4000 + df_raw['intercept']).agg(np.exp)
             tee.name = 'tee'
@@ -372,20 +787,33 @@ class AtCoderDB:
         else:
             assert False
 
-    # 内部perfを外部perfへ変換
+    # 内部perfを外部perfへ変換（1行ずつの基準実装、parseでは kernels.adjust_perf を使う）
     def adjust_perf(perf):
         return int(400 / math.exp((400 - perf) / 400)) if perf < 400 else perf
 
-    # 内部diffを外部diffへ変換
+    # 内部diffを外部diffへ変換（1行ずつの基準実装、parseでは kernels.adjust_diff を使う）
     def adjust_diff(self, diff):
         return round(400 / math.exp((400 - diff) / 400)) if diff < 400 else diff
 
     # ファイルおよびupdate状態をセーブ
-    def save(self, key, pre_file_len=0):
+    # 分割した保存では、since（時刻）より前の行が変わっていなければ、そのパーティションは書きなおさない
+    # checkpoint=True: フェッチ途中のセーブで、テーブルとupdatedだけを書く（マニフェストと共有列ストアは完了時に書く、
+    # それまではis_freshがFalseなので使われない）
+    @logging_time
+    def save(self, key, since=None, checkpoint=False):
+        assert not self.__class__.READ_ONLY, f'Cannot save {key} in read-only mode.'
         # ファイルをセーブ
-        filename = self.config['database'][key]['filename']
-        self.__df[key].iloc[pre_file_len:].to_csv(filename)
+        item = self.config['database'][key]
+        filename = item['filename']
+        storage.write(self.__df[key], filename, item.get('storage', 'csv'), item.get('schema'), item.get('partition'), since)
+        if not checkpoint: storage.write_manifest(self.__df[key], filename, item.get('schema'), item.get('partition'))
         logging.info(f'Saved {key} to {filename}')
+        self.__index[key] = None
+        self.__index_valid[key] = True
+        if item.get('shared') is not None and not checkpoint: self.export(key)
+        # ウォーターマーク（保存済の最終時刻）を記録
+        if item.get('watermark') is not None and len(self.__df[key]) > 0:
+            self.updated[key]['watermark'] = int(self.__df[key][item['watermark']].max())
         # update状態を更新してセーブ
         if 'recently_rated_contest_ids' in self.updated[key]:
             assert key == 'contests'
@@ -404,34 +832,41 @@ class AtCoderDB:
     @logging_time
     def transfer_languages_in_submissions(self):
         key = 'submissions'
-        self.__df[key]['language'] = self.df(key)['language']\
-            .str.extract('^([A-Za-z\+\#]+)', expand=True).replace('PyPy', 'Python')
+        self.__df[key] = self.transfer_languages(self.df(key))
+
+    # languageを変換集約したDataFrameを返す（元のDataFrameは変更しない）
+    def transfer_languages(self, df):
+        language = df['language'].str.extract(r'^([A-Za-z\+\#]+)', expand=False).replace('PyPy', 'Python')
+        return df.assign(language=language)
 
     # ratedか/heuristicかどうかを表すフラグを追加する
     @logging_time
     def add_rated_and_type(self, key):
-        if 'rated' in self.df(key).index or 'type_' in self.df(key).index:
+        if 'rated' in self.df(key).columns or 'type_' in self.df(key).columns:
             logging.info(f'Abort, already added rated and type in {key}.')
             return
-        contests = self.df('contests')
-        append = contests.loc[self.df(key)['contest_id'], ['rated', 'type_']]
-        append.index = self.df(key).index
-        self.__df[key] = pd.concat([self.df(key), append], axis=1)
+        self.__df[key] = self.add_rated_and_type_to(self.df(key))
+
+    # contest_idを持つDataFrameにrated/type_を追加して返す（元のDataFrameは変更しない）
+    def add_rated_and_type_to(self, df):
+        append = self.df('contests').loc[df['contest_id'], ['rated', 'type_']]
+        append.index = df.index
+        return pd.concat([df, append], axis=1)
 
     # diff/teeを追加する
     @logging_time
     def add_diff_and_tee_in_submissions(self):
         key = 'submissions'
-        if 'diff' in self.df(key).index or 'tee' in self.df(key).index:
+        if 'diff' in self.df(key).columns or 'tee' in self.df(key).columns:
             logging.info(f'Abort, already added diff and tee in {key}.')
             return
-        problems_models = self.df('problem_models')[['diff', 'tee']]
-        key_problem_id = pd.DataFrame(self.df(key)['problem_id'])
-        problems_models = pd.concat([problems_models.reset_index(), key_problem_id.drop_duplicates()]
-                                    ).drop_duplicates('problem_id').set_index('problem_id')
-        append = problems_models.loc[key_problem_id['problem_id'], ['diff', 'tee']]
-        append.index = self.df(key).index
-        self.__df[key] = pd.concat([self.df(key), append], axis=1)
+        self.__df[key] = self.add_diff_and_tee(self.df(key))
+
+    # problem_idを持つDataFrameにdiff/teeを追加して返す（problem_modelsに無い問題はNaN）
+    def add_diff_and_tee(self, df):
+        append = self.df('problem_models')[['diff', 'tee']].reindex(df['problem_id'].to_numpy())
+        append.index = df.index
+        return pd.concat([df, append], axis=1)
 
     # 汎用関数
 
@@ -439,31 +874,113 @@ class AtCoderDB:
     # - リストを指定したら要素のorで抽出
     # - rangeを指定したら範囲クエリー
     # 例 filter(key, column1=x, column2=[y, z], column3=range(s, t))
+    # 未ロードで保存済ファイルが最新であれば、条件に合う部分だけを読む（scanを参照）
     @logging_time
     def filter(self, key, **karg):
-        df = self.df(key)
-        for column, value in karg.items():
-            if column in self.df(key).columns:
-                if isinstance(value, range):
-                    df = df[(df[column] >= value[0]) * (df[column] <= value[-1])]
-                elif isinstance(value, list):
-                    df = df[df[column].isin(value)]
-                else:
-                    df = df[df[column] == value]
-            elif self.df(key).index.name == column:
-                if isinstance(value, range):
-                    df = df[(df.index >= value[0]) * (df.index <= value[-1])]
-                elif isinstance(value, list):
-                    df = df[df.index.isin(value)]
-                else:
-                    df = df[df.index == value]
+        df = self.scan(key, **karg)
         self.__df[key] = df
+        self.__index_valid[key] = False
         return self
 
+    # 条件(filterの書式)に合う行を取り出す
+    # dfがテーブルそのもので副次インデックスが有効であれば、インデックスを引いてから残りの条件で絞る
+    def select_rows(self, key, df, karg):
+        # インデックスのある列で絞るときだけ、インデックスを用意する
+        indexed = self.config['database'][key].get('index') or {}
+        columns = {*indexed.get('sorted', []), *indexed.get('csr', [])}
+        index = self.get_index(key) if df is self.__df[key] and len(columns & set(karg)) > 0 else None
+        positions, used = None, set()
+        for column, value in karg.items():
+            rows = index.lookup(column, value) if index is not None else None
+            if rows is None: continue
+            positions = rows if positions is None else np.intersect1d(positions, rows, assume_unique=True)
+            used.add(column)
+        if positions is not None:
+            df = df.iloc[positions]
+        for column, value in karg.items():
+            if column in used: continue
+            if column in df.columns:
+                df = df[storage.condition(df[column], value)]
+            elif df.index.name == column:
+                df = df[storage.condition(df.index, value)]
+        return df
+
+    # 副次インデックスを返す（config.yamlのindexで指定したkeyのみ）
+    # 保存済のインデックスがテーブルファイルと一致すれば読み込み、なければ作って保存する（読み取り専用では保存しない）
+    def get_index(self, key):
+        item = self.config['database'][key]
+        if item.get('index') is None or not self.__index_valid[key]: return None
+        if self.__index[key] is None:
+            filename = item['filename']
+            index_dirname = f'{filename}.idx'
+            signature = storage.signature(filename)
+            df = self.__df[key]
+            index = TableIndex.load(index_dirname, df)
+            if index is not None and index.signature == signature and index.nrows == len(df):
+                self.__index[key] = index
+            if self.__index[key] is None:
+                logging.info(f'Building index of {key}')
+                index = TableIndex.build(df, item['index'].get('sorted', []), item['index'].get('csr', []), signature)
+                if not self.__class__.READ_ONLY:
+                    index.save(index_dirname)
+                    # 旧形式(npz)のインデックスは使わないので消す
+                    if os.path.isfile(f'{filename}.idx.npz'): os.remove(f'{filename}.idx.npz')
+                self.__index[key] = index
+        return self.__index[key]
+
+    # 非破壊の遅延クエリーを作る（Queryを参照）
+    def query(self, key):
+        return Query(self, key)
+
+    # テーブルから、条件(filterの書式)に合う行と指定の列だけを取り出す（元のテーブルは変更しない）
+    # 未ロードで保存済ファイルが最新であれば、ファイルから必要な部分だけを読む
+    # 分割した保存では、時刻の範囲とcontest_idのコンテスト開始時刻に重なるパーティションだけを開く
+    def scan(self, key, columns=None, **karg):
+        item = self.config['database'][key]
+        filename = item['filename']
+        # 共有列ストアがあれば接続して絞る（読み込まない）
+        if self.__df[key] is None and os.path.isfile(filename) and self.is_fresh(key) and not self.attach(key):
+            logging.info(f'Scanning {key} from {filename}')
+            return storage.read(filename, item.get('storage', 'csv'), item.get('schema'), columns, karg,
+                                item.get('partition'), self.partition_bounds(key, karg))
+        df = self.select_rows(key, self.df(key), karg)
+        if columns is not None:
+            df = df[[c for c in columns if c in df.columns]]
+        return df
+
+    # 分割した保存で、読むパーティションを絞る範囲 {時刻の列: range}（行は絞らない）
+    # contest_idの条件があれば、contestsにあるコンテストの開始時刻（の最小）より前のパーティションは読まない
+    # （コンテスト後の提出はあるので上限はつけない、writer/testerの事前の提出に備えてCONTEST_MARGINだけ余裕をとる）
+    def partition_bounds(self, key, karg):
+        partition = self.config['database'][key].get('partition')
+        if partition is None or 'contest_id' not in karg: return None
+        contest_ids = karg['contest_id'] if isinstance(karg['contest_id'], list) else [karg['contest_id']]
+        if len(contest_ids) == 0: return None
+        starts = self.scan('contests', ['start_epoch_second'], contest_id=contest_ids)['start_epoch_second']
+        if len(starts) < len(set(contest_ids)): return None
+        return {partition['column']: range(int(starts.min()) - self.__class__.CONTEST_MARGIN, 2 ** 62)}
+
+    # 保存済ファイルをそのまま使える状態か（ベースファイルのマージや、依存関係によるfetchが不要か）
+    # 読み取り専用では、親プロセスがprepareで記録したシグネチャと保存済ファイルが一致すれば最新とみなす
+    # （依存関係は時刻にもよるので確かめ直さない、fetchしても直らなかった破れは親プロセスと同じくそのまま使う）
+    def is_fresh(self, key):
+        item = self.config['database'][key]
+        if self.__class__.READ_ONLY:
+            signature = storage.signature(item['filename'])
+            return signature is not None and self.updated[key].get('prepared_signature') == signature
+        if 'pre_processing' in item:
+            signature = self.pre_file_signature(key)
+            if signature is not None and self.updated[key].get('base_file_signature') != signature:
+                return False
+        # 途中で止まったフェッチがあれば、続きをfetchするまでは最新ではない
+        if self.updated[key].get('fetch_state') is not None: return False
+        return not self.broken_dependencies(key)
+
     # DataFrameの重複排除
     @logging_time
     def drop_duplicates(self, key, arg):
         self.__df[key] = self.df(key).drop_duplicates(arg)
+        self.__index_valid[key] = False
         return self
 
 # 使わないAPI
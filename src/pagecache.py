@@ -0,0 +1,84 @@
+# 取得したページのキャッシュ（SQLite 1ファイルに圧縮して追記する）
+# (name, page) をキーにする。name は config.yaml の cache テンプレート（例 ../in/results/{}.json）、
+# page は {} に入る値（テンプレートでなければ空文字）
+# 旧形式（ページごとの個別ファイル）は、テンプレートごとに一度だけ取り込む
+
+import os
+import glob
+import zlib
+import time
+import sqlite3
+import logging
+import threading
+
+class PageCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.buffer = {}
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS pages (name TEXT, page TEXT, body BLOB, '
+                              'etag TEXT, last_modified TEXT, fetched REAL, PRIMARY KEY (name, page))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS imported (name TEXT PRIMARY KEY)')
+
+    def has(self, name, page=''):
+        if (name, str(page)) in self.buffer: return True
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM pages WHERE name=? AND page=?', (name, str(page))).fetchone() is not None
+
+    # 本文を返す、無ければNone
+    def get(self, name, page=''):
+        text = self.buffer.pop((name, str(page)), None)
+        if text is not None: return text
+        with self.lock:
+            row = self.conn.execute('SELECT body FROM pages WHERE name=? AND page=?', (name, str(page))).fetchone()
+        return None if row is None else zlib.decompress(row[0]).decode()
+
+    # まとめて読み出して、以降のgetに備える
+    def preload(self, name, pages):
+        pages = [str(page) for page in pages if (name, str(page)) not in self.buffer]
+        for i in range(0, len(pages), 500):
+            batch = pages[i:i + 500]
+            with self.lock:
+                rows = self.conn.execute(f'SELECT page, body FROM pages WHERE name=? AND page IN ({",".join("?" * len(batch))})',
+                                         (name, *batch)).fetchall()
+            for page, body in rows:
+                self.buffer[(name, page)] = zlib.decompress(body).decode()
+
+    def meta(self, name, page=''):
+        with self.lock:
+            row = self.conn.execute('SELECT etag, last_modified FROM pages WHERE name=? AND page=?',
+                                    (name, str(page))).fetchone()
+        return {} if row is None else {'etag': row[0], 'last_modified': row[1]}
+
+    def put(self, name, page, text, etag=None, last_modified=None):
+        body = zlib.compress(text.encode())
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+                              (name, str(page), body, etag, last_modified, time.time()))
+
+    def delete(self, name):
+        self.buffer = {k: v for k, v in self.buffer.items() if k[0] != name}
+        with self.lock, self.conn:
+            n = self.conn.execute('DELETE FROM pages WHERE name=?', (name,)).rowcount
+        logging.info(f'Removed {n} pages of {name}')
+
+    # 旧形式のキャッシュファイルを取り込む（nameごとに一度だけ、元のファイルは残す）
+    def import_files(self, name):
+        with self.lock:
+            if self.conn.execute('SELECT 1 FROM imported WHERE name=?', (name,)).fetchone() is not None: return
+        if '{}' in name:
+            prefix, suffix = name.split('{}')
+            files = [(f[len(prefix):len(f) - len(suffix)], f) for f in glob.glob(name.replace('{}', '*'))]
+        else:
+            files = [('', name)] if os.path.isfile(name) else []
+        if len(files) > 0:
+            logging.info(f'Importing {len(files)} files of {name} into {self.filename}')
+        with self.lock, self.conn:
+            for page, f in files:
+                with open(f) as fp:
+                    body = zlib.compress(fp.read().encode())
+                self.conn.execute('INSERT OR IGNORE INTO pages VALUES (?, ?, ?, NULL, NULL, ?)',
+                                  (name, page, body, os.path.getmtime(f)))
+            self.conn.execute('INSERT INTO imported VALUES (?)', (name,))
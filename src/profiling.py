@@ -0,0 +1,173 @@
+# 段ごとの計測（@lib.logging_time と span で記録する）
+#
+# 1回の呼び出し（span）ごとに次を記録する
+# - wall: 経過秒、cpu: プロセスのCPU秒（スレッドで並列に動いていると、その分も含む）
+# - rss_peak_mb: 終了時点のプロセスの最大RSS、rss_growth_mb: このspanの間に最大RSSが伸びた分
+# - alloc_mb / alloc_peak_mb: tracemallocで測った確保の差分とピーク（tracemallocが有効なときだけ）
+# - rows_in / rows_out、memory_in_mb / memory_out_mb: 入力と出力のDataFrameの行数とメモリ（deepではない）
+#   入力は引数のDataFrame/Seriesと、selfのprofile_frame()（AtCoderDBは引数keyのテーブル、Usersはdf）
+#   出力は戻り値（DataFrame/Series、またはprofile_frame()を持つもの）、無ければ呼び出し後のselfのprofile_frame()
+#
+# spanは入れ子にでき（スレッドごとに親をたどる）、JSONとChromeのtrace event形式(chrome://tracing, Perfetto)に書き出せる
+# 1回あたりの負担は0.1ミリ秒程度（@logging_timeをつけるのは段の単位なので）常に有効にしておける
+# tracemallocは重いので既定では使わない
+#
+# 使い方
+#  with profiling.span('merge'): ...
+#  profiling.profiler.save_json('../out/profile.json')
+#  python profiling.py ../out/profile.json  # 名前ごとの集計（自身の時間の降順）を表示する
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import tracemalloc
+import contextlib
+import pandas as pd
+
+MB = 1024 * 1024
+# ru_maxrssの単位（LinuxはKB、macOSはバイト）
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+def maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_UNIT / MB
+
+# dtypeの1要素の大きさ（カテゴリ型は符号、文字列などのオブジェクトは参照の8バイト）
+def itemsize(dtype):
+    if isinstance(dtype, pd.CategoricalDtype):
+        return 1 if len(dtype.categories) < 2 ** 7 else 2 if len(dtype.categories) < 2 ** 15 else 4
+    return getattr(dtype, 'itemsize', 8)
+
+# DataFrame/Seriesの (行数, メモリMB)、それ以外は None
+# メモリはdtypeからの概算（memory_usage(deep=False)に近い、memory_usageは1回数百マイクロ秒かかるので使わない）
+def frame_size(obj):
+    if obj is not None and not isinstance(obj, (pd.DataFrame, pd.Series)):
+        obj = obj.profile_frame() if hasattr(obj, 'profile_frame') else None
+    if obj is None: return None
+    dtypes = obj.dtypes.to_numpy() if isinstance(obj, pd.DataFrame) else [obj.dtype]
+    index = 0 if isinstance(obj.index, pd.RangeIndex) else itemsize(obj.index.dtype)
+    return len(obj), len(obj) * (sum(map(itemsize, dtypes)) + index) / MB
+
+class Profiler:
+    def __init__(self):
+        self.enabled = True
+        self.spans = []
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__next_id = 0
+
+    # config.yaml の profiling（enabled、tracemalloc）を反映する
+    def configure(self, config):
+        config = config or {}
+        self.enabled = config.get('enabled', True)
+        if config.get('tracemalloc', False) and not tracemalloc.is_tracing(): tracemalloc.start()
+
+    def stack(self):
+        if not hasattr(self.__local, 'stack'): self.__local.stack = []
+        return self.__local.stack
+
+    # 1つのspanを記録する、inputsは入力のDataFrameなど（frame_sizeを参照）
+    # withの中で span['output'] に出力を入れると、その行数も記録する
+    @contextlib.contextmanager
+    def span(self, name, inputs=(), args=None):
+        if not self.enabled:
+            yield {}
+            return
+        stack = self.stack()
+        with self.__lock:
+            self.__next_id += 1
+            id_ = self.__next_id
+        entry = {'id': id_, 'parent': stack[-1]['id'] if stack else None, 'peak': 0}
+        sizes = [size for size in map(frame_size, inputs) if size is not None]
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack: stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            entry['alloc'] = current
+        stack.append(entry)
+        rss = maxrss_mb()
+        ts = time.time_ns()
+        start, cpu = time.perf_counter_ns(), time.process_time_ns()
+        try:
+            yield entry
+        finally:
+            wall, cpu = time.perf_counter_ns() - start, time.process_time_ns() - cpu
+            stack.pop()
+            record = {
+                'name': name, 'id': id_, 'parent': entry['parent'], 'depth': len(stack),
+                'pid': os.getpid(), 'tid': threading.get_native_id(), 'ts': ts // 1000,
+                'wall': wall / 1e9, 'cpu': cpu / 1e9,
+                'rss_peak_mb': round(maxrss_mb(), 1), 'rss_growth_mb': round(maxrss_mb() - rss, 1),
+            }
+            if tracing and tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(entry['peak'], peak)
+                if stack: stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+                tracemalloc.reset_peak()
+                record['alloc_mb'] = round((current - entry['alloc']) / MB, 1)
+                record['alloc_peak_mb'] = round((peak - entry['alloc']) / MB, 1)
+            if sizes:
+                record['rows_in'] = sum(size[0] for size in sizes)
+                record['memory_in_mb'] = round(sum(size[1] for size in sizes), 1)
+            output = frame_size(entry.get('output'))
+            if output is not None:
+                record['rows_out'], record['memory_out_mb'] = output[0], round(output[1], 1)
+            if args is not None: record['args'] = args
+            self.spans.append(record)
+
+    # 他のプロセスで記録したspanを取り込む（users.mainのワーカーなど）
+    def extend(self, spans):
+        self.spans.extend(spans)
+
+    def clear(self):
+        self.spans = []
+
+    # 名前ごとの集計（self_wallは子spanを除いた自身の時間）、自身の時間の降順
+    def summary(self, spans=None):
+        return summarize(self.spans if spans is None else spans)
+
+    def save_json(self, filename):
+        write_json(filename, {'spans': self.spans, 'summary': self.summary().reset_index().to_dict('records')})
+
+    # Chromeのtrace event形式（完了イベント ph='X'、時刻はマイクロ秒）
+    def save_trace(self, filename):
+        events = []
+        for span in self.spans:
+            args = {k: v for k, v in span.items() if k not in ['name', 'pid', 'tid', 'ts', 'wall', 'id', 'parent', 'depth']}
+            events.append({'name': span['name'], 'cat': span['name'].split('.')[0], 'ph': 'X', 'ts': span['ts'],
+                           'dur': round(span['wall'] * 1e6), 'pid': span['pid'], 'tid': span['tid'], 'args': args})
+        write_json(filename, {'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+def summarize(spans):
+    columns = ['count', 'wall', 'self_wall', 'cpu', 'rss_growth_mb', 'rows_in', 'rows_out']
+    if len(spans) == 0: return pd.DataFrame(columns=columns).rename_axis('name')
+    df = pd.DataFrame(spans)
+    for column in ['rows_in', 'rows_out']:
+        if column not in df.columns: df[column] = float('nan')
+    # 同じスレッドの子のwallを親から引く（idはプロセスごとなので、pidと組にする）
+    # 他のスレッドやプロセスで動いた処理は子にならないので、それを待つ時間は自身の時間に入る
+    children = df[df['parent'].notna()].groupby(['pid', 'parent'])['wall'].sum()
+    keys = pd.MultiIndex.from_arrays([df['pid'], df['id']])
+    df['self_wall'] = df['wall'] - children.reindex(keys, fill_value=0).to_numpy()
+    res = df.groupby('name').agg(count=('wall', 'size'), wall=('wall', 'sum'), self_wall=('self_wall', 'sum'),
+                                 cpu=('cpu', 'sum'), rss_growth_mb=('rss_growth_mb', 'sum'),
+                                 rows_in=('rows_in', 'sum'), rows_out=('rows_out', 'sum'))
+    return res.sort_values('self_wall', ascending=False)
+
+def write_json(filename, obj):
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, default=str)
+    os.replace(tmp, filename)
+
+profiler = Profiler()
+span = profiler.span
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as f:
+        spans = json.load(f)['spans']
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(summarize(spans))
@@ -0,0 +1,182 @@
+# 取得先（kenkoooo.com、atcoder.jp）のローカルな代役
+# 記録したフィクスチャを返すHTTPサーバで、遅延、エラー率、429（ランダム、またはレート制限の超過）を設定できる
+# 取得のスループット、リトライ、レート制限の遵守を、オフラインで再現性よく測るために使う
+#
+# フィクスチャ: dirnameの下に、URLごとに1ファイル（fetcher.fixture_path を参照）
+#  config.yaml の fetcher.record を設定して実行すると、実際の取得を記録できる
+#  提出API /atcoder/atcoder-api/v3/from/{epoch} は、記録したページが無くても
+#  kenkoooo.com/submissions.json（全提出のJSON配列、epoch_second順）があれば、epoch以降を500件ずつ返す
+#  静的なファイルにはETag/Last-Modifiedをつけ、条件付きGETには304を返す
+# AtCoderDBを向けるには、config.yaml の fetcher.rewrite でURLを書き換える
+#  https://kenkoooo.com/ → http://127.0.0.1:8765/kenkoooo.com/ のように、パスの先頭を元のホストにする
+#
+# 使い方（src/から）
+#  python replay.py [フィクスチャのディレクトリ]  # config.yaml の replay にしたがってサーバを起動する
+#  GET /__stats__ で、受けたリクエストの集計（状態コードごとの数、ホストごとの1秒あたり最大リクエスト数）を返す
+
+import os
+import sys
+import json
+import time
+import yaml
+import random
+import logging
+import threading
+import numpy as np
+from email.utils import formatdate
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from fetcher import TokenBucket, fixture_path
+
+class ReplayServer:
+    SUBMISSIONS_PATH = '/atcoder/atcoder-api/v3/from/'
+    SUBMISSIONS_SOURCE = os.path.join('kenkoooo.com', 'submissions.json')
+    PAGE_SIZE = 500
+
+    def __init__(self, dirname, config=None):
+        config = config or {}
+        self.dirname = dirname
+        self.latency = config.get('latency', 0)
+        self.jitter = config.get('jitter', 0)
+        self.error_rate = config.get('error_rate', 0)
+        self.throttle_rate = config.get('throttle_rate', 0)
+        self.retry_after = config.get('retry_after', 1)
+        # 元のホストごとのレート制限（これを超えたリクエストには429を返す）
+        self.limits = {host: TokenBucket(**limit) for host, limit in (config.get('rate_limit') or {}).items()}
+        self.random = random.Random(config.get('seed', 0))
+        self.lock = threading.Lock()
+        self.log = []       # [(時刻, ホスト, 状態コード, レート制限の超過か)]
+        self.submissions = None
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                server.handle(self)
+            def log_message(self, format, *args):
+                pass
+        self.httpd = ThreadingHTTPServer((config.get('host', '127.0.0.1'), config.get('port', 0)), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    # fetcher.rewrite に設定する書き換え {元のURLの先頭: このサーバのURL}
+    def rewrite(self, hosts=('kenkoooo.com', 'atcoder.jp', 's3-ap-northeast-1.amazonaws.com')):
+        return {f'https://{host}/': f'{self.url}/{host}/' for host in hosts}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        logging.info(f'Replaying {self.dirname} at {self.url}')
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, request):
+        parts = urlsplit(request.path)
+        if parts.path == '/__stats__':
+            return self.send(request, 200, json.dumps(self.stats()).encode(), 'application/json')
+        host, _, path = parts.path.lstrip('/').partition('/')
+        url = f'https://{host}/{path}' + (f'?{parts.query}' if parts.query else '')
+        with self.lock:
+            draw = self.random.random()
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        limited = host in self.limits and self.limits[host].try_acquire() > 0
+        time.sleep(delay)
+        if limited or draw < self.throttle_rate:
+            status, body = 429, b''
+        elif draw < self.throttle_rate + self.error_rate:
+            status, body = 500, b''
+        else:
+            return self.send_resource(request, host, url)
+        self.record(host, status, limited)
+        self.send(request, status, body, 'text/plain', {'Retry-After': str(self.retry_after)} if status == 429 else {})
+
+    def send_resource(self, request, host, url):
+        filename = fixture_path(self.dirname, url)
+        content_type = 'application/json' if url.endswith('json') or self.__class__.SUBMISSIONS_PATH in url \
+            else 'text/html; charset=utf-8'
+        if os.path.isfile(filename):
+            stat = os.stat(filename)
+            etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+            headers = {'ETag': etag, 'Last-Modified': formatdate(stat.st_mtime, usegmt=True)}
+            if request.headers.get('If-None-Match') == etag:
+                self.record(host, 304)
+                return self.send(request, 304, b'', content_type, headers)
+            with open(filename, 'rb') as f:
+                body = f.read()
+            self.record(host, 200)
+            return self.send(request, 200, body, content_type, headers)
+        if self.__class__.SUBMISSIONS_PATH in url and self.load_submissions():
+            epoch = int(url.rsplit('/', 1)[1])
+            epochs, rows = self.submissions
+            start = int(np.searchsorted(epochs, epoch, side='left'))
+            self.record(host, 200)
+            return self.send(request, 200, f'[{",".join(rows[start:start + self.__class__.PAGE_SIZE])}]'.encode(),
+                             content_type)
+        self.record(host, 404)
+        self.send(request, 404, b'', 'text/plain')
+
+    # 提出APIの元データを読み込む（1回だけ）、無ければFalse
+    def load_submissions(self):
+        with self.lock:
+            if self.submissions is None:
+                filename = os.path.join(self.dirname, self.__class__.SUBMISSIONS_SOURCE)
+                if not os.path.isfile(filename): return False
+                with open(filename) as f:
+                    items = json.load(f)
+                epochs = np.array([item['epoch_second'] for item in items], dtype=np.int64)
+                assert (np.diff(epochs) >= 0).all(), f'{filename} must be sorted by epoch_second.'
+                self.submissions = (epochs, [json.dumps(item) for item in items])
+        return True
+
+    def send(self, request, status, body, content_type, headers=None):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def record(self, host, status, limited=False):
+        with self.lock:
+            self.log.append((time.monotonic(), host, status, limited))
+
+    # 受けたリクエストの集計
+    # requests / status: 状態コードごとの数 / limited: レート制限の超過で429にした数
+    # max_per_second: ホストごとの、任意の1秒間に受けたリクエスト数の最大
+    def stats(self):
+        with self.lock:
+            log = list(self.log)
+        res = {'requests': len(log), 'status': {}, 'limited': sum(item[3] for item in log), 'max_per_second': {}}
+        for _, _, status, _ in log:
+            res['status'][str(status)] = res['status'].get(str(status), 0) + 1
+        for host in sorted({item[1] for item in log}):
+            times = np.array([item[0] for item in log if item[1] == host])
+            res['max_per_second'][host] = int((np.searchsorted(times, times + 1, side='left') - np.arange(len(times))).max())
+        return res
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(message)s')
+    with open('config.yaml') as f:
+        config = yaml.safe_load(f)['replay']
+    dirname = sys.argv[1] if len(sys.argv) > 1 else config['dirname']
+    server = ReplayServer(dirname, config).start()
+    print('Set fetcher.rewrite in config.yaml to:', flush=True)
+    print(yaml.safe_dump(server.rewrite(), default_flow_style=False), flush=True)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,700 @@
+# テーブルの保存形式を抽象化する
+# config.yaml の database.{key}.storage で形式を選ぶ（csv / parquet / feather / npz）
+# database.{key}.schema で列の型を明示する（category / int32 / int64 / float32 / float64 など）
+#
+# parquet / feather は pyarrow が必要
+# npz は numpy のみで動き、文字列列は辞書符号化（codes + categories）して保存する
+#
+# database.{key}.partition があれば、時刻の列で月（または週）ごとのファイルに分けて保存する（read_partitioned を参照）
+#
+# export / attach は、複数のプロセスで同じテーブルを共有するための列ストア（ディレクトリ）
+# 列ごとの .npy をメモリマップで読み取り専用に開くので、読み込みはほぼ一瞬で、物理メモリはページキャッシュで共有される
+
+import os
+import yaml
+import time
+import fcntl
+import shutil
+import tempfile
+import hashlib
+import importlib.util
+import logging
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+import kernels
+
+FORMATS = ['csv', 'parquet', 'feather', 'npz']
+
+# スキーマにしたがって型を揃える
+# 整数型は、欠損値または小数を含む列には適用しない（黙って元の型のまま）
+def apply_schema(df, schema):
+    if not schema or len(df) == 0: return df
+    dtypes = {}
+    for column, dtype in schema.items():
+        if column in df.columns and _castable(df[column], dtype):
+            dtypes[column] = dtype
+    if len(dtypes) > 0:
+        df = df.astype(dtypes)
+    name = df.index.name
+    if name in schema and _castable(df.index, schema[name]):
+        df.index = df.index.astype(schema[name])
+        df.index.name = name
+    return df
+
+def _castable(values, dtype):
+    if str(values.dtype) == dtype: return False
+    if dtype.startswith('int') or dtype.startswith('uint'):
+        if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype): return False
+        if values.isna().any(): return False
+        if values.dtype.kind == 'f' and not (values == np.floor(values)).all(): return False
+    return True
+
+# カテゴリ列のカテゴリを揃えてからconcatする（揃えないとobject型に落ちてメモリが膨らむ）
+def concat(frames):
+    frames = [df for df in frames if df is not None and len(df) > 0]
+    if len(frames) == 0: return pd.DataFrame()
+    if len(frames) == 1: return frames[0]
+    for column in frames[0].columns:
+        if not all(column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype) for df in frames):
+            continue
+        categories = union_categoricals([df[column] for df in frames], ignore_order=True).categories
+        frames = [df.assign(**{column: df[column].cat.set_categories(categories)}) for df in frames]
+    return pd.concat(frames)
+
+# filterの条件をboolマスクにする
+# - リストを指定したら要素のor
+# - rangeを指定したら範囲クエリー
+# - それ以外は一致
+def condition(values, value):
+    if isinstance(value, range):
+        return (values >= value[0]) & (values <= value[-1])
+    elif isinstance(value, list):
+        return values.isin(value)
+    else:
+        return values == value
+
+# 大きなcsvをチャンク単位で読み、列の射影と行の絞り込みをしながら sort_column でソートして返す
+# 読み込み中に抑えられるのは絞り込み前のチャンクまでで、マージではソート済のチャンク全体・連結・並べ替えの
+# コピーが同時に載るため、ピークのメモリは結果の数倍になる（チャンクの大きさでは抑えられない）
+# where={column: value} の書式は condition() にしたがう
+def scan_csv(filename, sort_column, chunksize=1000000, columns=None, schema=None, where=None):
+    where = where or {}
+    header = pd.read_csv(filename, nrows=0).columns
+    usecols = None
+    if columns is not None:
+        usecols = [c for i, c in enumerate(header) if i == 0 or c in columns or c in where or c == sort_column]
+    dtype = {c: t for c, t in (schema or {}).items() if t == 'category' and (usecols is None or c in usecols)}
+    chunks = []
+    with pd.read_csv(filename, index_col=0, usecols=usecols, dtype=dtype, chunksize=chunksize) as reader:
+        for df in reader:
+            for column, value in where.items():
+                df = df[condition(df[column] if column in df.columns else df.index, value)]
+            df = apply_schema(df, schema)
+            chunks.append(df.sort_values(sort_column, kind='stable'))
+    df = merge_sorted(chunks, sort_column)
+    if columns is not None:
+        df = df[[c for c in df.columns if c in columns]]
+    return df
+
+# ソート済のDataFrame群をマージする
+# 安定ソート(timsort)はソート済の連続区間を検出するので、連結してからのargsortがk-wayマージとして働く
+def merge_sorted(frames, column):
+    df = concat(frames)
+    if len(df) == 0: return df
+    values = df[column].to_numpy()
+    if (values[1:] >= values[:-1]).all(): return df
+    return df.iloc[np.argsort(values, kind='stable')]
+
+# ファイルの同一性（大きさと更新時刻）、ファイルが無ければNone
+def signature(filename):
+    if not os.path.isfile(filename): return None
+    return f'{os.path.getsize(filename)}:{int(os.path.getmtime(filename))}'
+
+# columnsで読む列を、where={column: value}（conditionの書式）で読む行を絞る
+# parquetは列・行とも読み込み時に絞り、それ以外の形式は読み込んでから絞る
+# partitionを指定したら分割した保存から読む（read_partitioned を参照）
+def read(filename, storage='csv', schema=None, columns=None, where=None, partition=None, bounds=None):
+    assert storage in FORMATS, f'Storage: {storage} is not implemented.'
+    if partition is not None: return read_partitioned(filename, storage, schema, columns, where, partition, bounds)
+    return read_files([filename], storage, schema, columns, where)
+
+# 同じ形式のファイル群を読んで、つなげた1つのDataFrameにする（columns / where は read と同じ）
+def read_files(filenames, storage, schema=None, columns=None, where=None):
+    where = where or {}
+    match storage:
+        case 'csv':
+            usecols = None
+            if columns is not None:
+                index = pd.read_csv(filenames[0], nrows=0).columns[0]
+                usecols = lambda c: c == index or c in columns or c in where
+            frames = [pd.read_csv(filename, index_col=0, usecols=usecols) for filename in filenames]
+        case 'parquet':
+            _require_pyarrow(storage)
+            read_columns = None if columns is None else list(dict.fromkeys([*columns, *where]))
+            frames = [_read_parquet(filenames, read_columns, _parquet_filters(where))]
+        case 'feather':
+            _require_pyarrow(storage)
+            frames = []
+            for filename in filenames:
+                df = pd.read_feather(filename)
+                index = df.columns[0]
+                df = df.set_index(index)
+                df.index.name = index.removeprefix('__index__:') or None
+                frames.append(df)
+        case 'npz':
+            frames = [_read_npz(filename) for filename in filenames]
+    df = concat(frames)
+    if len(df) == 0: df = frames[0]
+    for column, value in where.items():
+        df = df[condition(df[column] if column in df.columns else df.index, value)]
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return apply_schema(df, schema)
+
+# 複数のparquetは1つのテーブルにつなげてからDataFrameにする（ファイルごとにDataFrameにしてつなげるより速い）
+# ファイルごとに辞書の符号の幅（int8 / int16など）が違うので、まとめた辞書が収まる幅に揃えてからつなげ、辞書を1つにまとめる
+def _read_parquet(filenames, columns, filters):
+    if len(filenames) == 1: return pd.read_parquet(filenames[0], columns=columns, filters=filters or None)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    tables = [pq.read_table(filename, columns=columns, filters=filters or None, use_pandas_metadata=True)
+              for filename in filenames]
+    # まとめた辞書の大きさは、ファイルごとの辞書の大きさの和を超えない
+    sizes = {}
+    for table in tables:
+        for name in table.column_names:
+            if pa.types.is_dictionary(table[name].type):
+                sizes[name] = sizes.get(name, 0) + sum(len(chunk.dictionary) for chunk in table[name].chunks)
+    widths = {name: 8 if size < 2 ** 7 else 16 if size < 2 ** 15 else 32 for name, size in sizes.items()}
+    for i, table in enumerate(tables):
+        fields = [field.with_type(pa.dictionary(getattr(pa, f'int{widths[field.name]}')(), field.type.value_type))
+                  if field.name in widths and pa.types.is_dictionary(field.type) else field for field in table.schema]
+        tables[i] = table.cast(pa.schema(fields, metadata=table.schema.metadata))
+    table = pa.concat_tables(tables, promote_options='default').unify_dictionaries()
+    del tables
+    # 変換しながらテーブルを解放して、ピークメモリを抑える
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+# 行数がわかっている複数のparquetを、つなげた大きさの配列に順に書き写してDataFrameにする
+# つなげたテーブルからの変換より、テーブルを1つずつしか持たない分だけ速く、ピークメモリも小さい
+# dtypes={列: 型} で配列の型を指定できる、数値でない列があれば読まずにNone
+def _read_parquet_rows(filenames, columns, rows, dtypes=None):
+    _require_pyarrow('parquet')
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pq.read_schema(filenames[0])
+    names = [name for name in schema.names if columns is None or name in columns or name in _index_columns(schema)]
+    types = [schema.field(name).type for name in names]
+    if not all(pa.types.is_integer(t) or pa.types.is_floating(t) or pa.types.is_boolean(t) for t in types): return None
+    arrays = {name: np.empty(rows, dtype=(dtypes or {}).get(name, t.to_pandas_dtype())) for name, t in zip(names, types)}
+    offset = 0
+    for filename in filenames:
+        table = pq.ParquetFile(filename).read(columns=names)
+        for name in names:
+            position = offset
+            for chunk in table[name].chunks:
+                arrays[name][position:position + len(chunk)] = chunk.to_numpy(zero_copy_only=False)
+                position += len(chunk)
+        offset += table.num_rows
+        del table
+    assert offset == rows, f'Read {offset} rows, expected {rows}.'
+    index = [name for name in _index_columns(schema) if name in arrays]
+    df = pd.DataFrame({name: arrays[name] for name in names if name not in index}, copy=False)
+    if len(index) > 0:
+        labels = {column['field_name']: column['name'] for column in schema.pandas_metadata.get('columns', [])}
+        df.index = pd.Index(arrays[index[0]], name=labels.get(index[0], index[0]))
+    if columns is not None: df = df[[c for c in columns if c in df.columns]]
+    return df
+
+# pandasが書いたparquetのindexの列名（RangeIndexは列を持たない）
+def _index_columns(schema):
+    metadata = schema.pandas_metadata or {}
+    return [name for name in metadata.get('index_columns', []) if isinstance(name, str)]
+
+# 空のリスト・rangeはpyarrowに渡せないので、読み込んでから絞る側に任せる
+def _parquet_filters(where):
+    filters = []
+    for column, value in where.items():
+        if isinstance(value, (range, list)) and len(value) == 0:
+            continue
+        if isinstance(value, range):
+            filters += [(column, '>=', value[0]), (column, '<=', value[-1])]
+        elif isinstance(value, list):
+            filters.append((column, 'in', value))
+        else:
+            filters.append((column, '==', value))
+    return filters
+
+# 書き込みは一時ファイル経由で置き換える（途中で落ちても既存ファイルを壊さない）
+# partitionを指定したら分割して保存する（write_partitioned を参照）
+def write(df, filename, storage='csv', schema=None, partition=None, since=None):
+    assert storage in FORMATS, f'Storage: {storage} is not implemented.'
+    if partition is not None: return write_partitioned(df, filename, storage, schema, partition, since)
+    df = apply_schema(df, schema)
+    tmp = f'{filename}.tmp'
+    match storage:
+        case 'csv':
+            df.to_csv(tmp)
+        case 'parquet':
+            _require_pyarrow(storage)
+            df.to_parquet(tmp)
+        case 'feather':
+            _require_pyarrow(storage)
+            # featherはindexを持てないので先頭列として退避する
+            df.reset_index(names=f'__index__:{df.index.name or ""}').to_feather(tmp)
+        case 'npz':
+            _write_npz(df, tmp)
+    os.replace(tmp, filename)
+
+# 旧形式のファイルがあれば、一度だけ新形式に変換する
+# legacy_filenameはリストでもよく（新しい順）、最初に見つかったものを変換する
+# 旧形式は拡張子で決める（FORMATS以外はcsv）
+def migrate(legacy_filename, filename, storage, schema=None, partition=None):
+    if os.path.isfile(filename) or legacy_filename is None: return False
+    legacy_filenames = legacy_filename if isinstance(legacy_filename, list) else [legacy_filename]
+    legacy_filenames = [name for name in legacy_filenames if os.path.isfile(name)]
+    if len(legacy_filenames) == 0: return False
+    legacy_filename = legacy_filenames[0]
+    legacy_storage = os.path.splitext(legacy_filename)[1].removeprefix('.')
+    legacy_storage = legacy_storage if legacy_storage in FORMATS else 'csv'
+    logging.info(f'Migrating {legacy_filename} to {filename} ({storage})')
+    df = read(legacy_filename, legacy_storage, schema)
+    write(df, filename, storage, schema, partition)
+    logging.info(f'Migrated {len(df)} rows to {filename}')
+    return True
+
+# 分割した保存（config.yaml の database.{key}.partition: {column: 時刻の列, fleq: 'M' または 'W'}）
+# filenameは目録（yaml）で、パーティションは同じディレクトリの {ラベル}.{形式}
+# ラベルは column を kernels.resample_datetime で fleq にしたもの（東京時間の YYYYMM、週は月曜の YYYYMMDD）
+# compact: 'Y' を指定したら、最新の年より前は年ごとに1つのパーティション（ラベルは YYYY）にまとめる
+# （差分の追加で書きなおすのは最新の月のままで、全体を読むときに開くファイルが少なくなる）
+# 目録: version, column, fleq, storage, schema（スキーマのハッシュ）
+#       compact, partitions: [{label, filename, rows, min, max, signature}] ラベル順、min / max は column の最小・最大
+#       dictionaries: {カテゴリ列: {filename, size}} パーティションは符号（int32、欠損値は-1）で持ち、
+#       カテゴリは列ごとに1つの辞書ファイル（dictionary.{列}.{形式}、列名はvalue）の先頭 size 個
+#       （パーティションごとに辞書を持つと、全体を読むときに同じ文字列を何度も読んでまとめることになる）
+# 辞書は追加だけなので、辞書ファイルを先に置き換えれば、古い目録を読んだプロセスも先頭 size 個で正しく読める
+# 読み込みは、where（と bounds）の column の範囲に [min, max] が重なるパーティションのファイルだけを開く
+# 書き込みは、since以降の行を含むパーティションだけを書きなおす（差分の追加では最新のパーティションだけになる）
+# dictionariesの無い目録（パーティションがカテゴリを持つ形式）も読め、次の書き込みで全体を書きなおす
+# 要約 {filename}.summary.yaml: マニフェストはこれを集めて作るので、全行をたどらない（読み込みには使わない）
+#       columns（summarize を参照）
+#       partitions: {label: {signature, hash, contest_ids, epochs}} hash はファイルの内容のハッシュ
+#       contest_ids / epochs は summarize を参照（contest_ids は空白区切りの1つの文字列、contest_idが無ければNone）
+#       signature が目録と違うパーティションの要約は、そのファイルを読んで作りなおす
+PARTITIONS_VERSION = 1
+
+def read_catalog(filename):
+    if not os.path.isfile(filename): return None
+    with open(filename) as f:
+        catalog = yaml.load(f, Loader=YAML_LOADER)
+    if not isinstance(catalog, dict) or catalog.get('version') != PARTITIONS_VERSION: return None
+    return catalog
+
+def summary_filename(filename):
+    return f'{filename}.summary.yaml'
+
+def read_summary(filename):
+    if not os.path.isfile(summary_filename(filename)): return {}
+    with open(summary_filename(filename)) as f:
+        summary = yaml.load(f, Loader=YAML_LOADER)
+    return summary if isinstance(summary, dict) else {}
+
+def _write_yaml(filename, data):
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'w') as f:
+        yaml.dump(data, f, Dumper=YAML_DUMPER, default_flow_style=False, sort_keys=False)
+    os.replace(tmp, filename)
+
+# 分割した保存から読む、whereの書式は read と同じ
+# bounds={column: range} は読むパーティションを絞るだけの範囲（行は絞らない）
+def read_partitioned(filename, storage, schema=None, columns=None, where=None, partition=None, bounds=None):
+    catalog = read_catalog(filename)
+    assert catalog is not None, f'{filename} is not a catalog of partitions.'
+    column = catalog['column']
+    lower, upper = -2 ** 63, 2 ** 63 - 1
+    for value in [(where or {}).get(column), (bounds or {}).get(column)]:
+        if isinstance(value, range) and len(value) > 0:
+            lower, upper = max(lower, value[0]), min(upper, value[-1])
+    parts = catalog['partitions']
+    selected = [part for part in parts if part['max'] >= lower and part['min'] <= upper]
+    logging.info(f'Reading {len(selected)} of {len(parts)} partitions of {filename}')
+    # 重なるパーティションが無くても、列を揃えるために1つは読む
+    if len(selected) == 0:
+        if len(parts) == 0: return pd.DataFrame()
+        return _read_parts(filename, catalog, parts[-1:], schema, columns).iloc[:0]
+    return _read_parts(filename, catalog, selected, schema, columns, where)
+
+# パーティションを読んでつなげ、符号をカテゴリに戻す
+# カテゴリ列のwhereは符号に直して絞る（辞書に無い値は何にも一致しない）
+def _read_parts(filename, catalog, parts, schema=None, columns=None, where=None):
+    dirname = os.path.dirname(filename)
+    filenames = [os.path.join(dirname, part['filename']) for part in parts]
+    if 'dictionaries' not in catalog: return read_files(filenames, catalog['storage'], schema, columns, where)
+    dictionaries = {column: _read_dictionary(dirname, catalog['storage'], item)
+                    for column, item in catalog['dictionaries'].items()
+                    if columns is None or column in columns or column in (where or {})}
+    where = dict(where or {})
+    for column, value in where.items():
+        if column not in dictionaries: continue
+        assert not isinstance(value, range), f'Cannot filter category column {column} by range.'
+        codes = dictionaries[column].get_indexer(value if isinstance(value, list) else [value])
+        where[column] = codes[codes >= 0].tolist()
+    # 符号はカテゴリの数が収まる幅にする（from_codesがそのまま使い、コピーしない）
+    widths = {column: np.int8 if len(categories) < 2 ** 7 else np.int16 if len(categories) < 2 ** 15 else np.int32
+              for column, categories in dictionaries.items()}
+    if catalog['storage'] == 'parquet' and len(where) == 0:
+        df = _read_parquet_rows(filenames, columns, sum(part['rows'] for part in parts), widths)
+    else:
+        df = read_files(filenames, catalog['storage'], {c: t for c, t in (schema or {}).items() if c not in dictionaries},
+                        columns, where)
+    if df is None: return read_files(filenames, catalog['storage'], schema, columns)
+    for column, categories in dictionaries.items():
+        if column in df.columns:
+            codes = df[column].to_numpy().astype(widths[column], copy=False)
+            df[column] = pd.Categorical.from_codes(codes, categories=categories, validate=False)
+    return apply_schema(df, schema)
+
+def _read_dictionary(dirname, storage, item):
+    df = read(os.path.join(dirname, item['filename']), storage)
+    return pd.Index(df['value'].iloc[:item['size']]) if 'value' in df.columns else pd.Index([])
+
+# dfをcolumnでソートして（ソート済であればそのまま）パーティションに分けて保存し、目録を書く
+# sinceより前の行だけのパーティションは、目録と行数・[min, max]・ファイルの signature が一致すれば書かない
+# 目録はパーティションを書き終えてから置き換え、目録から外れたパーティションのファイルは消す
+def write_partitioned(df, filename, storage, schema, partition, since=None):
+    column, fleq = partition['column'], partition.get('fleq', 'M')
+    df = apply_schema(df, schema)
+    values = df[column].to_numpy()
+    if len(values) > 1 and not (values[1:] >= values[:-1]).all():
+        df = df.iloc[np.argsort(values, kind='stable')]
+        values = df[column].to_numpy()
+    labels = kernels.resample_datetime(values, 'epoch', fleq)
+    compact = partition.get('compact')
+    if compact is not None and len(values) > 0:
+        assert compact == 'Y', f'Compact: {compact} is not implemented.'
+        years = kernels.resample_datetime(values, 'epoch', 'Y')
+        labels = np.where(years < years[-1], years, labels)
+    starts = np.concatenate([[0], np.flatnonzero(labels[1:] != labels[:-1]) + 1]) if len(df) > 0 else []
+    ends = [*starts[1:], len(df)]
+    catalog = read_catalog(filename)
+    # カテゴリ列の辞書は前の辞書に追加する（書き残すパーティションの符号も、古い目録で読むプロセスの符号も変えない）
+    extend = catalog is not None and 'dictionaries' in catalog and [catalog[k] for k in ['storage', 'schema']] == \
+        [storage, schema_hash(schema)]
+    compatible = extend and [catalog[k] for k in ['column', 'fleq']] == [column, fleq] and catalog.get('compact') == compact
+    old = {part['label']: part for part in catalog['partitions']} if catalog is not None else {}
+    dirname = os.path.dirname(filename)
+    if dirname: os.makedirs(dirname, exist_ok=True)
+    dictionaries, remaps = {}, {}
+    for name in df.columns:
+        if not isinstance(df[name].dtype, pd.CategoricalDtype): continue
+        item = {'filename': f'dictionary.{name}.{storage}', 'size': 0}
+        categories = df[name].cat.categories
+        previous = categories[:0]
+        if extend and name in catalog['dictionaries']:
+            item = catalog['dictionaries'][name]
+            previous = _read_dictionary(dirname, storage, item)
+        if categories[:len(previous)].equals(previous):
+            merged, remap = categories, None
+        else:
+            merged = previous.append(categories.difference(previous, sort=False))
+            # 旧符号から新符号への表（末尾は欠損値の-1を-1に移す）
+            remap = np.append(merged.get_indexer(categories), -1).astype(np.int32)
+        if len(merged) > item['size'] or not os.path.isfile(os.path.join(dirname, item['filename'])):
+            write(pd.DataFrame({'value': merged}), os.path.join(dirname, item['filename']), storage)
+        dictionaries[name] = {'filename': item['filename'], 'size': len(merged)}
+        remaps[name] = remap
+    summaries = read_summary(filename).get('partitions') or {}
+    parts, written = [], 0
+    for start, end in zip(starts, ends):
+        label = str(labels[start])
+        part = {'label': label, 'filename': f'{label}.{storage}', 'rows': int(end - start),
+                'min': int(values[start]), 'max': int(values[end - 1])}
+        path = os.path.join(dirname, part['filename'])
+        prev = old.get(label) if compatible else None
+        if compatible and since is not None and part['max'] < since and prev is not None \
+                and all(prev[k] == part[k] for k in ['filename', 'rows', 'min', 'max']) \
+                and prev['signature'] == signature(path):
+            parts.append(prev)
+            continue
+        frame = df.iloc[start:end]
+        codes = {}
+        for name, remap in remaps.items():
+            codes[name] = frame[name].cat.codes.to_numpy().astype(np.int32)
+            if remap is not None: codes[name] = remap[codes[name]]
+        write(frame.assign(**codes), path, storage)
+        part['signature'] = signature(path)
+        summaries[label] = _part_summary(path, summarize(frame, schema))
+        parts.append(part)
+        written += 1
+    labels = {part['label'] for part in parts}
+    _write_yaml(summary_filename(filename), {'columns': summarize(df.iloc[:0], schema)['columns'],
+        'partitions': {label: item for label, item in summaries.items() if label in labels}})
+    catalog = {'version': PARTITIONS_VERSION, 'column': column, 'fleq': fleq, 'compact': compact, 'storage': storage,
+               'schema': schema_hash(schema), 'dictionaries': dictionaries, 'partitions': parts}
+    _write_yaml(filename, catalog)
+    filenames = {part['filename'] for part in parts}
+    for part in old.values():
+        path = os.path.join(dirname, part['filename'])
+        if part['filename'] not in filenames and os.path.isfile(path): os.remove(path)
+    logging.info(f'Wrote {written} of {len(parts)} partitions of {filename}')
+
+def _require_pyarrow(storage):
+    assert importlib.util.find_spec('pyarrow') is not None, f'Install pyarrow to use storage: {storage}.'
+
+# npz: 列ごとに配列で保存する
+# 数値列はそのまま、それ以外は codes(int32) と categories(unicode) に分ける（欠損値は code=-1）
+def _write_npz(df, filename):
+    arrays = {}
+    names = [df.index.name or '', *df.columns]
+    for i, values in enumerate([df.index.to_series(), *(df[c] for c in df.columns)]):
+        if values.dtype.kind in 'biuf':
+            arrays[f'v{i}'] = values.to_numpy()
+        else:
+            cat = values.astype('category').cat
+            arrays[f'c{i}'] = cat.codes.to_numpy().astype(np.int32)
+            arrays[f'k{i}'] = cat.categories.to_numpy().astype(str)
+    arrays['names'] = np.array(names, dtype=str)
+    with open(filename, 'wb') as f:
+        np.savez(f, **arrays)
+
+def _read_npz(filename):
+    with np.load(filename) as z:
+        names = z['names'].tolist()
+        columns = {}
+        for i, name in enumerate(names):
+            if f'v{i}' in z:
+                columns[i] = z[f'v{i}']
+            else:
+                columns[i] = pd.Categorical.from_codes(z[f'c{i}'], categories=z[f'k{i}'])
+    df = pd.DataFrame({name: columns[i + 1] for i, name in enumerate(names[1:])})
+    index = columns[0]
+    if isinstance(index, pd.Categorical): index = np.asarray(index, dtype=object)
+    df.index = pd.Index(index, name=names[0] or None)
+    return df
+
+# 版を分けて書くディレクトリ（列ストアや副次インデックス）
+# {dirname}/CURRENT: 使う版のディレクトリ名（書き終えてから置き換える）
+# {dirname}/{版}/: 書き始めた時刻順の名前で、版ごとに別のディレクトリ（mkdtemp）に書くので、開いているプロセスとは干渉しない
+#   最後に meta.yaml を書き、それがあれば書き終えた版とみなす
+# CURRENTの置き換えと古い版の削除は {dirname}/LOCK で排他し、CURRENTは新しい版にしか進めない
+# 古い版は1つ前まで残す（CURRENTを読んだ直後のプロセスが開けるように）
+VERSION_POINTER = 'CURRENT'
+VERSION_STALE_SECONDS = 86400
+
+# write(版のディレクトリ) で書いてから、その版をCURRENTにする、使う版のディレクトリを返す
+def write_version(dirname, write):
+    # 版を分けない旧形式のディレクトリは作りなおす
+    if os.path.isdir(dirname) and not os.path.isfile(os.path.join(dirname, VERSION_POINTER)) \
+            and os.path.isfile(os.path.join(dirname, 'meta.yaml')):
+        shutil.rmtree(dirname)
+    os.makedirs(dirname, exist_ok=True)
+    path = tempfile.mkdtemp(dir=dirname, prefix=f'v{time.time_ns():020d}-')
+    write(path)
+    assert os.path.isfile(os.path.join(path, 'meta.yaml')), f'{path} has no meta.yaml.'
+    version = os.path.basename(path)
+    with open(os.path.join(dirname, 'LOCK'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        current = _current_version(dirname)
+        # 後から書き始めた版が先に置き換えていれば、この版は使わない（次の削除で消える）
+        if current is None or current < version:
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix=f'{VERSION_POINTER}.')
+            with os.fdopen(fd, 'w') as f:
+                f.write(version)
+            os.replace(tmp, os.path.join(dirname, VERSION_POINTER))
+            current = version
+        _remove_old_versions(dirname, current)
+    return os.path.join(dirname, current)
+
+# CURRENTが指す書き終えた版のディレクトリ、無ければNone
+def current_version(dirname):
+    version = _current_version(dirname)
+    if version is None or not os.path.isfile(os.path.join(dirname, version, 'meta.yaml')): return None
+    return os.path.join(dirname, version)
+
+def _current_version(dirname):
+    filename = os.path.join(dirname, VERSION_POINTER)
+    if not os.path.isfile(filename): return None
+    with open(filename) as f:
+        return f.read().strip() or None
+
+# 今の版より古い書き終えた版を1つ前を残して消す（今の版より新しいものは、書き出し中か置き換え待ちなので残す）
+# 書き出し途中で止まったまま古くなった版も消す
+def _remove_old_versions(dirname, current):
+    versions = sorted(entry.name for entry in os.scandir(dirname) if entry.is_dir() and entry.name < current)
+    finished = [v for v in versions if os.path.isfile(os.path.join(dirname, v, 'meta.yaml'))]
+    for version in versions:
+        path = os.path.join(dirname, version)
+        if version in finished[-1:]: continue
+        if version in finished or time.time() - os.path.getmtime(path) > VERSION_STALE_SECONDS:
+            shutil.rmtree(path, ignore_errors=True)
+
+# 列ストアへ書き出す（版を分けて書く、write_version を参照）
+# {版}/{i}.npy: 列ごとの配列（文字列列は辞書符号化したcodes、欠損値はcode=-1）
+# {版}/dictionary.npz: 辞書符号化した列の categories（全列で1ファイル）
+# {版}/meta.yaml: 列名と符号化の有無、行数、元テーブルファイルの signature
+def export(df, dirname, schema=None, signature=None):
+    df = apply_schema(df, schema)
+    def write(path):
+        columns, dictionary = [], {}
+        index = df.index
+        items = [] if isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1 else [('__index__', index.to_series())]
+        for i, (name, values) in enumerate([*items, *df.items()]):
+            encoded = values.dtype.kind not in 'biufM'
+            if encoded:
+                cat = values.astype('category').cat
+                dictionary[str(i)] = cat.categories.to_numpy().astype(str)
+                values = cat.codes
+            np.save(os.path.join(path, f'{i}.npy'), values.to_numpy())
+            columns.append({'name': name, 'encoded': encoded})
+        with open(os.path.join(path, 'dictionary.npz'), 'wb') as f:
+            np.savez(f, **dictionary)
+        meta = {'nrows': len(df), 'signature': signature, 'index_name': index.name, 'columns': columns}
+        with open(os.path.join(path, 'meta.yaml'), 'w') as f:
+            yaml.safe_dump(meta, f, default_flow_style=False)
+    path = write_version(dirname, write)
+    logging.info(f'Exported {len(df)} rows to {path}')
+
+# 列ストアの今の版のメタ情報（dirnameに版のディレクトリを入れる）、無ければNone
+def exported(dirname):
+    path = current_version(dirname)
+    if path is None: return None
+    with open(os.path.join(path, 'meta.yaml')) as f:
+        meta = yaml.safe_load(f)
+    meta['dirname'] = path
+    return meta
+
+# 列ストアを読み取り専用でメモリマップしたDataFrameを返す（列はコピーしない）
+# 書き出し時にobject型だった列はcategory型になる
+def attach(dirname):
+    meta = exported(dirname)
+    assert meta is not None, f'{dirname} is not exported.'
+    dirname = meta['dirname']
+    with np.load(os.path.join(dirname, 'dictionary.npz')) as z:
+        dictionary = {name: pd.Index(z[name]) for name in z.files}
+    columns = {}
+    for i, column in enumerate(meta['columns']):
+        # memmapのままだとpandasの比較などで型が食い違うので、同じメモリを指すndarrayにする
+        values = np.asarray(np.load(os.path.join(dirname, f'{i}.npy'), mmap_mode='r'))
+        if column['encoded']:
+            values = pd.Categorical.from_codes(values, categories=dictionary[str(i)], validate=False)
+        columns[column['name']] = values
+    index = columns.pop('__index__', None)
+    if isinstance(index, pd.Categorical): index = np.asarray(index, dtype=object)
+    df = pd.DataFrame(columns, copy=False)
+    if index is not None: df.index = pd.Index(index)
+    df.index.name = meta['index_name']
+    return df
+
+# マニフェスト {filename}.manifest.yaml
+# テーブルファイルの要約で、依存関係の確認などはファイル本体を読まずにこれだけを読む
+# version: マニフェストの形式、signature: 要約したときのファイルの signature（一致しなければ古いので使わない）
+# schema: 書いたときのスキーマ（config.yaml）のハッシュ（スキーマを変えたら古いとみなす）
+# rows: 行数、hash: ファイルの内容のハッシュ（blake2b）、columns / contest_ids / epochs: summarize を参照
+# 分割した保存では要約ファイル（read_summary）のパーティションごとの要約から作り（hashはパーティションのハッシュを並べたもののハッシュ）、
+# ファイル本体もdfもたどらない
+MANIFEST_VERSION = 1
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+def manifest_filename(filename):
+    return f'{filename}.manifest.yaml'
+
+def schema_hash(schema):
+    return hashlib.blake2b(repr(sorted((schema or {}).items())).encode(), digest_size=8).hexdigest()
+
+def file_hash(filename, chunksize=1 << 22):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        while chunk := f.read(chunksize):
+            h.update(chunk)
+    return h.hexdigest()
+
+# 要約 columns: {列名: 型}（indexを含む、スキーマがあればその型）
+#      contest_ids: contest_id（列またはindex）の重複なしの昇順（無ければNone）、epochs: {*epoch_second の列: [最小, 最大]}
+# カテゴリ型は使っている符号から重複を除く（全行の値をたどらない）
+def summarize(df, schema=None):
+    schema = schema or {}
+    items = [*([(df.index.name, df.index)] if df.index.name is not None else []), *df.items()]
+    stats = {'columns': {str(name): schema.get(name, str(values.dtype)) for name, values in items},
+             'contest_ids': None, 'epochs': {}}
+    for name, values in items:
+        if name == 'contest_id':
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                codes = np.asarray(values.array.codes)
+                unique = values.array.categories[np.unique(codes[codes >= 0])]
+            else:
+                unique = values.dropna().unique()
+            stats['contest_ids'] = sorted(map(str, unique))
+        if str(name).endswith('epoch_second') and values.notna().any():
+            stats['epochs'][name] = [int(values.min()), int(values.max())]
+    return stats
+
+# dfを保存したfilenameのマニフェストを書く（一時ファイルから置き換える）、書いた内容を返す
+# partitionを指定したら要約ファイルから作る（dfは使わないのでNoneでよい）
+def write_manifest(df, filename, schema=None, partition=None):
+    if partition is not None:
+        rows, hash_, stats = _summarize_catalog(filename, schema)
+    else:
+        rows, hash_, stats = len(df), file_hash(filename), summarize(df, schema)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'signature': signature(filename),
+        'schema': schema_hash(schema),
+        'rows': rows,
+        'columns': stats['columns'],
+        'hash': hash_,
+        'contest_ids': stats['contest_ids'],
+        'epochs': stats['epochs'],
+    }
+    tmp = f'{manifest_filename(filename)}.tmp'
+    with open(tmp, 'w') as f:
+        yaml.dump(manifest, f, Dumper=YAML_DUMPER, default_flow_style=False)
+    os.replace(tmp, manifest_filename(filename))
+    return manifest
+
+# パーティションのファイルとその要約から、要約ファイルに書く項目を作る
+def _part_summary(path, stats):
+    contest_ids = ' '.join(stats['contest_ids']) if stats['contest_ids'] is not None else None
+    return {'signature': signature(path), 'hash': file_hash(path), 'contest_ids': contest_ids, 'epochs': stats['epochs']}
+
+# 要約ファイルのパーティションごとの要約を集める、(行数, ハッシュ, 要約)
+# 要約が無いか古い（signatureが目録と違う）パーティションは、そのファイルだけを読んで要約を作りなおしておく
+def _summarize_catalog(filename, schema):
+    catalog = read_catalog(filename)
+    assert catalog is not None, f'{filename} is not a catalog of partitions.'
+    parts = catalog['partitions']
+    summary = read_summary(filename)
+    summaries = summary.get('partitions') or {}
+    missing = [part for part in parts if (summaries.get(part['label']) or {}).get('signature') != part['signature']]
+    if len(missing) > 0 or 'columns' not in summary:
+        dirname = os.path.dirname(filename)
+        for part in missing or parts[-1:]:
+            stats = summarize(_read_parts(filename, catalog, [part], schema), schema)
+            summaries[part['label']] = _part_summary(os.path.join(dirname, part['filename']), stats)
+            summary['columns'] = stats['columns']
+        labels = {part['label'] for part in parts}
+        summary = {'columns': summary.get('columns') or {},
+                   'partitions': {label: item for label, item in summaries.items() if label in labels}}
+        _write_yaml(summary_filename(filename), summary)
+    h = hashlib.blake2b(digest_size=16)
+    contest_ids, epochs = None, {}
+    for part in parts:
+        item = summaries[part['label']]
+        h.update(f'{part["label"]}:{item["hash"]}'.encode())
+        if item['contest_ids'] is not None: contest_ids = (contest_ids or set()).union(item['contest_ids'].split())
+        for name, (lower, upper) in item['epochs'].items():
+            epochs[name] = [min(lower, epochs[name][0]), max(upper, epochs[name][1])] if name in epochs else [lower, upper]
+    stats = {'columns': summary['columns'], 'contest_ids': sorted(contest_ids) if contest_ids is not None else None,
+             'epochs': epochs}
+    return sum(part['rows'] for part in parts), h.hexdigest(), stats
+
+# filenameのマニフェスト、無いか古い（signature、形式、スキーマが違う）ときはNone
+def read_manifest(filename, schema=None):
+    if not os.path.isfile(manifest_filename(filename)): return None
+    with open(manifest_filename(filename)) as f:
+        manifest = yaml.load(f, Loader=YAML_LOADER)
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION: return None
+    if manifest.get('signature') != signature(filename) or manifest.get('schema') != schema_hash(schema): return None
+    return manifest
@@ -0,0 +1,51 @@
+# ユーザごとのレート推移（ある時刻におけるレートを一括で引く）
+# UsersARateHistory / UsersHRateHistory のdf（index: user_id、datetime: コンテスト終了のエポック秒、new_rate）から作る
+#
+# user_idを符号(code)にして、ユーザごとに時刻順に並べた epochs / rates と、ユーザごとの開始位置 offsets を持つ
+# 一括の問い合わせは、code * 2^33 + epoch の合成キー（ユーザ、時刻の順に昇順）を searchsorted で引く
+# 時刻tのレートは、終了時刻がt以下の最後のコンテストの new_rate（コンテスト中の提出であれば、そのコンテスト前のレート）
+# それより前（未参加）は、引数 default を返す
+
+import numpy as np
+import pandas as pd
+
+class RatingTimeline:
+    SHIFT = 33      # エポック秒は2^33未満（2242年まで）
+
+    def __init__(self, users, offsets, epochs, rates):
+        self.users = users          # pd.Index(user_id) 昇順
+        self.offsets = offsets      # len(users) + 1
+        self.epochs = epochs
+        self.rates = rates
+        self.keys = (np.repeat(np.arange(len(users), dtype=np.int64), np.diff(offsets)) << self.__class__.SHIFT) | epochs
+
+    @classmethod
+    def from_df(cls, df, time_column='datetime', rate_column='new_rate'):
+        codes, users = pd.factorize(np.asarray(df.index, dtype=object), sort=True)
+        epochs = df[time_column].to_numpy().astype(np.int64)
+        assert (epochs >= 0).all() and (epochs < 1 << cls.SHIFT).all(), 'Out of epoch range.'
+        order = np.lexsort((epochs, codes))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(users)))]).astype(np.int64)
+        return cls(pd.Index(users, name='user_id'), offsets, epochs[order], df[rate_column].to_numpy()[order])
+
+    # Usersオブジェクト（UsersARateHistoryなど）から作る
+    @classmethod
+    def from_users(cls, users):
+        return cls.from_df(users.df)
+
+    # user_idsのそれぞれについて、時刻epochsにおけるレートを返す
+    def rate_at(self, user_ids, epochs, default=np.nan):
+        codes = self.users.get_indexer(np.asarray(user_ids, dtype=object))
+        epochs = np.asarray(epochs).astype(np.int64)
+        queries = (np.maximum(codes, 0).astype(np.int64) << self.__class__.SHIFT) | epochs
+        positions = np.searchsorted(self.keys, queries, side='right') - 1
+        found = (codes >= 0) & (positions >= 0)
+        found[found] &= self.keys[positions[found]] >> self.__class__.SHIFT == codes[found]
+        res = np.full(len(codes), default, dtype=np.float64)
+        res[found] = self.rates[positions[found]]
+        return res
+
+    # 1ユーザのレート推移 (epochs, rates)
+    def history(self, user_id):
+        code = self.users.get_loc(user_id)
+        return self.epochs[self.offsets[code]:self.offsets[code + 1]], self.rates[self.offsets[code]:self.offsets[code + 1]]
@@ -1,77 +1,76 @@
+import sys
 import time
 import os
+import yaml
 import logging
+import multiprocessing
+import tempfile
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import storage
+import kernels
+import profiling
 from lib import AtCoderDB, logging_time
+from cubes import SubmissionCubes
+from timeline import RatingTimeline
 
 # Usersクラス
 # submissions または results をもとに、user_idをインデックス管理、datetimeフィールドを持つ
 # (双方ともlibにおいてdatetimeで昇順にソート済)
+# datetimeの形式は fleq に持つ（kernels.FLEQSのいずれか、作った時点では 'epoch'）
 
 class Users:
+    # aggで1回の走査で計算できる集計
+    FAST_AGG = ['size', 'count', 'sum', 'mean', 'last']
+    # 保存・読み込みするdatetimeの形式
+    FLEQ = 'epoch'
+
     def __init__(self, df=None, filename=None):
         self.df = df
         self.filename = filename
+        self.fleq = self.__class__.FLEQ
+        self._groups = None     # (df, groups) groupsの結果をdfが同じ間だけ使い回す
         if df is None and filename is not None and os.path.isfile(filename):
             self.load()
 
     @classmethod
-    def from_db(cls, db, key):
+    def from_db(cls, db, key, columns=None):
+        return cls.from_df(db.df(key), key, columns)
+
+    # AtCoderDBのテーブル（またはそのクエリー結果）から作る
+    # columnsを指定すると、その列（とuser_id、datetime）だけを持つ
+    @classmethod
+    def from_df(cls, df, key, columns=None):
         assert key == 'submissions' or key == 'results'
         # datetimeは、submissionsであればepoch_second, resultsであれば end_epoch_secondを使う
         time_column = 'epoch_second' if key == 'submissions' else 'end_epoch_second'
+        if columns is not None:
+            df = df[['user_id', time_column, *[c for c in columns if c not in ['user_id', time_column]]]]
         # そのまま数値で持ち、datetime64型は使わない(user_idグループの中でresampleすると遅いので)
-        df = db.df(key).rename(columns={time_column: 'datetime'}).set_index('user_id')
+        df = df.rename(columns={time_column: 'datetime'}).set_index('user_id')
         return cls(df)
 
+    # 同じクラスで、dfだけを替えたものを作る（datetimeの形式は引き継ぐ）
+    def _derive(self, df, fleq=None):
+        users = self.__class__(df)
+        users.fleq = self.fleq if fleq is None else fleq
+        return users
+
     # datetimeのepoch数値をアップorダウンサンプリングする、resampleのように集計はしない
-    # 'epoch': エポック秒, 'D': YYYYMMDD、'M': YYYYMM、'Y': YYYY の4形式 (いずれも東京TZ)
+    # 'epoch': エポック秒, 'H': YYYYMMDDHH, 'D': YYYYMMDD、'W': 週初め(月曜)のYYYYMMDD、'M': YYYYMM、'Y': YYYY
+    # の形式 (いずれも東京TZ、kernels.resample_datetime を参照)
     # epochに戻すことはできない（遅いため）
     def resample(self, fleq, inplace=False):
+        assert fleq in kernels.FLEQS and fleq != 'epoch', f'Fleq: {fleq} is not supported.'
         df = self.df
-        fleq_org = self.__class__._type_datetime(df)
-        if fleq == fleq_org: return self.__class__(df)
-        match fleq_org:
-            case 'epoch':
-                datetime = pd.to_datetime(df['datetime'], unit='s', utc=True).dt.tz_convert('Asia/Tokyo')
-                year, month, day = datetime.dt.year, datetime.dt.month, datetime.dt.day
-            case 'Y':
-                year, month, day = df['datetime'], 1, 1
-            case 'M':
-                year, month, day = df['datetime'] // 100, df['datetime'] % 100, 1
-            case 'D':
-                year, month, day = df['datetime'] // 10000, df['datetime'] // 100 % 100, df['datetime'] % 100
-            case _:
-                assert False
-        match fleq:
-            case 'Y':
-                df['datetime'] = year
-            case 'M':
-                df['datetime'] = year * 100 + month
-            case 'D':
-                df['datetime'] = year * 10000 + month * 100 + day
-            case _:
-                assert False
+        if fleq != self.fleq:
+            df = df.assign(datetime=kernels.resample_datetime(df['datetime'].to_numpy(), self.fleq, fleq))
         if inplace:
             self.df = df
+            self.fleq = fleq
         else:
-            return self.__class__(df)
-
-    # datetime列の型の自動判定
-    @classmethod
-    def _type_datetime(cls, df):
-        match len(str(int(df['datetime'].head(1).values[0]))):
-            case digits if digits >= 10:
-                return 'epoch'
-            case digits if digits == 8:
-                return 'D'
-            case digits if digits == 6:
-                return 'M'
-            case digits if digits == 4:
-                return 'Y'
-            case _:
-                assert False
+            return self._derive(df, fleq)
 
     # 重複削除において、datetime型がresample済であれば一致条件に入れる
     @logging_time
@@ -79,17 +78,17 @@ class Users:
         df = self.df.reset_index()
         if subset is None:
             subset = []
-        if 'datetime' in self.df.columns and self._type_datetime(self.df) != 'epoch':
+        if 'datetime' in self.df.columns and self.fleq != 'epoch':
             subset.insert(0, 'datetime')
         subset.insert(0, 'user_id')
         df = df.drop_duplicates(subset).set_index('user_id')
         if inplace:
             self.df = df
         else:
-            return self.__class__(df)
+            return self._derive(df)
 
     # param={column: value} または param={column: (value, op)}
-    # opは、'==', '!=', '<', '<=', '>', '>=', 'isin' を許容
+    # opは、'==', '!=', '<', '<=', '>', '>=', 'isin', 'notna'(valueは無視) を許容
     @logging_time
     def filter(self, params, inplace=False):
         df = self.df
@@ -110,36 +109,110 @@ class Users:
                     df = df[df[column] >= value]
                 case 'isin':
                     df = df[df[column].isin(value)]
+                case 'notna':
+                    df = df[df[column].notna()]
                 case _:
                     assert False
         if inplace:
             self.df = df
         else:
-            return self.__class__(df)
+            return self._derive(df)
+
+    # 集計のグループ user_id（datetime型がresample済であればdatetimeも）を符号化する
+    # (codes, order, starts, index) を返す
+    # codes: 行ごとのグループ番号（キーが欠損の行は-1）、order: グループ番号で安定ソートした行番号（欠損行を除く）
+    # starts: orderにおける各グループの開始位置、index: グループのキー（groupbyと同じ昇順）
+    def groups(self):
+        if self._groups is not None and self._groups[0] is self.df: return self._groups[1]
+        df = self.df
+        by = [df.index]
+        if 'datetime' in df.columns and self.fleq != 'epoch':
+            by.append(df['datetime'])
+        codes, uniques = pd.factorize(by[0], sort=True)
+        codes = codes.astype(np.int64)
+        if len(by) == 2:
+            codes2, uniques2 = pd.factorize(by[1], sort=True)
+            valid = (codes >= 0) & (codes2 >= 0)
+            key = np.where(valid, codes * len(uniques2) + codes2, -1)
+            combined = np.unique(key[valid])
+            codes = np.where(valid, np.searchsorted(combined, key), -1)
+            index = pd.MultiIndex.from_arrays([uniques.take(combined // len(uniques2)),
+                                               uniques2.take(combined % len(uniques2))], names=['user_id', 'datetime'])
+        else:
+            index = pd.Index(uniques, name='user_id')
+        order = np.argsort(codes, kind='stable')
+        order = order[(codes < 0).sum():]
+        starts = np.concatenate([[0], np.cumsum(np.bincount(codes[order], minlength=len(index)))[:-1]]).astype(np.int64)
+        groups = (codes, order, starts, index)
+        self._groups = (df, groups)
+        return groups
+
+    # 1列の集計（FAST_AGGの関数）
+    @classmethod
+    def _agg_column(cls, values, func, groups):
+        codes, order, starts, index = groups
+        n = len(index)
+        if func == 'size':
+            return pd.Series(np.bincount(codes[order], minlength=n), index=index)
+        notna = values.notna().to_numpy()
+        if func == 'count':
+            return pd.Series(np.bincount(codes[order], weights=notna[order], minlength=n).astype(np.int64), index=index)
+        if func == 'last':
+            # 欠損でない最後の値（グループ内にすべて欠損なら欠損）
+            rows = order[notna[order]]
+            ends = np.flatnonzero(np.diff(codes[rows], append=-1))
+            indexer = np.full(n, -1, dtype=np.int64)
+            indexer[codes[rows[ends]]] = rows[ends]
+            return pd.Series(pd.api.extensions.take(values.array, indexer, allow_fill=True), index=index)
+        # sum / mean は欠損を除いて集計する（整数はint64、bool は整数として足す）
+        array = values.to_numpy()
+        if array.dtype.kind in 'biu':
+            array = array.astype(np.int64)
+        else:
+            array = np.where(notna, array, 0)
+        sums = np.add.reduceat(array[order], starts) if len(order) > 0 else np.zeros(0, dtype=array.dtype)
+        if func == 'sum':
+            return pd.Series(sums, index=index)
+        counts = np.bincount(codes[order], weights=notna[order], minlength=n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.Series(sums / counts, index=index)
 
     # 集計において、datetime型がresample済であれば一致条件に入れる
     # map={元column: 集計func} または {元column: (集計func, 集計後column)}
+    # FAST_AGGの関数は、グループの符号化を共有して1回の走査で計算する。それ以外はgroupbyで計算する
     @logging_time
     def agg(self, map, inplace=False):
-        df = self.df.reset_index()
-        by = ['user_id']
-        if 'datetime' in df.columns and self.__class__._type_datetime(df) != 'epoch':
-            by.append('datetime')
+        groups = self.groups()
+        index = groups[3]
         res = []
         for column_fr, param in map.items():
             (func, column_to) = param if isinstance(param, tuple) else (param, column_fr)
-            to_ = df.groupby(by)[column_fr].agg(func)
+            values = self.df[column_fr]
+            if isinstance(func, str) and func in self.__class__.FAST_AGG:
+                to_ = self.__class__._agg_column(values, func, groups)
+            else:
+                keys = [self.df.index] + ([self.df['datetime']] if index.nlevels == 2 else [])
+                to_ = values.groupby(keys, observed=True).agg(func)
+                to_.index.names = index.names
             to_.name = column_to
             res.append(to_)
         df = pd.concat(res, axis=1)
+        by = list(index.names)
+        # カテゴリ型のuser_idは、集計後は通常の文字列に戻す（merge時にカテゴリが食い違わないように）
+        if any(isinstance(df.index.get_level_values(i).dtype, pd.CategoricalDtype) for i in range(df.index.nlevels)):
+            df = df.reset_index()
+            df[by] = df[by].astype(object)
+            df = df.set_index(by)
         if inplace:
             self.df = df
         else:
-            return self.__class__(df)
+            return self._derive(df)
 
     @classmethod
     def merge(cls, others):
-        return cls(pd.concat([other.df for other in others], axis=1))
+        users = cls(pd.concat([other.df for other in others], axis=1))
+        users.fleq = others[0].fleq
+        return users
 
     # 特定の列をキーに比率を追加する
     def add_ratio(self, column, ratio_column, inplace=False):
@@ -148,7 +221,7 @@ class Users:
         if inplace:
             self.df = df
         else:
-            return self.__class__(df)
+            return self._derive(df)
 
     # 特定の列をキーにAtCoder色を追加する
     def add_color(self, column, color_column, inplace=False):
@@ -165,7 +238,11 @@ class Users:
         if inplace:
             self.df = df
         else:
-            return self.__class__(df)
+            return self._derive(df)
+
+    # 計測用（profiling.frame_sizeを参照）
+    def profile_frame(self, *args, **kwargs):
+        return self.df
 
     def save(self, filename=None):
         filename = self.filename if filename is None else filename
@@ -179,119 +256,365 @@ class Users:
         logging.info(f'Loading {self.__class__} from {filename}')
         self.df = pd.read_csv(filename, index_col=0)
 
+# 差分更新できるUsers
+# 集計の途中状態(state)をマージ可能なDataFrameとして {filename}.state.npz に保存し、
+# そのstateがカバーしている範囲(watermark)を {filename}.state.meta.yaml に記録する
+# update() はwatermarkより後の入力(delta)だけをstateに畳み込む。update(full=True) で全件から作り直す
+#
+# 継承先で定義するもの
+# KEY: 入力のAtCoderDBのkey
+# delta(db, watermark): watermarkより後の入力と、新しいwatermark を返す（watermarkがNoneなら全件）
+# fold(db, state, delta): stateにdeltaを畳み込んだ新しいstateを返す（stateがNoneなら新規）
+# output(db, state): stateから出力のDataFrameを作る
+class IncrementalUsers(Users):
+    KEY = None
+    INPUTS = []     # 入力として使うAtCoderDBのkey（users.mainで事前にloadする）
+
+    def __init__(self, df=None, filename=None):
+        super().__init__(df, filename)
+        self.state = None
+        self.watermark = None
+
+    def state_filename(self):
+        return self.filename.replace('.csv.gz', '.state.npz')
+
+    def load_state(self):
+        filename = self.state_filename()
+        if not os.path.isfile(filename) or not os.path.isfile(f'{filename}.meta.yaml'): return None, None
+        with open(f'{filename}.meta.yaml') as f:
+            meta = yaml.safe_load(f)
+        logging.info(f'Loading state of {self.__class__} from {filename}')
+        return storage.read(filename, 'npz'), meta['watermark']
+
+    @logging_time
+    def update(self, full=False):
+        db = AtCoderDB()
+        name = self.__class__.__name__
+        state, watermark = (None, None) if full else self.load_state()
+        with profiling.span(f'{name}.delta') as span:
+            delta, self.watermark = self.delta(db, watermark)
+            span['output'] = delta
+        logging.info(f'Folding {len(delta)} rows of {self.__class__.KEY} into {self.__class__}')
+        if state is None or len(delta) > 0:
+            with profiling.span(f'{name}.fold', [state, delta]) as span:
+                state = span['output'] = self.fold(db, state, delta)
+        self.state = state
+        with profiling.span(f'{name}.output', [state]) as span:
+            self.df = span['output'] = self.output(db, self.state)
+
+    # 出力に加えてstateも保存する（stateを先に書くので、途中で落ちても次回は再度畳み込まれるだけ）
+    def save(self, filename=None):
+        super().save(filename)
+        if self.state is None: return
+        state_filename = self.state_filename()
+        storage.write(self.state, state_filename, 'npz')
+        with open(f'{state_filename}.meta.yaml', 'w') as f:
+            yaml.safe_dump({'key': self.__class__.KEY, 'watermark': self.watermark}, f, default_flow_style=False)
+        logging.info(f'Saved state of {self.__class__} to {state_filename}')
+
+    # resultsの差分は、stateに未反映のコンテスト単位で取る（過去のコンテストが後から取得されることがあるため）
+    # watermarkは反映済のcontest_idのリスト
+    def delta_results(self, db, watermark):
+        contest_ids = db.manifest('results')['contest_ids'] or []
+        new_ids = contest_ids if watermark is None else sorted(set(contest_ids) - set(watermark))
+        return db.query('results').where(contest_id=new_ids).collect(), contest_ids
+
+    # check用: 時刻cutoffまでの行しかない（伸びていく途中の）テーブルから取った差分と、そのときのwatermark
+    # submissionsのwatermarkはcutoff（次回はmerge_overlapだけ遡るので、cutoffの前後の行を重ねて読み直す）
+    # resultsのwatermarkは反映済のcontest_idのリスト
+    def delta_until(self, db, watermark, cutoff):
+        delta, latest = self.__class__.delta(self, db, watermark)
+        if cutoff is None: return delta, latest
+        delta = delta[delta[self.time_column()] <= cutoff]
+        if self.__class__.KEY == 'submissions': return delta, int(cutoff)
+        return delta, sorted(set(watermark or []) | {str(c) for c in delta['contest_id'].unique()})
+
+    def time_column(self):
+        return 'epoch_second' if self.__class__.KEY == 'submissions' else 'end_epoch_second'
+
+    # 差分と一括で結果が一致することを確認する
+    # 1. 入力を時刻で2つに分けて順に畳み込み、全件からの結果と比べる
+    # 2. 伸びていくテーブルに対してupdate()を3回（全件から、その後2回は保存したstateとwatermarkからの差分で）
+    #    実行して、全件からの結果と比べる（出力とstateは一時ディレクトリに保存する）
+    def check(self):
+        db = AtCoderDB()
+        delta, _ = self.delta(db, None)
+        time_column = self.time_column()
+        median = delta[time_column].median()
+        state = self.fold(db, None, delta[delta[time_column] <= median])
+        state = self.fold(db, state, delta[delta[time_column] > median])
+        expected = self.output(db, self.fold(db, None, delta))
+        pd.testing.assert_frame_equal(self.output(db, state), expected)
+        # cutoffは実在する時刻にして、watermarkちょうどの行が次回の差分にも含まれるようにする
+        cutoffs = [delta[time_column].quantile(q, interpolation='lower') for q in [1 / 3, 2 / 3]] + [None]
+        filename = self.filename
+        with tempfile.TemporaryDirectory() as dirname:
+            self.filename = os.path.join(dirname, os.path.basename(filename))
+            try:
+                for i, cutoff in enumerate(cutoffs):
+                    self.delta = lambda db, watermark: self.delta_until(db, watermark, cutoff)
+                    self.update(full=i == 0)
+                    self.save()
+            finally:
+                del self.delta
+                self.filename = filename
+        pd.testing.assert_frame_equal(self.df, expected)
+        logging.info(f'Incremental update of {self.__class__} is identical to full rebuild')
+
 # Usersを継承して、代表的な分析を行う
 #
 # 共通的な使い方
 # クラスオブジェクトを作ると、既存でセーブされていれば読み込む
-# update() で最新情報にする（関連のAtCoderDB情報が遅延最新化される）
+# update() で最新情報にする（関連のAtCoderDB情報が遅延最新化される、前回からの差分だけを反映する）
+# update(full=True) で全件から作り直す
 # save() で指定ファイルにセーブする
 # dfに計算したDataFrameが入る
 # append(others) でたとえばBaseProfileとその他をマージできる
 
 # user基本情報 country affiliation algo/heuristicsの最新レート を得る
-class UsersProfile(Users):
+# state: userごとの各列の最新値と、その時刻(列名_t)
+class UsersProfile(IncrementalUsers):
+    KEY = 'results'
+    INPUTS = ['results', 'contests']
+    # 出力列: (元の列, 条件)
+    COLUMNS = {'country': ('country', {}), 'affiliation': ('affiliation', {}),
+               'a_rate': ('new_rate', {'rated': 1, 'type_': 'Algorithm'}),
+               'h_rate': ('new_rate', {'rated': 1, 'type_': 'Heuristic'})}
+
     def __init__(self, df=None):
         super().__init__(df, filename='../out/users/profile.csv.gz')
 
-    @logging_time
-    def update(self):
-        db = AtCoderDB()
-        db.add_rated_and_type('results')
-        users = Users.from_db(db, 'results')
-        users = users.agg({'country': 'last', 'affiliation': 'last'})
-        db.filter('results', rated=1)
-        a_rate = Users.from_db(db, 'results').filter({'type_': 'Algorithm'}).agg({'new_rate': ('last', 'a_rate')})
-        h_rate = Users.from_db(db, 'results').filter({'type_': 'Heuristic'}).agg({'new_rate': ('last', 'h_rate')})
-        self.df = Users.merge([users, a_rate, h_rate]).df
+    def delta(self, db, watermark):
+        return self.delta_results(db, watermark)
+
+    def fold(self, db, state, delta):
+        users = Users.from_df(db.add_rated_and_type_to(delta), 'results',
+                              columns=['country', 'affiliation', 'new_rate', 'rated', 'type_'])
+        parts = []
+        for column, (column_fr, params) in self.__class__.COLUMNS.items():
+            part = users.filter({**params, column_fr: (None, 'notna')})
+            if len(part.df) == 0:
+                parts.append(pd.DataFrame(columns=[column, f'{column}_t'], index=pd.Index([], name='user_id')))
+                continue
+            parts.append(part.agg({column_fr: ('last', column), 'datetime': ('last', f'{column}_t')}).df)
+        new = pd.concat(parts, axis=1)
+        if state is None: return new
+        # 列ごとに、時刻の新しい方（同時刻ならdelta）を採る
+        state, new = state.align(new, join='outer')
+        for column in self.__class__.COLUMNS:
+            newer = new[f'{column}_t'].notna() & (new[f'{column}_t'].fillna(-np.inf) >= state[f'{column}_t'].fillna(-np.inf))
+            old_values, new_values = state[column], new[column]
+            if isinstance(old_values.dtype, pd.CategoricalDtype) or isinstance(new_values.dtype, pd.CategoricalDtype):
+                old_values, new_values = old_values.astype(object), new_values.astype(object)
+            state[column] = old_values.where(~newer, new_values)
+            state[f'{column}_t'] = state[f'{column}_t'].where(~newer, new[f'{column}_t'])
+        return state
+
+    def output(self, db, state):
+        df = state[list(self.__class__.COLUMNS)].sort_index()
+        df.index = df.index.astype(object)
+        for column in ['country', 'affiliation']:
+            df[column] = df[column].astype(object)
+        for column in ['a_rate', 'h_rate']:
+            df[column] = pd.to_numeric(df[column])
+        return df
         #self.add_color('a_rate','a_color', inplace=True)
         #self.add_color('h_rate','h_color', inplace=True)
 
 # 精進情報 accepted, rps, tee と累積diffを得る
-class UsersShojin(Users):
+# state: ユニークなAC (user_id, problem_id) ごとの最初のAC（diff/teeやrated/type_は出力時に付け直す）
+class UsersShojin(IncrementalUsers):
+    KEY = 'submissions'
+    INPUTS = ['submissions', 'contests', 'problem_models']
+
     def __init__(self, df=None):
         super().__init__(df, filename='../out/users/shojin.csv.gz')
 
-    @logging_time
-    def update(self):
-        db = AtCoderDB()
-        db.add_rated_and_type('submissions')
+    def delta(self, db, watermark):
+        return self.__class__.delta_ac(db, watermark, ['user_id', 'problem_id', 'contest_id', 'epoch_second', 'point'],
+                                       distinct=['user_id', 'problem_id'])
+
+    # watermark以降（ストアのマージと同じだけ遡る）のAC
+    @classmethod
+    def delta_ac(cls, db, watermark, columns, distinct=False):
+        query = db.query('submissions').where(result='AC').select(columns)
+        if watermark is not None:
+            overlap = db.config['database']['submissions']['pre_processing']['merge_overlap']
+            query = query.where(epoch_second=range(watermark - overlap, 2 ** 62))
+        if distinct is not False:
+            query = query.distinct(distinct)
+        return query.collect(), db.updated['submissions']['watermark']
+
+    def fold(self, db, state, delta):
+        delta = delta.reset_index(drop=True)
+        if state is None: return delta
+        state = storage.concat([state, delta]).sort_values('epoch_second', kind='stable')
+        return state.drop_duplicates(['user_id', 'problem_id']).reset_index(drop=True)
+
+    def output(self, db, state):
         # ユニークなAC提出をすべて抽出して、accepted、tee、diff累積 を計算
-        db.filter('submissions', result='AC')
-        db.drop_duplicates('submissions', ['user_id', 'problem_id'])
-        db.add_diff_and_tee_in_submissions()
-        accepted = Users.from_db(db, 'submissions').agg({'result': ('size', 'accepted')})
-        tee_diff = Users.from_db(db, 'submissions').agg({'tee': 'sum', 'diff': 'sum'})
+        users = Users.from_df(db.add_diff_and_tee(db.add_rated_and_type_to(state)), 'submissions',
+                              columns=['problem_id', 'tee', 'diff', 'point', 'rated', 'type_'])
+        accepted_tee_diff = users.agg({'problem_id': ('size', 'accepted'), 'tee': 'sum', 'diff': 'sum'})
         # rpsは本家では「rated かつ 問題が2問以上のコンテスト」のpoint総計
         # ここではより正確に「rated かつ アルゴ」でフィルタしている
-        rps = Users.from_db(db, 'submissions').filter({'rated': 1, 'type_': 'Algorithm'})\
-            .agg({'point': ('sum', 'rps')})
-        self.df = Users.merge([accepted, rps, tee_diff]).df
-        self.df.fillna(0).round().astype(int)
+        rps = users.filter({'rated': 1, 'type_': 'Algorithm'}).agg({'point': ('sum', 'rps')})
+        return Users.merge([accepted_tee_diff, rps]).df[['accepted', 'rps', 'tee', 'diff']]
+
+# ユーザ単位での、rate更新履歴（TYPE_で Algorithm / Heuristic を指定する）
+# state: 出力そのもの（新しいコンテストの行を追加して時刻順に並べ直す）
+class UsersRateHistory(IncrementalUsers):
+    KEY = 'results'
+    INPUTS = ['results', 'contests']
+    TYPE_ = None
+
+    def delta(self, db, watermark):
+        return self.delta_results(db, watermark)
+
+    def fold(self, db, state, delta):
+        df = Users.from_df(db.add_rated_and_type_to(delta), 'results')\
+            .filter({'type_': self.__class__.TYPE_, 'user_rated': 1})\
+            .df[['datetime', 'contest_id', 'old_rate', 'new_rate', 'perf']]
+        if state is None: return df
+        return storage.concat([state, df]).sort_values('datetime', kind='stable')
+
+    # stateを保存から読み直すとカテゴリ型が外れるので、全件からの場合とそろえて文字列で出す
+    def output(self, db, state):
+        df = state.copy()
+        df.index = df.index.astype(object)
+        df['contest_id'] = df['contest_id'].astype(object)
+        return df
 
 # ユーザ単位での、Algoのrate更新履歴
-class UsersARateHistory(Users):
+class UsersARateHistory(UsersRateHistory):
+    TYPE_ = 'Algorithm'
+
     def __init__(self, df=None):
         super().__init__(df, filename='../out/users/a_rate_hist.csv.gz')
 
-    @logging_time
-    def update(self):
-        db = AtCoderDB()
-        db.add_rated_and_type('results')
-        self.df = Users.from_db(db, 'results').filter({'type_': 'Algorithm', 'user_rated': 1})\
-            .df[['datetime', 'contest_id', 'old_rate', 'new_rate', 'perf']]
-
 # ユーザ単位での、Heuristicのrate更新履歴
-class UsersHRateHistory(Users):
+class UsersHRateHistory(UsersRateHistory):
+    TYPE_ = 'Heuristic'
+
     def __init__(self, df=None):
         super().__init__(df, filename='../out/users/h_rate_hist.csv.gz')
 
-    @logging_time
-    def update(self):
-        db = AtCoderDB()
-        db.add_rated_and_type('results')
-        self.df = Users.from_db(db, 'results').filter({'type_': 'Heuristic', 'user_rated': 1})\
-            .df[['datetime', 'contest_id', 'old_rate', 'new_rate', 'perf']]
+# ユーザ単位・月単位の精進履歴（アルゴのコンテストの問題で、diffのあるもの）
+# unique_ac: 月間ユニークAC数、tee / diff: その合計
+# rate: 月初のアルゴレート（その月にコンテストが無くても直前のレートで補完、未参加は0）
+# diff_sub_rate_sum: 月間ユニークACの (diff - 月初rate) の合計
+# unique_ac_cum / diff_sub_rate_cum: それぞれの月までの累積
+# state: ユニークな (user_id, 月, problem_id) のAC（diff/teeやtype_、レートは出力時に付け直す）
+class UsersShojinExHistory(IncrementalUsers):
+    KEY = 'submissions'
+    INPUTS = ['submissions', 'contests', 'problem_models', 'results']
+    FLEQ = 'M'
 
-# 月間ユニークAC数(diffありのもの)(unique_ac)、左記の(diff-月初rate)累積(diff_sub_rate_sum)
-# マージでの補完つき（rate記録無い月でもrateを入れる）
-# *********** 工事中 ************
-
-class UsersShojinExHistory(Users):
     def __init__(self, df=None):
         super().__init__(df, filename='../out/users/shojin_ex.csv.gz')
 
-    def update(self):
-        logging.info('Computing shojin_ex ...')
-        start_time = time.time()
-        db = AtCoderDB()
-        db.add_rated_and_type('submissions')
-        db.filter('submissions', result='AC', type_='Algorithm')
-        db.add_diff_and_tee_in_submissions()
-        self.df = self.__class__.from_db(db, 'submissions', time_columns=('epoch_second', 'time'),
-            resolution='month',
-            filter={'type_': 'Algorithm', 'user_rated': 1},
-            drop_duplicates=['time', 'problem_id'],
-            size='accepted', agg={'tee': np.sum, 'diff': np.sum}).df
-        duration = int(time.time() - start_time)
-        logging.info(f'Computed shojin_ex in {duration}sec.')
+    def delta(self, db, watermark):
+        return UsersShojin.delta_ac(db, watermark, ['user_id', 'problem_id', 'contest_id', 'epoch_second'])
+
+    def fold(self, db, state, delta):
+        delta = delta.assign(datetime=kernels.resample_datetime(delta['epoch_second'].to_numpy(), 'epoch', 'M'))
+        delta = delta[['user_id', 'datetime', 'problem_id', 'contest_id']].reset_index(drop=True)
+        state = delta if state is None else storage.concat([state, delta])
+        return state.drop_duplicates(['user_id', 'datetime', 'problem_id']).reset_index(drop=True)
+
+    # resultsから、アルゴのレート推移を作る
+    @classmethod
+    def timeline(cls, db):
+        rated = db.add_rated_and_type_to(db.query('results').where(user_rated=1).collect())
+        rated = rated[rated['type_'] == 'Algorithm'].set_index('user_id')
+        return RatingTimeline.from_df(rated, time_column='end_epoch_second')
+
+    def output(self, db, state):
+        df = db.add_diff_and_tee(db.add_rated_and_type_to(state))
+        df = df[(df['type_'] == 'Algorithm') & df['diff'].notna()]
+        rate = self.__class__.timeline(db).rate_at(df['user_id'], kernels.to_epoch(df['datetime'].to_numpy(), 'M'), default=0)
+        df = df.assign(rate=rate, diff_sub_rate=df['diff'] - rate).set_index('user_id')
+        users = Users(df[['datetime', 'tee', 'diff', 'rate', 'diff_sub_rate']])
+        users.fleq = 'M'
+        df = users.agg({'datetime': ('size', 'unique_ac'), 'tee': 'sum', 'diff': 'sum', 'rate': 'last',
+                        'diff_sub_rate': ('sum', 'diff_sub_rate_sum')}).df
+        # 集計結果は (user_id, datetime) の昇順なので、ユーザごとの累積和がそのまま月順になる
+        cum = df[['unique_ac', 'diff_sub_rate_sum']].groupby(level='user_id').cumsum()
+        df['unique_ac_cum'] = cum['unique_ac']
+        df['diff_sub_rate_cum'] = cum['diff_sub_rate_sum']
+        return df.reset_index(level='datetime')
 
 # 定義されているクラスの情報を一斉にアップデートする
-def main():
-    shojin = UsersShojin()
-    shojin.update()
-    shojin.save()
-    profile = UsersProfile()
-    profile.update()
-    profile.save()
-    a_rate_hist = UsersARateHistory()
-    a_rate_hist.update()
-    a_rate_hist.save()
-    h_rate_hist = UsersHRateHistory()
-    h_rate_hist.update()
-    h_rate_hist.save()
-    #shojin_ex = UsersShojinExHistory()
-    #shojin_ex.update()
-    #shojin_ex.save()
+# 1. 各ジョブのINPUTSを、依存関係の順に1回だけ親プロセスでloadする（fetch、共有列ストアと副次インデックスの用意を含む）
+# 2. ジョブは互いに独立なので、プロセスプールで並列に update / save する
+#    子プロセスのAtCoderDBは読み取り専用で、submissions / results の共有列ストアにメモリマップで接続する
+#    （fetch / save / exportは1.で親プロセスが済ませておき、子プロセスからは行わない）
+# チャート用の提出集計キューブ(SubmissionCubes)も同じジョブとして更新する
+JOBS = [UsersShojin, UsersProfile, UsersARateHistory, UsersHRateHistory, UsersShojinExHistory, SubmissionCubes]
+
+# ワーカープロセスの初期化: AtCoderDBは親プロセスが用意したものを読むだけにする
+def init_worker():
+    AtCoderDB.READ_ONLY = True
+
+# ジョブを1つ実行して、(秒, このジョブで記録したspan) を返す（ワーカーのspanは親で取り込む）
+def run_job(name, full=False):
+    start_time = time.time()
+    first = len(profiling.profiler.spans)
+    with profiling.span(f'run_job.{name}'):
+        users = globals()[name]()
+        users.update(full)
+        with profiling.span(f'{name}.save', [users]):
+            users.save()
+    return time.time() - start_time, profiling.profiler.spans[first:]
+
+# python users.py full で全件から作り直す、python users.py check で差分更新と全件の一致を確認する
+# python users.py jobs で、prepareせずに（前回のprepareで用意したテーブルに対して）ジョブだけを実行する
+@logging_time
+def main(full=False, jobs=JOBS):
+    db = AtCoderDB()
+    db.prepare(list(dict.fromkeys(key for job in jobs for key in job.INPUTS)))
+    run_jobs(full, jobs)
+
+# prepare済のテーブルに対してジョブを実行する（configのusers.workersが2以上ならプロセスプールで並列に）
+def run_jobs(full=False, jobs=JOBS):
+    db = AtCoderDB()
+    workers = min(db.config['users']['workers'], len(jobs))
+    if workers <= 1:
+        for job in jobs: run_job(job.__name__, full)
+    else:
+        # 親プロセスのスレッドやSQLite接続を引き継がないように、spawnで起動する
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_worker) as executor:
+            futures = {executor.submit(run_job, job.__name__, full): job for job in jobs}
+            for future in as_completed(futures):
+                duration, spans = future.result()
+                profiling.profiler.extend(spans)
+                logging.info(f'Finished {futures[future].__name__} in {int(duration)}sec.')
+
+# 記録したspanを書き出す（config.yaml の profiling の json / trace）
+def save_profile():
+    config = AtCoderDB().config.get('profiling') or {}
+    if config.get('json') is not None:
+        profiling.profiler.save_json(config['json'])
+        logging.info(f'Saved profile to {config["json"]}')
+    if config.get('trace') is not None:
+        profiling.profiler.save_trace(config['trace'])
+        logging.info(f'Saved trace events to {config["trace"]}')
+
+def check():
+    for cls in [UsersShojin, UsersProfile, UsersARateHistory, UsersHRateHistory, UsersShojinExHistory]:
+        cls().check()
 
 if __name__ == '__main__':
-    main()
+    match sys.argv[1:]:
+        case ['check']:
+            check()
+        case ['full']:
+            main(full=True)
+            save_profile()
+        case ['jobs']:
+            run_jobs()
+            save_profile()
+        case _:
+            main()
+            save_profile()